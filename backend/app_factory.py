@@ -2,6 +2,7 @@
 FastAPI app factory for Lite-LLM-Chat
 """
 
+import asyncio
 import os
 from contextlib import asynccontextmanager
 
@@ -11,10 +12,16 @@ from fastapi.staticfiles import StaticFiles
 
 from config import settings
 from database import init_db
+from db_writer import writer
+from maintenance import abort_interrupted_replies, run_startup_backfills
 from routers.chat import router as chat_router
+from routers.chat_ws import router as chat_ws_router
+from routers.db import router as db_router
+from routers.export import get_router as get_export_router
 from routers.health import router as health_router
 from routers.models import router as models_router
 from routers.providers import router as providers_router
+from routers.search import router as search_router
 from routers.sessions import router as sessions_router
 from routers.upload import get_router as get_upload_router
 
@@ -23,7 +30,12 @@ from routers.upload import get_router as get_upload_router
 async def lifespan(app: FastAPI):
     """Startup and shutdown events"""
     init_db()
+    await abort_interrupted_replies()
+    backfill = asyncio.create_task(run_startup_backfills())
     yield
+    if not backfill.done():
+        backfill.cancel()
+    await writer.close()
 
 
 def create_app() -> FastAPI:
@@ -40,6 +52,7 @@ def create_app() -> FastAPI:
         allow_credentials=True,
         allow_methods=["*"],
         allow_headers=["*"],
+        expose_headers=["X-Generation-Id", "X-Next-Cursor"],
     )
 
     upload_dir = os.path.join(os.path.dirname(__file__), "uploads")
@@ -52,7 +65,11 @@ def create_app() -> FastAPI:
     app.include_router(models_router)
     app.include_router(get_upload_router(upload_dir))
     app.include_router(sessions_router)
+    app.include_router(search_router)
+    app.include_router(get_export_router(upload_dir))
     app.include_router(chat_router)
+    app.include_router(chat_ws_router)
+    app.include_router(db_router)
     app.include_router(health_router)
 
     return app
@@ -0,0 +1,134 @@
+"""
+Transparent compression of bulky message columns
+"""
+import json
+import zlib
+from typing import Any, Optional, Union
+
+from sqlalchemy import Text, type_coerce
+from sqlalchemy.types import TypeDecorator
+
+try:
+    from .config import settings
+except (ImportError, ValueError):
+    from config import settings
+
+try:
+    import zstandard
+except ImportError:  # optional; zlib is always available
+    zstandard = None
+
+
+# Compressed values are stored as BLOBs starting with this marker and a codec
+# byte. Plain TEXT values (including every row written before compression
+# existed) never carry it, so both read back unchanged.
+MARKER = b"\x00lc"
+_ZLIB = b"\x01"
+_ZSTD = b"\x02"
+
+
+def _codec() -> Optional[bytes]:
+    mode = settings.message_compression.lower()
+    if mode == "off":
+        return None
+    if mode == "zlib" or zstandard is None:
+        if mode == "zstd":
+            raise RuntimeError("MESSAGE_COMPRESSION=zstd requires the zstandard package")
+        return _ZLIB
+    return _ZSTD
+
+
+def compress_text(text: Optional[str]) -> Union[str, bytes, None]:
+    """Compressed form of `text` for storage, or `text` itself when not worth compressing."""
+    if text is None:
+        return None
+    codec = _codec()
+    raw = text.encode("utf-8")
+    if codec is None or len(raw) < settings.message_compression_min_bytes:
+        return text
+    if codec == _ZSTD:
+        packed = zstandard.ZstdCompressor().compress(raw)
+    else:
+        packed = zlib.compress(raw)
+    if len(packed) + len(MARKER) + 1 >= len(raw):
+        return text
+    return MARKER + codec + packed
+
+
+def decompress_text(value: Union[str, bytes, None]) -> Optional[str]:
+    """Inverse of compress_text; plain strings pass through."""
+    if value is None or isinstance(value, str):
+        return value
+    value = bytes(value)
+    if not value.startswith(MARKER):
+        return value.decode("utf-8")
+    codec = value[len(MARKER):len(MARKER) + 1]
+    packed = value[len(MARKER) + 1:]
+    if codec == _ZLIB:
+        return zlib.decompress(packed).decode("utf-8")
+    if codec == _ZSTD:
+        if zstandard is None:
+            raise RuntimeError("Stored message is zstd-compressed; install the zstandard package")
+        return zstandard.ZstdDecompressor().decompress(packed).decode("utf-8")
+    raise ValueError(f"Unknown compression codec {codec!r}")
+
+
+def is_compressed(value: Any) -> bool:
+    return isinstance(value, (bytes, memoryview)) and bytes(value[:len(MARKER)]) == MARKER
+
+
+class CompressedText(TypeDecorator):
+    """
+    TEXT column whose long values are stored compressed.
+
+    Relies on SQLite keeping BLOBs in a TEXT column as is; other databases
+    store plain text. SQL that reads the column directly (triggers, views,
+    LIKE filters) goes through the `decompress_text` SQL function.
+    """
+
+    impl = Text
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if dialect.name != "sqlite":
+            return value
+        return compress_text(value)
+
+    def process_result_value(self, value, dialect):
+        return decompress_text(value)
+
+
+class CompressedJSON(TypeDecorator):
+    """JSON column stored as text and compressed like CompressedText."""
+
+    impl = Text
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        text = json.dumps(value)
+        if dialect.name != "sqlite":
+            return text
+        return compress_text(text)
+
+    def process_result_value(self, value, dialect):
+        text = decompress_text(value)
+        if text is None:
+            return None
+        return json.loads(text)
+
+
+def uncompressed(value: Optional[str]):
+    """
+    Bind `value` to a CompressedText column as plain text.
+
+    Used for rows still being appended to with `content || delta`, which
+    only works while the stored value is text.
+    """
+    return type_coerce(value, Text)
+
+
+def register_sqlite_functions(dbapi_connection) -> None:
+    """Expose decompress_text(x) to SQL on a raw sqlite3 connection."""
+    dbapi_connection.create_function("decompress_text", 1, decompress_text, deterministic=True)
@@ -26,6 +26,98 @@ class Settings(BaseSettings):
 
     # Database
     database_url: str = "sqlite:///./chat_history.db"
+    # Threads running blocking database work off the event loop
+    db_executor_workers: int = 8
+    # Connection pool sizing (keep pool_size >= db_executor_workers)
+    db_pool_size: int = 10
+    db_max_overflow: int = 20
+    db_pool_timeout: float = 30.0
+    # Group commit of chat writes: writes queued within the window (plus any
+    # queued while the previous group commits) share one transaction
+    db_group_commit: bool = True
+    db_group_commit_window_ms: float = 2.0
+    db_group_commit_max_writes: int = 256
+    # SQLite pragmas applied to every new connection (ignored for other databases)
+    sqlite_journal_mode: str = "WAL"
+    sqlite_synchronous: str = "NORMAL"
+    sqlite_cache_size: int = -65536  # negative values are KiB, i.e. 64 MiB per connection
+    sqlite_mmap_size: int = 268435456
+    sqlite_busy_timeout_ms: int = 5000
+    sqlite_temp_store: str = "MEMORY"
+
+    # Streamed assistant messages are checkpointed to the database every N deltas
+    # (roughly one token each) or every T milliseconds, whichever comes first
+    stream_checkpoint_tokens: int = 32
+    stream_checkpoint_interval_ms: int = 1000
+
+    # Sessions whose prepared provider message list is kept in memory (LRU);
+    # 0 disables the cache
+    context_cache_sessions: int = 256
+    # Context assembly: window assumed when the provider does not report a
+    # model's context_length (0, the default, sends the full history), tokens
+    # kept free for the reply when the request has no max_tokens, and the
+    # fraction of the window held back because token counts are estimated
+    context_default_length: int = 0
+    context_reserved_output_tokens: int = 4096
+    context_safety_margin: float = 0.1
+    # Media of older turns: the newest N user turns (counting the request)
+    # keep their images, videos and audios; older media is sent as
+    # "thumbnail" (images downscaled to at most thumbnail_px per side, needs
+    # Pillow; other media becomes a placeholder), "placeholder" (a short note
+    # instead of the file) or "full". Overrides map "provider" or
+    # "provider/model" to a policy, e.g. {"deepseek": "placeholder"}
+    context_media_policy: str = "thumbnail"
+    context_media_full_turns: int = 4
+    context_media_thumbnail_px: int = 256
+    context_media_policy_overrides: dict = {}
+
+    # FTS5 tokenizer of the message search index, applied when the index is
+    # created ("trigram" matches substrings and suits CJK text better)
+    search_tokenizer: str = "unicode61 remove_diacritics 2"
+
+    # NDJSON export/import: rows fetched per database round trip while
+    # exporting, and records written per transaction while importing
+    export_batch_size: int = 500
+    import_batch_size: int = 500
+    # Messages removed per transaction when deleting sessions
+    delete_batch_size: int = 5000
+
+    # Compression of message content, reasoning and search results (SQLite):
+    # "auto" uses zstd when the zstandard package is installed and zlib
+    # otherwise; "zstd", "zlib" force a codec and "off" stores plain text.
+    # Values shorter than the threshold (in UTF-8 bytes) are stored as is
+    message_compression: str = "auto"
+    message_compression_min_bytes: int = 1024
+    # Rewrite existing rows compressed in the background at startup, this
+    # many messages per transaction
+    message_compression_backfill: bool = True
+    message_compression_batch_size: int = 200
+    # Move data: URIs stored in message media lists to uploads/ in the
+    # background at startup, this many messages per transaction (each row
+    # can hold megabytes of base64, so batches are small)
+    inline_media_backfill: bool = True
+    inline_media_batch_size: int = 20
+
+    # Resumable streams: events kept per generation for Last-Event-ID replay,
+    # how long an abandoned generation keeps running waiting for a reconnect,
+    # and how long a finished generation stays available for replay
+    stream_replay_buffer_events: int = 2048
+    stream_resume_grace_seconds: float = 30.0
+    stream_replay_ttl_seconds: float = 60.0
+    # What happens when the last subscriber of a generation leaves:
+    # "grace" (cancel after stream_resume_grace_seconds), "cancel" (immediately)
+    # or "complete" (always run to the end)
+    stream_orphan_policy: str = "grace"
+    # Backpressure between the upstream reader and SSE writers: the upstream
+    # read pauses once the slowest subscriber has this many unsent bytes
+    # buffered and resumes below the low watermark; subscribers that keep the
+    # stream paused for longer than the timeout are disconnected
+    stream_buffer_high_watermark: int = 262144
+    stream_buffer_low_watermark: int = 65536
+    stream_slow_subscriber_timeout_seconds: float = 30.0
+    # How long deleting, truncating or forking a session waits for its
+    # cancelled generations to save what they produced
+    stream_cancel_timeout_seconds: float = 5.0
 
     # DeepSeek API
     deepseek_api_key: Optional[str] = None
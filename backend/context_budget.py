@@ -0,0 +1,89 @@
+"""
+Token-budgeted assembly of the conversation sent to a provider
+"""
+import math
+from typing import Dict, List, Optional, Sequence, Tuple
+
+try:
+    from .config import settings
+except (ImportError, ValueError):
+    from config import settings
+
+
+# Fixed framing cost of one message (role markers, separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+# Rough cost of an attachment; providers bill media very differently, so this
+# only has to keep long multimodal histories from overflowing the window
+MEDIA_TOKENS = 768
+
+
+def estimate_tokens(text: Optional[str]) -> int:
+    """
+    Approximate token count of `text` without a model-specific tokenizer.
+
+    ASCII runs average about four characters per token; other scripts
+    (CJK in particular) are close to one token per character.
+    """
+    if not text:
+        return 0
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    return math.ceil(ascii_chars / 4) + (len(text) - ascii_chars)
+
+
+def message_tokens(content: Optional[str], *attachments: Optional[Sequence]) -> int:
+    """Estimated cost of a stored message: its text plus any attached media."""
+    media = sum(len(items) for items in attachments if isinstance(items, (list, tuple)))
+    return MESSAGE_OVERHEAD_TOKENS + estimate_tokens(content) + media * MEDIA_TOKENS
+
+
+def history_budget(context_length: Optional[int], max_tokens: Optional[int], fixed_tokens: int) -> Optional[int]:
+    """
+    Tokens available for stored history, or None when the window is unknown.
+
+    The window is reduced by the reply allowance (`max_tokens`, or
+    `context_reserved_output_tokens` when unset), a safety margin for the
+    approximate count, and `fixed_tokens` for what is always sent (system
+    prompt and the new messages).
+    """
+    context_length = context_length or settings.context_default_length
+    if not context_length or context_length <= 0:
+        return None
+    reserved = max_tokens or settings.context_reserved_output_tokens
+    usable = int(context_length * (1 - settings.context_safety_margin))
+    return max(0, usable - reserved - fixed_tokens)
+
+
+def fit_history(
+    history: List[Tuple[int, Dict]], budget: Optional[int]
+) -> Tuple[List[Dict], Dict[str, int]]:
+    """
+    Keep the newest (token_count, message) pairs of `history` that fit `budget`.
+
+    Returns the kept messages in order and a report of what was dropped.
+    """
+    total = sum(tokens for tokens, _ in history)
+    if budget is None or total <= budget:
+        return [message for _, message in history], {
+            "kept": len(history),
+            "dropped": 0,
+            "history_tokens": total,
+            "dropped_tokens": 0,
+        }
+
+    start = len(history)
+    used = 0
+    while start > 0 and used + history[start - 1][0] <= budget:
+        start -= 1
+        used += history[start][0]
+    # Do not open the trimmed history with an orphaned assistant reply
+    while start < len(history) and history[start][1].get("role") == "assistant":
+        used -= history[start][0]
+        start += 1
+
+    kept = history[start:]
+    return [message for _, message in kept], {
+        "kept": len(kept),
+        "dropped": start,
+        "history_tokens": used,
+        "dropped_tokens": total - used,
+    }
@@ -0,0 +1,146 @@
+"""
+Per-session cache of the provider-neutral conversation context
+"""
+import copy
+import itertools
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+try:
+    from .config import settings
+except (ImportError, ValueError):
+    from config import settings
+
+
+# (message id, estimated tokens, prepared api message) along the session's
+# active branch, root first; the message is {"role", "content", "thought_signatures"}
+_Entries = List[Tuple[int, int, Dict]]
+
+# Per session: whether the entries were built with thought signatures, and the entries
+_CACHE: "OrderedDict[int, Tuple[bool, _Entries]]" = OrderedDict()
+# Database work runs on executor threads, so every access takes the lock
+_LOCK = threading.Lock()
+
+# Stamp of each session's last cache change, cached or not, so a context
+# loaded before a change is not put over it (see context_version). Cleared
+# when it grows past the limit, which raises the floor for every session.
+_STAMPS = itertools.count(1)
+_CHANGED: Dict[int, int] = {}
+_CHANGED_LIMIT = 4096
+_floor = 0
+
+
+def _touch(session_id: int) -> None:
+    global _floor
+    if len(_CHANGED) >= _CHANGED_LIMIT:
+        _CHANGED.clear()
+        _floor = next(_STAMPS)
+    _CHANGED[session_id] = next(_STAMPS)
+
+
+def context_version(session_id: int) -> int:
+    """
+    Version of a session's cached context; take it before loading the
+    context from the database and pass it to put_context.
+    """
+    with _LOCK:
+        return max(_CHANGED.get(session_id, 0), _floor)
+
+
+def get_context(
+    session_id: int, signatures: bool = False, upto: Optional[int] = None
+) -> Optional[Tuple[Optional[int], List[Tuple[int, Dict]]]]:
+    """
+    Return (leaf message id, copy of the (token_count, message) history), or None on a miss.
+
+    The history ends at the active leaf, or at `upto` when given; a branch
+    point that is not on the cached branch is a miss. With `signatures`, a
+    context cached without thought signatures is a miss.
+    """
+    with _LOCK:
+        cached = _CACHE.get(session_id)
+        if cached is None or (signatures and not cached[0]):
+            return None
+        entries = cached[1]
+        if upto is not None:
+            ids = [entry[0] for entry in entries]
+            if upto not in ids:
+                return None
+            entries = entries[: ids.index(upto) + 1]
+        _CACHE.move_to_end(session_id)
+        leaf_id = entries[-1][0] if entries else None
+        # Providers may rewrite messages in place while building requests
+        return leaf_id, copy.deepcopy([(tokens, message) for _, tokens, message in entries])
+
+
+def put_context(
+    session_id: int,
+    messages: Iterable[Tuple[int, int, Dict]],
+    signatures: bool = False,
+    version: Optional[int] = None,
+) -> None:
+    """
+    Replace the cached context of a session with its active branch, root first.
+
+    `messages` are (message_id, token_count, message) triples; `signatures`
+    tells whether they were loaded with their thought signatures. With
+    `version` (from context_version before the load), nothing is cached if
+    the session's context changed since, as the load may predate the change.
+    """
+    if settings.context_cache_sessions <= 0:
+        return
+    entries = list(messages)
+    with _LOCK:
+        if version is not None and max(_CHANGED.get(session_id, 0), _floor) != version:
+            return
+        _touch(session_id)
+        _CACHE[session_id] = (signatures, entries)
+        _CACHE.move_to_end(session_id)
+        while len(_CACHE) > settings.context_cache_sessions:
+            _CACHE.popitem(last=False)
+
+
+def append_context(
+    session_id: int, message_id: int, tokens: int, message: Dict, *, parent_id: Optional[int]
+) -> None:
+    """
+    Add a newly persisted message, a child of `parent_id`, to a cached session.
+
+    The branch is cut after the parent first, so a regenerated reply
+    replaces the one it is an alternative to. A message whose parent is not
+    on the cached branch drops the session's cache.
+    """
+    with _LOCK:
+        _touch(session_id)
+        cached = _CACHE.get(session_id)
+        if cached is None:
+            return
+        entries = cached[1]
+        ids = [entry[0] for entry in entries]
+        if message_id in ids:
+            entries[ids.index(message_id)] = (message_id, tokens, message)
+            return
+        if parent_id is None:
+            keep = 0
+        elif parent_id in ids:
+            keep = ids.index(parent_id) + 1
+        else:
+            _CACHE.pop(session_id, None)
+            return
+        del entries[keep:]
+        entries.append((message_id, tokens, message))
+
+
+def invalidate_context(session_id: Optional[int] = None) -> None:
+    """Drop one session's cached context, or every session's when `session_id` is None."""
+    global _floor
+    with _LOCK:
+        if session_id is None:
+            _CACHE.clear()
+            _CHANGED.clear()
+            _floor = next(_STAMPS)
+        else:
+            _touch(session_id)
+            _CACHE.pop(session_id, None)
+
@@ -0,0 +1,152 @@
+"""
+Media of older turns in the conversation sent to a provider
+
+Images, videos and audios are re-read and re-encoded on every request, so in
+long multimodal sessions only the newest turns keep their media in full.
+Older media is sent as a downscaled thumbnail or replaced by a short note.
+"""
+import math
+import os
+from typing import Dict, List, Tuple
+
+try:
+    from .config import settings
+    from .context_budget import MEDIA_TOKENS, estimate_tokens
+    from .upload_store import UPLOAD_DIR, UPLOAD_REF, Image, make_thumbnail
+except (ImportError, ValueError):
+    from config import settings
+    from context_budget import MEDIA_TOKENS, estimate_tokens
+    from upload_store import UPLOAD_DIR, UPLOAD_REF, Image, make_thumbnail
+
+
+POLICIES = ("full", "thumbnail", "placeholder")
+
+_MEDIA_PARTS = {"image_url": "image", "video_url": "video", "audio_url": "audio"}
+
+
+def media_policy(provider_id: str, model_id: str) -> str:
+    """
+    Policy for the media of older turns: "full", "thumbnail" or "placeholder".
+
+    `CONTEXT_MEDIA_POLICY_OVERRIDES` entries for "provider/model" win over
+    entries for "provider", which win over `CONTEXT_MEDIA_POLICY`.
+    """
+    overrides = settings.context_media_policy_overrides or {}
+    policy = (
+        overrides.get(f"{provider_id}/{model_id}")
+        or overrides.get(provider_id)
+        or settings.context_media_policy
+    ).lower()
+    if policy not in POLICIES:
+        return "full"
+    if policy == "thumbnail" and Image is None:
+        return "placeholder"
+    return policy
+
+
+def elided_count(history: List[Tuple[int, Dict]], current_turns: int) -> int:
+    """
+    Number of leading `history` messages whose media is elided.
+
+    The newest `CONTEXT_MEDIA_FULL_TURNS` user turns keep their media;
+    `current_turns` of them are the user messages of the request itself.
+    """
+    keep = settings.context_media_full_turns - current_turns
+    if keep <= 0:
+        return len(history)
+    seen = 0
+    for index in range(len(history) - 1, -1, -1):
+        if history[index][1].get("role") == "user":
+            seen += 1
+            if seen == keep:
+                return index
+    return 0
+
+
+def has_media(history: List[Tuple[int, Dict]]) -> bool:
+    """True if any message of `history` has media parts."""
+    return any(isinstance(entry.get("content"), list) for _, entry in history)
+
+
+def media_report(policy: str) -> Dict:
+    """Counters of what the policy changed, reported in the `context` event."""
+    return {"media_policy": policy, "media_thumbnails": 0, "media_placeholders": 0, "media_bytes_saved": 0}
+
+
+def _payload_bytes(url: str) -> int:
+    """Base64 bytes a provider request carries for the media at `url`."""
+    if url.startswith("data:"):
+        return len(url) - url.find(",") - 1
+    match = UPLOAD_REF.fullmatch(url)
+    if not match:
+        # Remote URLs are fetched by the provider
+        return 0
+    try:
+        size = os.path.getsize(os.path.join(UPLOAD_DIR, match.group(1)))
+    except OSError:
+        return 0
+    return 4 * math.ceil(size / 3)
+
+
+def _elide_entry(entry: Dict, policy: str, report: Dict) -> Tuple[Dict, int]:
+    """Copy of `entry` with its media elided, and the tokens saved."""
+    text_parts: List[str] = []
+    parts: List[Dict] = []
+    notes: List[str] = []
+    for part in entry["content"]:
+        kind = part.get("type")
+        if kind == "text":
+            text_parts.append(part.get("text") or "")
+            parts.append(part)
+            continue
+        if kind not in _MEDIA_PARTS:
+            parts.append(part)
+            continue
+        url = (part.get(kind) or {}).get("url") or ""
+        saved = _payload_bytes(url)
+        if policy == "thumbnail" and kind == "image_url":
+            match = UPLOAD_REF.fullmatch(url)
+            thumb = make_thumbnail(match.group(1), settings.context_media_thumbnail_px) if match else None
+            if thumb is not None:
+                parts.append({**part, "image_url": {"url": thumb}})
+                report["media_thumbnails"] += 1
+                report["media_bytes_saved"] += max(0, saved - _payload_bytes(thumb))
+                continue
+        note = f"[{_MEDIA_PARTS[kind]} from an earlier turn omitted]"
+        notes.append(note)
+        parts.append({"type": "text", "text": note})
+        report["media_placeholders"] += 1
+        report["media_bytes_saved"] += saved
+
+    tokens_saved = 0
+    if notes:
+        tokens_saved = len(notes) * MEDIA_TOKENS - sum(estimate_tokens(note) for note in notes)
+    if len(parts) == len(text_parts) + len(notes):
+        # Text only now: send a plain string, which every provider accepts
+        content = "\n\n".join(text for text in text_parts + notes if text)
+    else:
+        content = parts
+    return {**entry, "content": content}, tokens_saved
+
+
+def elide_history_media(
+    history: List[Tuple[int, Dict]], count: int, policy: str
+) -> Tuple[List[Tuple[int, Dict]], Dict[str, int]]:
+    """
+    Apply `policy` to the media of the first `count` (token_count, message)
+    pairs of `history`.
+
+    Messages are copied, never changed in place, since the history may come
+    from the context cache. Token counts shrink by the elided attachments.
+    Creating thumbnails reads and writes files, so call this off the event loop.
+    """
+    report = media_report(policy)
+    if policy == "full":
+        return history, report
+    elided = []
+    for index, (tokens, entry) in enumerate(history):
+        if index < count and isinstance(entry.get("content"), list):
+            entry, tokens_saved = _elide_entry(entry, policy, report)
+            tokens = max(0, tokens - tokens_saved)
+        elided.append((tokens, entry))
+    return elided, report
@@ -1,21 +1,173 @@
 """
 Database models and setup
 """
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, ForeignKey, JSON
+import asyncio
+import re
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, TypeVar
+
+from sqlalchemy import create_engine, event, Column, Index, Integer, String, Text, DateTime, ForeignKey, JSON
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import deferred, sessionmaker, relationship
+from sqlalchemy.pool import QueuePool
 from datetime import datetime, timezone
+from compression import CompressedJSON, CompressedText, register_sqlite_functions
 from config import settings
 
+
+def _is_sqlite(url: str) -> bool:
+    return url.startswith("sqlite")
+
+
+def _is_sqlite_memory(url: str) -> bool:
+    return url in ("sqlite://", "sqlite:///:memory:") or "mode=memory" in url
+
+
+def _engine_kwargs(url: str) -> dict:
+    if not _is_sqlite(url):
+        return {
+            "pool_size": settings.db_pool_size,
+            "max_overflow": settings.db_max_overflow,
+            "pool_timeout": settings.db_pool_timeout,
+        }
+
+    kwargs = {
+        "connect_args": {
+            "check_same_thread": False,  # Needed for SQLite
+            "timeout": settings.sqlite_busy_timeout_ms / 1000,
+        }
+    }
+    if not _is_sqlite_memory(url):
+        # File databases get a real QueuePool sized for concurrent streams
+        kwargs.update(
+            pool_size=settings.db_pool_size,
+            max_overflow=settings.db_max_overflow,
+            pool_timeout=settings.db_pool_timeout,
+        )
+    return kwargs
+
+
 # Create database engine
-engine = create_engine(
-    settings.database_url,
-    connect_args={"check_same_thread": False}  # Needed for SQLite
-)
+engine = create_engine(settings.database_url, **_engine_kwargs(settings.database_url))
+
+
+if _is_sqlite(settings.database_url):
+
+    @event.listens_for(engine, "connect")
+    def _apply_sqlite_pragmas(dbapi_connection, connection_record):
+        """Apply the configured SQLite profile to every new connection."""
+        # Triggers and the search view read compressed columns through it
+        register_sqlite_functions(dbapi_connection)
+        cursor = dbapi_connection.cursor()
+        try:
+            if not _is_sqlite_memory(settings.database_url):
+                cursor.execute(f"PRAGMA journal_mode={settings.sqlite_journal_mode}")
+                cursor.execute(f"PRAGMA mmap_size={int(settings.sqlite_mmap_size)}")
+            cursor.execute(f"PRAGMA synchronous={settings.sqlite_synchronous}")
+            cursor.execute(f"PRAGMA cache_size={int(settings.sqlite_cache_size)}")
+            cursor.execute(f"PRAGMA busy_timeout={int(settings.sqlite_busy_timeout_ms)}")
+            cursor.execute(f"PRAGMA temp_store={settings.sqlite_temp_store}")
+            # Enforce ON DELETE CASCADE; SQLite leaves foreign keys off by default
+            cursor.execute("PRAGMA foreign_keys=ON")
+        finally:
+            cursor.close()
+
+
+class _PoolUsage:
+    """Checkout counts and hold times of pooled connections, for pool_stats()."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checked_out = 0
+        self.peak_checked_out = 0
+        self.checkouts = 0
+        self.hold_seconds = 0.0
+        self.max_hold_seconds = 0.0
+
+    def checkout(self, connection_record) -> None:
+        connection_record.info["checked_out_at"] = time.monotonic()
+        with self._lock:
+            self.checked_out += 1
+            self.checkouts += 1
+            self.peak_checked_out = max(self.peak_checked_out, self.checked_out)
+
+    def checkin(self, connection_record) -> None:
+        started = connection_record.info.pop("checked_out_at", None)
+        if started is None:
+            return
+        held = time.monotonic() - started
+        with self._lock:
+            self.checked_out -= 1
+            self.hold_seconds += held
+            self.max_hold_seconds = max(self.max_hold_seconds, held)
+
+
+_pool_usage = _PoolUsage()
+# Records checked out right now, to report the longest current hold
+_checked_out_records: "weakref.WeakSet" = weakref.WeakSet()
+
+
+@event.listens_for(engine, "checkout")
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    _pool_usage.checkout(connection_record)
+    _checked_out_records.add(connection_record)
+
+
+@event.listens_for(engine, "checkin")
+def _on_checkin(dbapi_connection, connection_record):
+    _checked_out_records.discard(connection_record)
+    _pool_usage.checkin(connection_record)
+
+
+def pool_stats() -> dict:
+    """
+    Connection pool usage.
+
+    Every request and stream borrows a connection only for the duration of
+    one run_db/write_db call, so `checked_out` stays at or below the
+    executor's worker count however many streams are running; a large
+    `longest_checkout_ms` points at code holding a session across awaits.
+    """
+    pool = engine.pool
+    now = time.monotonic()
+    held = [
+        now - record.info["checked_out_at"]
+        for record in list(_checked_out_records)
+        if "checked_out_at" in record.info
+    ]
+    usage = _pool_usage
+    stats = {
+        "pool": type(pool).__name__,
+        "checked_out": usage.checked_out,
+        "peak_checked_out": usage.peak_checked_out,
+        "checkouts": usage.checkouts,
+        "avg_checkout_ms": round(usage.hold_seconds * 1000 / usage.checkouts, 3)
+        if usage.checkouts
+        else 0,
+        "max_checkout_ms": round(usage.max_hold_seconds * 1000, 3),
+        "longest_checkout_ms": round(max(held) * 1000, 3) if held else 0,
+        "executor_workers": settings.db_executor_workers,
+    }
+    if isinstance(pool, QueuePool):
+        stats.update(
+            {
+                "size": pool.size(),
+                "idle": pool.checkedin(),
+                "overflow": max(pool.overflow(), 0),
+                "max_overflow": settings.db_max_overflow,
+            }
+        )
+    return stats
+
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
+T = TypeVar("T")
+
 
 class ChatSession(Base):
     """Chat session model"""
@@ -27,9 +179,19 @@ class ChatSession(Base):
     model = Column(String(100), nullable=False)
     created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
     updated_at = Column(DateTime, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
+    # Last message of the branch being continued; new messages become its children
+    active_leaf_id = Column(Integer, nullable=True)
     
     # Relationship to messages
-    messages = relationship("ChatMessage", back_populates="session", cascade="all, delete-orphan")
+    # The database cascades deletes; passive_deletes keeps the ORM from loading messages first
+    messages = relationship(
+        "ChatMessage", back_populates="session", cascade="all, delete-orphan", passive_deletes=True
+    )
+
+    __table_args__ = (
+        # Keyset pagination of the session list
+        Index("ix_chat_sessions_updated_at_id", "updated_at", "id"),
+    )
 
 
 class ChatMessage(Base):
@@ -37,22 +199,272 @@ class ChatMessage(Base):
     __tablename__ = "chat_messages"
     
     id = Column(Integer, primary_key=True, index=True)
-    session_id = Column(Integer, ForeignKey("chat_sessions.id"), nullable=False)
+    session_id = Column(Integer, ForeignKey("chat_sessions.id", ondelete="CASCADE"), nullable=False)
     role = Column(String(20), nullable=False)  # 'user', 'assistant', 'system'
-    content = Column(Text, nullable=False)
+    # Previous message of the branch (None for a first message). Edits and
+    # regenerations add siblings instead of replacing rows. No foreign key:
+    # messages only go away with their whole subtree or session
+    parent_id = Column(Integer, nullable=True)
+    content = Column(CompressedText, nullable=False)
     images = Column(JSON, nullable=True)  # List of image URLs/paths
     videos = Column(JSON, nullable=True)  # List of video URLs/paths
     audios = Column(JSON, nullable=True)  # List of audio URLs/paths
-    thought_process = Column(Text, nullable=True)  # For reasoning/thinking content from inference models
-    thought_signatures = Column(JSON, nullable=True)
-    search_results = Column(JSON, nullable=True)
+    # Bulky columns load only when asked for (undefer_group); chat history
+    # never needs them except Gemini's signatures
+    thought_process = deferred(Column(CompressedText, nullable=True), group="details")  # For reasoning/thinking content from inference models
+    thought_signatures = deferred(Column(JSON, nullable=True), group="signatures")
+    # Legacy inline copy; new search results live in message_sources
+    search_results = deferred(Column(CompressedJSON, nullable=True), group="details")
     provider = Column(String(50), nullable=True)
     model = Column(String(100), nullable=True)
+    status = Column(String(20), nullable=True, default="complete")  # 'complete', 'partial', 'aborted'
+    token_count = Column(Integer, nullable=True)  # Estimated prompt tokens, filled lazily when NULL
     created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
     
     # Relationship to session
     session = relationship("ChatSession", back_populates="messages")
 
+    __table_args__ = (
+        # Ordered history of one session; also covers per-session counts
+        Index("ix_chat_messages_session_created_id", "session_id", "created_at", "id"),
+        # Children of a message, for branch navigation and subtree deletes
+        Index("ix_chat_messages_parent_id", "parent_id"),
+        # Ids of deleted messages are never handed out again, so a late write
+        # addressed to a deleted message cannot land on a newer one
+        {"sqlite_autoincrement": True},
+    )
+
+
+class SearchSource(Base):
+    """A search result source, stored once however many messages cite it"""
+    __tablename__ = "search_sources"
+
+    id = Column(Integer, primary_key=True)
+    url = Column(Text, nullable=False, unique=True)
+    title = Column(Text, nullable=True)
+
+
+class MessageSource(Base):
+    """One search result of a message, in display order"""
+    __tablename__ = "message_sources"
+
+    message_id = Column(
+        Integer, ForeignKey("chat_messages.id", ondelete="CASCADE"), primary_key=True
+    )
+    position = Column(Integer, primary_key=True)
+    source_id = Column(Integer, ForeignKey("search_sources.id"), nullable=False)
+    title = Column(Text, nullable=True)  # Only when it differs from the source's title
+    content = Column(CompressedText, nullable=True)  # Snippet quoted for this message
+
+
+def _rebuild_messages_table(conn, new_sql: str) -> None:
+    """
+    Replace chat_messages by a table created from `new_sql`, its own DDL
+    changed, keeping its rows, indexes, triggers and the view over it.
+
+    SQLite cannot alter constraints in place, so the rows are copied into a
+    new table which then takes the old one's name.
+    """
+    new_sql = re.sub(r'^CREATE TABLE\s+"?chat_messages"?', "CREATE TABLE chat_messages_new", new_sql)
+    dependents = [
+        row[0]
+        for row in conn.exec_driver_sql(
+            "SELECT sql FROM sqlite_master WHERE tbl_name = 'chat_messages' "
+            "AND type IN ('index', 'trigger') AND sql IS NOT NULL"
+        )
+    ]
+    # The rename fails while a view names the missing table
+    views = list(
+        conn.exec_driver_sql(
+            "SELECT name, sql FROM sqlite_master WHERE type = 'view' AND name = 'chat_messages_plain'"
+        )
+    )
+    for name, _ in views:
+        conn.exec_driver_sql(f"DROP VIEW {name}")
+    # Dropping a table deletes its rows first, which cascades to their sources
+    conn.exec_driver_sql("CREATE TEMP TABLE message_sources_saved AS SELECT * FROM message_sources")
+
+    conn.exec_driver_sql(new_sql)
+    conn.exec_driver_sql("INSERT INTO chat_messages_new SELECT * FROM chat_messages")
+    conn.exec_driver_sql("DROP TABLE chat_messages")
+    conn.exec_driver_sql("ALTER TABLE chat_messages_new RENAME TO chat_messages")
+    for _, statement in views:
+        conn.exec_driver_sql(statement)
+    for statement in dependents:
+        conn.exec_driver_sql(statement)
+
+    conn.exec_driver_sql("INSERT INTO message_sources SELECT * FROM message_sources_saved")
+    conn.exec_driver_sql("DROP TABLE message_sources_saved")
+
+
+def _cascade_message_deletes(conn) -> None:
+    """Rebuild chat_messages with an ON DELETE CASCADE foreign key."""
+    table_sql = conn.exec_driver_sql(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'chat_messages'"
+    ).scalar()
+    if "ON DELETE CASCADE" in table_sql.upper():
+        return
+    new_sql, replaced = re.subn(
+        r'REFERENCES\s+"?chat_sessions"?\s*\(\s*"?id"?\s*\)',
+        "REFERENCES chat_sessions (id) ON DELETE CASCADE",
+        table_sql,
+        flags=re.IGNORECASE,
+    )
+    if replaced != 1:
+        raise RuntimeError("Unexpected chat_messages schema; cannot add ON DELETE CASCADE")
+    # Messages of long-deleted sessions would violate the new constraint
+    conn.exec_driver_sql(
+        "DELETE FROM chat_messages WHERE session_id NOT IN (SELECT id FROM chat_sessions)"
+    )
+    _rebuild_messages_table(conn, new_sql)
+
+
+def _autoincrement_message_ids(conn) -> None:
+    """Rebuild chat_messages with an AUTOINCREMENT key, so deleted ids are not reused."""
+    table_sql = conn.exec_driver_sql(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'chat_messages'"
+    ).scalar()
+    if "AUTOINCREMENT" in table_sql.upper():
+        return
+    # Either a column constraint (early schemas) or a table constraint
+    new_sql, replaced = re.subn(
+        r'("?id"?\s+INTEGER\s+(?:NOT\s+NULL\s+)?PRIMARY\s+KEY)\b',
+        r"\1 AUTOINCREMENT",
+        table_sql,
+        count=1,
+        flags=re.IGNORECASE,
+    )
+    if not replaced:
+        new_sql, column = re.subn(
+            r'"?id"?\s+INTEGER\s+NOT\s+NULL\s*,',
+            "id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,",
+            table_sql,
+            count=1,
+            flags=re.IGNORECASE,
+        )
+        new_sql, key = re.subn(
+            r',\s*PRIMARY\s+KEY\s*\(\s*"?id"?\s*\)', "", new_sql, flags=re.IGNORECASE
+        )
+        if column != 1 or key != 1:
+            raise RuntimeError("Unexpected chat_messages schema; cannot add AUTOINCREMENT")
+    _rebuild_messages_table(conn, new_sql)
+
+
+# Versioned schema steps for existing databases, tracked in PRAGMA user_version.
+# Step N runs once when the stored version is below N; append, never reorder.
+# A step is a tuple of SQL statements or a callable taking the connection.
+_SCHEMA_MIGRATIONS = [
+    # 1: composite indexes for keyset pagination
+    (
+        "CREATE INDEX IF NOT EXISTS ix_chat_sessions_updated_at_id "
+        "ON chat_sessions (updated_at, id)",
+        "CREATE INDEX IF NOT EXISTS ix_chat_messages_session_created_id "
+        "ON chat_messages (session_id, created_at, id)",
+    ),
+    # 2: full-text index over message content and reasoning. External content
+    # table kept in sync by triggers; rows still streaming ('partial') are
+    # left out so checkpoint appends do not re-index the message every batch
+    (
+        "CREATE VIRTUAL TABLE IF NOT EXISTS chat_messages_fts USING fts5("
+        "content, thought_process, content='chat_messages', content_rowid='id', "
+        f"tokenize='{settings.search_tokenizer}')",
+        "CREATE TRIGGER IF NOT EXISTS chat_messages_fts_insert "
+        "AFTER INSERT ON chat_messages WHEN new.status IS NOT 'partial' BEGIN "
+        "INSERT INTO chat_messages_fts(rowid, content, thought_process) "
+        "VALUES (new.id, new.content, new.thought_process); END",
+        "CREATE TRIGGER IF NOT EXISTS chat_messages_fts_delete "
+        "AFTER DELETE ON chat_messages WHEN old.status IS NOT 'partial' BEGIN "
+        "INSERT INTO chat_messages_fts(chat_messages_fts, rowid, content, thought_process) "
+        "VALUES ('delete', old.id, old.content, old.thought_process); END",
+        "CREATE TRIGGER IF NOT EXISTS chat_messages_fts_update_old "
+        "AFTER UPDATE OF content, thought_process, status ON chat_messages "
+        "WHEN old.status IS NOT 'partial' BEGIN "
+        "INSERT INTO chat_messages_fts(chat_messages_fts, rowid, content, thought_process) "
+        "VALUES ('delete', old.id, old.content, old.thought_process); END",
+        "CREATE TRIGGER IF NOT EXISTS chat_messages_fts_update_new "
+        "AFTER UPDATE OF content, thought_process, status ON chat_messages "
+        "WHEN new.status IS NOT 'partial' BEGIN "
+        "INSERT INTO chat_messages_fts(rowid, content, thought_process) "
+        "VALUES (new.id, new.content, new.thought_process); END",
+        # Backfill existing history
+        "INSERT INTO chat_messages_fts(rowid, content, thought_process) "
+        "SELECT id, content, thought_process FROM chat_messages WHERE status IS NOT 'partial'",
+    ),
+    # 3: ON DELETE CASCADE from chat_messages to chat_sessions
+    _cascade_message_deletes,
+    # 4: compressed columns. The full-text index reads its external content
+    # through a view that decompresses, and the triggers index plain text;
+    # the index is rebuilt once against the view.
+    # decompress_text() is not built into SQLite: connections that do not
+    # register it (compression.register_sqlite_functions), such as the
+    # sqlite3 shell, fail on any write that fires these triggers, including
+    # session deletes cascading to messages
+    (
+        "DROP TRIGGER IF EXISTS chat_messages_fts_insert",
+        "DROP TRIGGER IF EXISTS chat_messages_fts_delete",
+        "DROP TRIGGER IF EXISTS chat_messages_fts_update_old",
+        "DROP TRIGGER IF EXISTS chat_messages_fts_update_new",
+        "DROP TABLE IF EXISTS chat_messages_fts",
+        "CREATE VIEW IF NOT EXISTS chat_messages_plain AS "
+        "SELECT id, decompress_text(content) AS content, "
+        "decompress_text(thought_process) AS thought_process, status FROM chat_messages",
+        "CREATE VIRTUAL TABLE chat_messages_fts USING fts5("
+        "content, thought_process, content='chat_messages_plain', content_rowid='id', "
+        f"tokenize='{settings.search_tokenizer}')",
+        "CREATE TRIGGER chat_messages_fts_insert "
+        "AFTER INSERT ON chat_messages WHEN new.status IS NOT 'partial' BEGIN "
+        "INSERT INTO chat_messages_fts(rowid, content, thought_process) "
+        "VALUES (new.id, decompress_text(new.content), decompress_text(new.thought_process)); END",
+        "CREATE TRIGGER chat_messages_fts_delete "
+        "AFTER DELETE ON chat_messages WHEN old.status IS NOT 'partial' BEGIN "
+        "INSERT INTO chat_messages_fts(chat_messages_fts, rowid, content, thought_process) "
+        "VALUES ('delete', old.id, decompress_text(old.content), "
+        "decompress_text(old.thought_process)); END",
+        # One trigger so the old row is removed before the new one is added;
+        # SQLite runs separate triggers in reverse creation order
+        "CREATE TRIGGER chat_messages_fts_update "
+        "AFTER UPDATE OF content, thought_process, status ON chat_messages BEGIN "
+        "INSERT INTO chat_messages_fts(chat_messages_fts, rowid, content, thought_process) "
+        "SELECT 'delete', old.id, decompress_text(old.content), "
+        "decompress_text(old.thought_process) WHERE old.status IS NOT 'partial'; "
+        "INSERT INTO chat_messages_fts(rowid, content, thought_process) "
+        "SELECT new.id, decompress_text(new.content), decompress_text(new.thought_process) "
+        "WHERE new.status IS NOT 'partial'; END",
+        "INSERT INTO chat_messages_fts(rowid, content, thought_process) "
+        "SELECT id, content, thought_process FROM chat_messages_plain WHERE status IS NOT 'partial'",
+    ),
+    # 5: message trees. Existing sessions become a single branch in their
+    # (created_at, id) order, continued from their newest message
+    (
+        "CREATE INDEX IF NOT EXISTS ix_chat_messages_parent_id ON chat_messages (parent_id)",
+        "UPDATE chat_messages SET parent_id = ordered.previous_id FROM ("
+        "SELECT id, LAG(id) OVER (PARTITION BY session_id ORDER BY created_at, id) AS previous_id "
+        "FROM chat_messages) AS ordered "
+        "WHERE ordered.id = chat_messages.id AND chat_messages.parent_id IS NULL",
+        "UPDATE chat_sessions SET active_leaf_id = ("
+        "SELECT id FROM chat_messages WHERE chat_messages.session_id = chat_sessions.id "
+        "ORDER BY created_at DESC, id DESC LIMIT 1) WHERE active_leaf_id IS NULL",
+    ),
+    # 6: message ids are never reused (a reply still streaming when its
+    # branch is deleted must not write into a newer message)
+    _autoincrement_message_ids,
+]
+
+
+def _apply_schema_migrations() -> None:
+    with engine.begin() as conn:
+        version = conn.exec_driver_sql("PRAGMA user_version").scalar() or 0
+        for target, step in enumerate(_SCHEMA_MIGRATIONS, start=1):
+            if version >= target:
+                continue
+            if callable(step):
+                step(conn)
+            else:
+                for statement in step:
+                    conn.exec_driver_sql(statement)
+            conn.exec_driver_sql(f"PRAGMA user_version = {target}")
+            print(f"[database] applied schema migration {target}")
+
 
 def init_db():
     """Initialize database tables"""
@@ -74,12 +486,42 @@ def init_db():
             conn.exec_driver_sql("ALTER TABLE chat_messages ADD COLUMN images TEXT")
         if "search_results" not in existing_cols:
             conn.exec_driver_sql("ALTER TABLE chat_messages ADD COLUMN search_results TEXT")
+        if "status" not in existing_cols:
+            conn.exec_driver_sql("ALTER TABLE chat_messages ADD COLUMN status VARCHAR(20) DEFAULT 'complete'")
+        if "token_count" not in existing_cols:
+            conn.exec_driver_sql("ALTER TABLE chat_messages ADD COLUMN token_count INTEGER")
+        if "parent_id" not in existing_cols:
+            conn.exec_driver_sql("ALTER TABLE chat_messages ADD COLUMN parent_id INTEGER")
+
+        result = conn.exec_driver_sql("PRAGMA table_info(chat_sessions)")
+        session_cols = {row[1] for row in result.fetchall()}
+        if "active_leaf_id" not in session_cols:
+            conn.exec_driver_sql("ALTER TABLE chat_sessions ADD COLUMN active_leaf_id INTEGER")
+
+    if _is_sqlite(settings.database_url):
+        _apply_schema_migrations()
+
+
+_db_executor = ThreadPoolExecutor(
+    max_workers=settings.db_executor_workers, thread_name_prefix="db"
+)
+
+
+async def run_db(fn: Callable[..., T], *args, **kwargs) -> T:
+    """
+    Run `fn(db, *args, **kwargs)` on the database executor with a short-lived session.
+
+    Keeps SQLite I/O off the event loop so queries and commits do not stall
+    in-flight streams. `fn` should return plain data (or Pydantic models)
+    rather than ORM instances, since the session is closed afterwards.
+    """
 
+    def _call():
+        db = SessionLocal()
+        try:
+            return fn(db, *args, **kwargs)
+        finally:
+            db.close()
 
-def get_db():
-    """Dependency to get database session"""
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_db_executor, _call)
@@ -0,0 +1,190 @@
+"""
+Group commit of small writes from concurrent requests
+"""
+import asyncio
+import time
+from typing import Any, Callable, Dict, List, Optional, TypeVar
+
+from sqlalchemy.orm import Session
+
+try:
+    from .config import settings
+    from .database import run_db
+except (ImportError, ValueError):
+    from config import settings
+    from database import run_db
+
+
+T = TypeVar("T")
+
+
+class _Write:
+    __slots__ = ("fn", "args", "kwargs", "future", "submitted")
+
+    def __init__(self, fn, args, kwargs, future, submitted):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.future = future
+        self.submitted = submitted
+
+
+class GroupCommitWriter:
+    """
+    Single writer task that commits queued writes in groups.
+
+    Writes submitted within `db_group_commit_window_ms` of each other (and
+    any queued while the previous group was committing) run in one
+    transaction, so concurrent streams share one SQLite write lock and one
+    fsync instead of taking turns. If a group fails, its writes are retried
+    one transaction each so only the failing write reports an error.
+    """
+
+    def __init__(self):
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._started = time.monotonic()
+        self._submitted = 0
+        self._committed = 0
+        self._failed = 0
+        self._groups = 0
+        self._retried_groups = 0
+        self._largest_group = 0
+        self._commit_seconds = 0.0
+        self._latency_seconds = 0.0
+        self._max_latency_seconds = 0.0
+
+    async def submit(self, fn: Callable[..., T], *args, **kwargs) -> T:
+        """
+        Queue `fn(db, *args, **kwargs)` and wait until its group is committed.
+
+        `fn` must not commit or roll back, and may run again after a failed
+        group, so it should only touch the database. Its return value is
+        passed back once the rows are durable.
+        """
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._loop is not loop:
+            self._queue = asyncio.Queue()
+            self._loop = loop
+            self._task = loop.create_task(self._run())
+        future = loop.create_future()
+        self._queue.put_nowait(_Write(fn, args, kwargs, future, time.monotonic()))
+        self._submitted += 1
+        return await future
+
+    async def close(self) -> None:
+        """Commit what is queued and stop the writer task."""
+        if self._task is None or self._task.done():
+            return
+        self._queue.put_nowait(None)
+        await self._task
+
+    async def _run(self) -> None:
+        window = settings.db_group_commit_window_ms / 1000
+        limit = max(1, settings.db_group_commit_max_writes)
+        while True:
+            first = await self._queue.get()
+            if first is None:
+                return
+            if window > 0:
+                await asyncio.sleep(window)
+            group = [first]
+            stop = False
+            while len(group) < limit and not self._queue.empty():
+                write = self._queue.get_nowait()
+                if write is None:
+                    stop = True
+                    break
+                group.append(write)
+            await self._commit(group)
+            if stop:
+                return
+
+    async def _commit(self, group: List[_Write]) -> None:
+        started = time.monotonic()
+        try:
+            outcomes, retried = await run_db(_execute_group, group)
+        except Exception as e:
+            outcomes, retried = [(False, e)] * len(group), False
+        finished = time.monotonic()
+
+        self._groups += 1
+        self._retried_groups += int(retried)
+        self._largest_group = max(self._largest_group, len(group))
+        self._commit_seconds += finished - started
+        for write, (ok, value) in zip(group, outcomes):
+            latency = finished - write.submitted
+            self._latency_seconds += latency
+            self._max_latency_seconds = max(self._max_latency_seconds, latency)
+            if ok:
+                self._committed += 1
+            else:
+                self._failed += 1
+            if write.future.done():
+                continue
+            if ok:
+                write.future.set_result(value)
+            else:
+                write.future.set_exception(value)
+
+    def stats(self) -> Dict[str, Any]:
+        done = self._committed + self._failed
+        elapsed = max(time.monotonic() - self._started, 1e-9)
+        return {
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "submitted": self._submitted,
+            "committed": self._committed,
+            "failed": self._failed,
+            "groups": self._groups,
+            "retried_groups": self._retried_groups,
+            "avg_group_size": round(done / self._groups, 2) if self._groups else 0,
+            "largest_group": self._largest_group,
+            "commits_per_second": round(self._groups / elapsed, 2),
+            "writes_per_second": round(self._committed / elapsed, 2),
+            "avg_commit_ms": round(self._commit_seconds * 1000 / self._groups, 3) if self._groups else 0,
+            "avg_latency_ms": round(self._latency_seconds * 1000 / done, 3) if done else 0,
+            "max_latency_ms": round(self._max_latency_seconds * 1000, 3),
+        }
+
+
+def _execute_group(db: Session, group: List[_Write]):
+    """Run a group in one transaction; on failure, retry each write on its own."""
+    if len(group) > 1:
+        try:
+            results = [write.fn(db, *write.args, **write.kwargs) for write in group]
+            db.commit()
+            return [(True, result) for result in results], False
+        except Exception:
+            db.rollback()
+
+    outcomes = []
+    for write in group:
+        try:
+            result = write.fn(db, *write.args, **write.kwargs)
+            db.commit()
+            outcomes.append((True, result))
+        except Exception as e:
+            db.rollback()
+            outcomes.append((False, e))
+    return outcomes, len(group) > 1
+
+
+writer = GroupCommitWriter()
+
+
+async def write_db(fn: Callable[..., T], *args, **kwargs) -> T:
+    """
+    Run the write `fn(db, *args, **kwargs)` and return its result once committed.
+
+    With DB_GROUP_COMMIT off, each write commits in its own transaction.
+    """
+    if not settings.db_group_commit:
+        return await run_db(_commit_one, fn, args, kwargs)
+    return await writer.submit(fn, *args, **kwargs)
+
+
+def _commit_one(db: Session, fn: Callable, args, kwargs):
+    result = fn(db, *args, **kwargs)
+    db.commit()
+    return result
@@ -0,0 +1,372 @@
+import asyncio
+import itertools
+import json
+import time
+import uuid
+from collections import deque
+from typing import (
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+
+try:
+    from .config import settings
+except (ImportError, ValueError):
+    from config import settings
+
+
+class ReplayGapError(Exception):
+    """Raised when the requested events are no longer in the replay buffer."""
+
+
+class _Subscriber:
+    def __init__(self, cursor: int):
+        self.cursor = cursor
+        self.evicted = False
+
+
+class Generation:
+    """
+    A streamed assistant reply running as a server-side task.
+
+    Every event gets a monotonically increasing id and is kept in a bounded
+    ring buffer. Any number of subscribers (the original request, a resumed
+    connection, a second tab) read it with their own cursor, and the upstream
+    call outlives them according to `stream_orphan_policy`.
+
+    The buffer doubles as the queue between the upstream reader and the SSE
+    writers: once the slowest subscriber has `stream_buffer_high_watermark`
+    unsent bytes, `publish` blocks (and with it the upstream read) until it
+    drains below `stream_buffer_low_watermark`.
+    """
+
+    def __init__(
+        self, generation_id: str, session_id: Optional[int], started_at: Optional[float] = None
+    ):
+        self.id = generation_id
+        # None until the incoming messages of a new chat are stored (bind_session)
+        self.session_id = session_id
+        # Message the reply answers, known once the incoming messages are stored
+        self.parent_id: Optional[int] = None
+        self.message_id: Optional[int] = None
+        # Monotonic time the chat request arrived and the time to its first token
+        self.started_at = started_at if started_at is not None else time.monotonic()
+        self.ttft_ms: Optional[float] = None
+        self.done = False
+        self.paused = False
+        self.task: Optional[asyncio.Task] = None
+        # (event id, data, byte offset of the event within the stream)
+        self._events: Deque[Tuple[int, str, int]] = deque()
+        self._next_id = 1
+        self._total_bytes = 0
+        # The request that starts a generation is subscribed from the outset so
+        # backpressure applies before its response begins streaming
+        self._initial = _Subscriber(0)
+        self._subscribers: Set[_Subscriber] = {self._initial}
+        self._changed = asyncio.Condition()
+        self._orphan_handle: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def last_event_id(self) -> int:
+        return self._next_id - 1
+
+    @property
+    def subscribers(self) -> int:
+        return len(self._subscribers)
+
+    @property
+    def buffered_bytes(self) -> int:
+        """Bytes published but not yet sent to the slowest subscriber."""
+        if not self._subscribers:
+            return 0
+        return self._total_bytes - self._offset_after(min(sub.cursor for sub in self._subscribers))
+
+    def _first_buffered_id(self) -> int:
+        return self._events[0][0] if self._events else self._next_id
+
+    def _offset_after(self, cursor: int) -> int:
+        index = cursor + 1 - self._first_buffered_id()
+        if 0 <= index < len(self._events):
+            return self._events[index][2]
+        return self._total_bytes
+
+    def can_replay(self, last_event_id: int) -> bool:
+        return last_event_id + 1 >= self._first_buffered_id()
+
+    def bind_session(self, session_id: int, parent_id: Optional[int] = None) -> None:
+        """Associate the generation with its session once the incoming messages are stored."""
+        self.session_id = session_id
+        self.parent_id = parent_id
+        _BY_SESSION[session_id] = self.id
+
+    def bind_message(self, message_id: int) -> None:
+        """Associate the generation with the assistant message it is writing."""
+        self.message_id = message_id
+
+    def info(self) -> Dict[str, object]:
+        return {
+            "generation_id": self.id,
+            "session_id": self.session_id,
+            "message_id": self.message_id,
+            "ttft_ms": self.ttft_ms,
+            "last_event_id": self.last_event_id,
+            "subscribers": self.subscribers,
+            "buffered_bytes": self.buffered_bytes,
+            "paused": self.paused,
+            "done": self.done,
+        }
+
+    async def publish(self, data: Dict) -> int:
+        if self.ttft_ms is None and (data.get("content") or data.get("reasoning")):
+            self.ttft_ms = round((time.monotonic() - self.started_at) * 1000, 3)
+            _TTFT_MS.append(self.ttft_ms)
+        event_id = self._next_id
+        self._next_id += 1
+        payload = json.dumps(data)
+        self._events.append((event_id, payload, self._total_bytes))
+        self._total_bytes += len(payload)
+        self._trim()
+        async with self._changed:
+            self._changed.notify_all()
+            if self.buffered_bytes >= settings.stream_buffer_high_watermark:
+                await self._wait_for_drain()
+        return event_id
+
+    async def _wait_for_drain(self) -> None:
+        # Called with self._changed held
+        self.paused = True
+        try:
+            await asyncio.wait_for(
+                self._changed.wait_for(
+                    lambda: self.buffered_bytes <= settings.stream_buffer_low_watermark
+                ),
+                timeout=settings.stream_slow_subscriber_timeout_seconds,
+            )
+        except asyncio.TimeoutError:
+            # Drop whoever is still lagging; they can resume via Last-Event-ID.
+            for sub in list(self._subscribers):
+                if self._total_bytes - self._offset_after(sub.cursor) > settings.stream_buffer_low_watermark:
+                    sub.evicted = True
+                    self._subscribers.discard(sub)
+            self._changed.notify_all()
+            if not self._subscribers:
+                self._on_orphaned()
+        finally:
+            self.paused = False
+        self._trim()
+
+    def _trim(self) -> None:
+        limit = max(1, settings.stream_replay_buffer_events)
+        slowest = min((sub.cursor for sub in self._subscribers), default=None)
+        while len(self._events) > limit:
+            # Never drop events a live subscriber has not received yet
+            if slowest is not None and self._events[0][0] > slowest:
+                break
+            self._events.popleft()
+
+    async def subscribe(
+        self, last_event_id: int = 0, initial: bool = False
+    ) -> AsyncIterator[Tuple[int, str]]:
+        """
+        Yield (event_id, data) pairs after `last_event_id`, replaying buffered ones first.
+
+        `initial` takes over the subscription reserved for the starting request.
+        """
+        if initial and self._initial in self._subscribers:
+            sub = self._initial
+            self._initial = None
+        else:
+            if not self.can_replay(last_event_id):
+                raise ReplayGapError(f"Events after {last_event_id} are no longer buffered")
+            sub = _Subscriber(last_event_id)
+            self._attach(sub)
+        try:
+            while True:
+                async with self._changed:
+                    await self._changed.wait_for(
+                        lambda: self.last_event_id > sub.cursor or self.done or sub.evicted
+                    )
+                if sub.evicted:
+                    raise ReplayGapError(f"Subscriber fell behind at event {sub.cursor}")
+                start = sub.cursor + 1 - self._first_buffered_id()
+                pending = list(itertools.islice(self._events, start, None))
+                for event_id, data, _ in pending:
+                    yield event_id, data
+                    sub.cursor = event_id
+                    if self.paused:
+                        async with self._changed:
+                            self._changed.notify_all()
+                if self.done and sub.cursor >= self.last_event_id:
+                    return
+        finally:
+            self._detach(sub)
+
+    async def run(self, producer: Callable[["Generation"], Awaitable[None]]) -> None:
+        try:
+            await producer(self)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print(f"[generation_registry] generation {self.id} failed: {e}")
+        finally:
+            self.done = True
+            async with self._changed:
+                self._changed.notify_all()
+            asyncio.get_running_loop().call_later(settings.stream_replay_ttl_seconds, _forget, self)
+
+    def cancel(self) -> None:
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+
+    def _attach(self, sub: _Subscriber) -> None:
+        self._subscribers.add(sub)
+        if self._orphan_handle is not None:
+            self._orphan_handle.cancel()
+            self._orphan_handle = None
+
+    def _detach(self, sub: _Subscriber) -> None:
+        if sub in self._subscribers:
+            self._subscribers.discard(sub)
+            if self.paused:
+                # A departing slow subscriber may be what the producer waits on
+                asyncio.ensure_future(self._notify())
+        if not self._subscribers:
+            self._on_orphaned()
+
+    def _on_orphaned(self) -> None:
+        if self.done:
+            return
+        policy = settings.stream_orphan_policy
+        if policy == "cancel":
+            self.cancel()
+        elif policy == "grace":
+            # Keep generating for a while so a dropped client can resume.
+            self._orphan_handle = asyncio.get_running_loop().call_later(
+                settings.stream_resume_grace_seconds, self._cancel_if_orphaned
+            )
+        # "complete": run to the end regardless of listeners
+
+    async def _notify(self) -> None:
+        async with self._changed:
+            self._changed.notify_all()
+
+    def _cancel_if_orphaned(self) -> None:
+        self._orphan_handle = None
+        if not self._subscribers:
+            self.cancel()
+
+
+_GENERATIONS: Dict[str, Generation] = {}
+# Time to first token of recent generations, for ttft_stats()
+_TTFT_MS: Deque[float] = deque(maxlen=1000)
+# Latest generation per session
+_BY_SESSION: Dict[int, str] = {}
+
+
+def _forget(generation: Generation) -> None:
+    _GENERATIONS.pop(generation.id, None)
+    if generation.session_id is not None and _BY_SESSION.get(generation.session_id) == generation.id:
+        _BY_SESSION.pop(generation.session_id, None)
+
+
+def start_generation(
+    session_id: Optional[int],
+    producer: Callable[[Generation], Awaitable[None]],
+    started_at: Optional[float] = None,
+) -> Generation:
+    generation = Generation(uuid.uuid4().hex, session_id, started_at)
+    _GENERATIONS[generation.id] = generation
+    if session_id is not None:
+        _BY_SESSION[session_id] = generation.id
+    generation.task = asyncio.create_task(generation.run(producer))
+    return generation
+
+
+def get_generation(generation_id: str) -> Optional[Generation]:
+    return _GENERATIONS.get(generation_id)
+
+
+def get_session_generation(session_id: int) -> Optional[Generation]:
+    generation_id = _BY_SESSION.get(session_id)
+    return _GENERATIONS.get(generation_id) if generation_id else None
+
+
+def running_generations(
+    session_id: Optional[int] = None, message_ids: Optional[Iterable[int]] = None
+) -> List[Generation]:
+    """
+    Unfinished generations, optionally only those of a session. With
+    `message_ids`, only those writing one of these messages or a reply to
+    one (or whose parent is not known yet).
+    """
+    generations = [
+        generation
+        for generation in _GENERATIONS.values()
+        if not generation.done and (session_id is None or generation.session_id == session_id)
+    ]
+    if message_ids is not None:
+        ids = set(message_ids)
+        generations = [
+            generation
+            for generation in generations
+            if generation.parent_id is None
+            or generation.parent_id in ids
+            or generation.message_id in ids
+        ]
+    return generations
+
+
+async def cancel_generations(generations: Iterable[Generation]) -> None:
+    """
+    Cancel `generations` and wait (up to `stream_cancel_timeout_seconds`)
+    until each has saved what it generated, so their writes cannot race
+    the caller's.
+    """
+    tasks = []
+    for generation in generations:
+        generation.cancel()
+        if generation.task is not None and not generation.task.done():
+            tasks.append(generation.task)
+    if tasks:
+        await asyncio.wait(tasks, timeout=settings.stream_cancel_timeout_seconds)
+
+
+def list_generations() -> List[Dict[str, object]]:
+    return [generation.info() for generation in _GENERATIONS.values()]
+
+
+def ttft_stats() -> Dict[str, object]:
+    """Time to first token (request received to first content) over recent generations."""
+    samples = sorted(_TTFT_MS)
+    if not samples:
+        return {"count": 0}
+
+    def percentile(p: float) -> float:
+        return samples[min(len(samples) - 1, int(p * len(samples)))]
+
+    return {
+        "count": len(samples),
+        "avg_ms": round(sum(samples) / len(samples), 3),
+        "p50_ms": percentile(0.5),
+        "p95_ms": percentile(0.95),
+        "max_ms": samples[-1],
+    }
+
+
+async def sse_events(
+    generation: Generation, last_event_id: int = 0, initial: bool = False
+) -> AsyncIterator[str]:
+    """Format a generation's events as SSE frames carrying their event ids."""
+    try:
+        async for event_id, data in generation.subscribe(last_event_id, initial=initial):
+            yield f"id: {event_id}\ndata: {data}\n\n"
+    except ReplayGapError as e:
+        yield f"data: {json.dumps({'error': str(e)})}\n\n"
@@ -0,0 +1,236 @@
+"""
+Background jobs that rewrite existing rows after a storage format change
+"""
+import asyncio
+from typing import List, Optional
+
+from sqlalchemy import LargeBinary, Text, and_, cast, func, or_, select, type_coerce, update
+from sqlalchemy.orm import Session
+
+try:
+    from .config import settings
+    from .database import ChatMessage, run_db
+    from .search_sources import store_search_results
+    from .upload_store import offload_data_uris
+except (ImportError, ValueError):
+    from config import settings
+    from database import ChatMessage, run_db
+    from search_sources import store_search_results
+    from upload_store import offload_data_uris
+
+
+def _abort_interrupted(db: Session) -> int:
+    result = db.execute(
+        update(ChatMessage).where(ChatMessage.status == "partial").values(status="aborted")
+    )
+    db.commit()
+    return result.rowcount
+
+
+async def abort_interrupted_replies() -> int:
+    """
+    Mark replies left 'partial' by a stopped server as 'aborted'.
+
+    Run before requests are served, since 'partial' rows then belong to live
+    streams. Once aborted, the rows are indexed for search and compressed by
+    the backfill like any finished message. Returns the number of rows.
+    """
+    count = await run_db(_abort_interrupted)
+    if count:
+        print(f"[maintenance] marked {count} interrupted replies as aborted")
+    return count
+
+
+def _stored_plain(column):
+    """SQL: the raw column is text long enough to be compressed."""
+    return and_(
+        func.typeof(column) == "text",
+        func.length(cast(column, LargeBinary)) >= settings.message_compression_min_bytes,
+    )
+
+
+def _compress_batch(db: Session, after_id: int) -> Optional[int]:
+    """
+    Rewrite one batch of completed messages with compressed columns.
+
+    Returns the last message id examined, or None when there is nothing left.
+    """
+    ids = db.execute(
+        select(ChatMessage.id)
+        .where(
+            ChatMessage.id > after_id,
+            ChatMessage.status.isnot("partial"),
+            or_(
+                _stored_plain(ChatMessage.content),
+                _stored_plain(ChatMessage.thought_process),
+                _stored_plain(ChatMessage.search_results),
+            ),
+        )
+        .order_by(ChatMessage.id)
+        .limit(settings.message_compression_batch_size)
+    ).scalars().all()
+    if not ids:
+        return None
+
+    rows = db.execute(
+        select(
+            ChatMessage.id,
+            ChatMessage.content,
+            ChatMessage.thought_process,
+            ChatMessage.search_results,
+        ).where(ChatMessage.id.in_(ids))
+    ).all()
+    # Reading decoded the values; writing them back through the column types compresses them
+    db.execute(
+        update(ChatMessage),
+        [
+            {
+                "id": row.id,
+                "content": row.content,
+                "thought_process": row.thought_process,
+                "search_results": row.search_results,
+            }
+            for row in rows
+        ],
+    )
+    db.commit()
+    return ids[-1]
+
+
+async def compress_existing_messages() -> int:
+    """
+    Compress messages stored before compression was enabled, batch by batch.
+
+    Each batch is its own short transaction on the database executor, so
+    chats keep working while the backfill runs.
+    """
+    if settings.message_compression.lower() == "off":
+        return 0
+    after_id = 0
+    batches = 0
+    while True:
+        last_id = await run_db(_compress_batch, after_id)
+        if last_id is None:
+            break
+        after_id = last_id
+        batches += 1
+        # Let request handlers get at the executor between batches
+        await asyncio.sleep(0)
+    if batches:
+        print(f"[maintenance] compressed existing messages up to id {after_id}")
+    return batches
+
+
+def _move_search_results_batch(db: Session) -> int:
+    """Move one batch of inline search results into message_sources; returns the count."""
+    raw = type_coerce(ChatMessage.search_results, Text)
+    rows = db.execute(
+        select(ChatMessage.id, ChatMessage.search_results)
+        # The legacy JSON column stored "no results" as the text 'null'
+        .where(raw.isnot(None), raw != "null")
+        .order_by(ChatMessage.id)
+        .limit(settings.message_compression_batch_size)
+    ).all()
+    for message_id, results in rows:
+        store_search_results(db, message_id, results)
+    if rows:
+        db.execute(
+            update(ChatMessage)
+            .where(ChatMessage.id.in_([row.id for row in rows]))
+            .values(search_results=None)
+        )
+        db.commit()
+    return len(rows)
+
+
+async def move_legacy_search_results() -> int:
+    """Move search results stored inline on messages into the interned side tables."""
+    moved = 0
+    while True:
+        count = await run_db(_move_search_results_batch)
+        if not count:
+            break
+        moved += count
+        await asyncio.sleep(0)
+    if moved:
+        print(f"[maintenance] moved search results of {moved} messages to message_sources")
+    return moved
+
+
+_MEDIA_COLUMNS = ("images", "videos", "audios")
+
+
+def _inline_media_batch(db: Session, after_id: int) -> List:
+    """Next batch of messages whose media lists hold `data:` URIs."""
+    pattern = '%"data:%'
+    return db.execute(
+        select(ChatMessage.id, ChatMessage.images, ChatMessage.videos, ChatMessage.audios)
+        .where(
+            ChatMessage.id > after_id,
+            or_(*(getattr(ChatMessage, column).like(pattern) for column in _MEDIA_COLUMNS)),
+        )
+        .order_by(ChatMessage.id)
+        .limit(settings.inline_media_batch_size)
+    ).all()
+
+
+def _offload_rows(rows: List):
+    """
+    Write the inline media of `rows` to uploads/; returns the row updates
+    and the number of URI characters moved.
+    """
+    updates = []
+    moved = 0
+    for row in rows:
+        values = {"id": row.id}
+        for column in _MEDIA_COLUMNS:
+            items, count = offload_data_uris(getattr(row, column))
+            if count:
+                values[column] = items
+                moved += count
+        if len(values) > 1:
+            updates.append(values)
+    return updates, moved
+
+
+def _update_media(db: Session, updates: List) -> None:
+    # Rows differ in which columns changed, so update them one by one
+    for values in updates:
+        db.execute(update(ChatMessage).where(ChatMessage.id == values.pop("id")).values(**values))
+    db.commit()
+
+
+async def extract_inline_media() -> int:
+    """
+    Move `data:` URIs stored in message media lists into uploads/.
+
+    Rows are read and updated in short transactions; decoding and writing
+    the files happens in between, off the database executor. Returns the
+    number of messages rewritten.
+    """
+    after_id = 0
+    rewritten = 0
+    moved = 0
+    while True:
+        rows = await run_db(_inline_media_batch, after_id)
+        if not rows:
+            break
+        after_id = rows[-1].id
+        updates, count = await asyncio.to_thread(_offload_rows, rows)
+        if updates:
+            await run_db(_update_media, updates)
+        rewritten += len(updates)
+        moved += count
+    if rewritten:
+        print(f"[maintenance] moved {moved} characters of inline media of {rewritten} messages to uploads/")
+    return rewritten
+
+
+async def run_startup_backfills() -> None:
+    """Bring rows written by older versions up to the current storage format."""
+    await move_legacy_search_results()
+    if settings.inline_media_backfill:
+        await extract_inline_media()
+    # Compression relies on SQLite storing BLOBs in TEXT columns
+    if settings.message_compression_backfill and settings.database_url.startswith("sqlite"):
+        await compress_existing_messages()
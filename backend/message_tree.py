@@ -0,0 +1,136 @@
+"""
+Message trees: branches of a session share their common history
+"""
+from typing import Dict, Iterable, List, Optional
+
+from sqlalchemy import func, literal, or_, select
+from sqlalchemy.orm import Session, aliased
+
+try:
+    from .database import ChatMessage, ChatSession
+except (ImportError, ValueError):
+    from database import ChatMessage, ChatSession
+
+# Bound on the levels a recursive walk follows. Well-formed trees never get
+# near it; a parent cycle (e.g. written by an older version) ends here
+# instead of pinning a database thread forever
+MAX_TREE_DEPTH = 100_000
+
+
+def path_cte(leaf_id: Optional[int], max_depth: Optional[int] = None):
+    """
+    Recursive CTE of the messages from `leaf_id` up to its root, or up to
+    `max_depth` levels above it.
+
+    Columns are `id` and `depth` (0 at the leaf); order by depth descending
+    for conversation order. A message listed as its own parent ends the path.
+    """
+    path = (
+        select(ChatMessage.id, ChatMessage.parent_id, literal(0).label("depth"))
+        .where(ChatMessage.id == leaf_id)
+        .cte("message_path", recursive=True)
+    )
+    depth_limit = MAX_TREE_DEPTH if max_depth is None else min(max_depth, MAX_TREE_DEPTH)
+    parent = aliased(ChatMessage)
+    step = select(parent.id, parent.parent_id, path.c.depth + 1).where(
+        parent.id == path.c.parent_id,
+        path.c.parent_id != path.c.id,
+        path.c.depth < depth_limit,
+    )
+    return path.union_all(step)
+
+
+def branch_lengths(db: Session, session_ids: Iterable[int]) -> Dict[int, int]:
+    """
+    Number of messages on the active branch of each session, with one
+    recursive query walking up from the active leaves. Sessions without
+    messages are left out.
+    """
+    session_ids = list(session_ids)
+    if not session_ids:
+        return {}
+    path = (
+        select(
+            ChatSession.id.label("session_id"),
+            ChatMessage.id,
+            ChatMessage.parent_id,
+            literal(0).label("depth"),
+        )
+        .join(ChatMessage, ChatMessage.id == ChatSession.active_leaf_id)
+        .where(ChatSession.id.in_(session_ids))
+        .cte("branch_path", recursive=True)
+    )
+    parent = aliased(ChatMessage)
+    path = path.union_all(
+        select(path.c.session_id, parent.id, parent.parent_id, path.c.depth + 1).where(
+            parent.id == path.c.parent_id,
+            path.c.parent_id != path.c.id,
+            path.c.depth < MAX_TREE_DEPTH,
+        )
+    )
+    rows = db.execute(select(path.c.session_id, func.count()).group_by(path.c.session_id))
+    return {session_id: count for session_id, count in rows}
+
+
+def newest_leaf(db: Session, message_id: int) -> int:
+    """The leaf reached from `message_id` by always following the newest child."""
+    child = aliased(ChatMessage)
+    tip = select(literal(message_id).label("id"), literal(0).label("depth")).cte(
+        "newest_tip", recursive=True
+    )
+    newest_child = (
+        select(func.max(child.id))
+        .where(child.parent_id == tip.c.id, child.id != tip.c.id)
+        .scalar_subquery()
+    )
+    tip = tip.union_all(
+        select(newest_child, tip.c.depth + 1).where(
+            tip.c.id.isnot(None), tip.c.depth < MAX_TREE_DEPTH
+        )
+    )
+    leaf = db.execute(
+        select(tip.c.id).where(tip.c.id.isnot(None)).order_by(tip.c.depth.desc()).limit(1)
+    ).scalar()
+    return leaf if leaf is not None else message_id
+
+
+def subtree_ids(db: Session, session_id: int, message_id: int) -> List[int]:
+    """Ids of `message_id` and all its descendants within a session."""
+    tree = (
+        select(ChatMessage.id)
+        .where(ChatMessage.id == message_id, ChatMessage.session_id == session_id)
+        .cte("message_subtree", recursive=True)
+    )
+    child = aliased(ChatMessage)
+    # UNION (not UNION ALL) visits every id once, so a cycle cannot loop
+    tree = tree.union(select(child.id).where(child.parent_id == tree.c.id))
+    return list(db.execute(select(tree.c.id)).scalars())
+
+
+def sibling_ids(db: Session, session_id: int, messages: Iterable) -> Dict[int, List[int]]:
+    """
+    Alternatives of each message: ids of all messages with the same parent.
+
+    Only messages that have alternatives (edits, regenerations) are included.
+    """
+    messages = list(messages)
+    parents = {msg.parent_id for msg in messages}
+    if not parents:
+        return {}
+    known = [parent for parent in parents if parent is not None]
+    conditions = [ChatMessage.parent_id.in_(known)] if known else []
+    if None in parents:
+        conditions.append(ChatMessage.parent_id.is_(None))
+    children: Dict[Optional[int], List[int]] = {}
+    rows = db.execute(
+        select(ChatMessage.id, ChatMessage.parent_id)
+        .where(ChatMessage.session_id == session_id, or_(*conditions))
+        .order_by(ChatMessage.id)
+    )
+    for message_id, parent_id in rows:
+        children.setdefault(parent_id, []).append(message_id)
+    return {
+        msg.id: children[msg.parent_id]
+        for msg in messages
+        if len(children.get(msg.parent_id, ())) > 1
+    }
@@ -59,7 +59,14 @@ class MessageResponse(BaseModel):
     model: Optional[str] = None
     thought_process: Optional[str] = None
     thought_signatures: Optional[List[str]] = None
+    status: Optional[str] = None
     created_at: datetime
+    # Set in summary views: reasoning/search results exist but were omitted
+    has_details: Optional[bool] = None
+    parent_id: Optional[int] = None
+    # Ids of the alternatives of this message (same parent), oldest first;
+    # empty when it was never edited or regenerated
+    sibling_ids: List[int] = []
 
     class Config:
         from_attributes = True
@@ -99,6 +106,48 @@ class SessionDetailResponse(SessionResponse):
     """Detailed session response with messages"""
 
     messages: List[MessageResponse] = []
+    active_generation_id: Optional[str] = None
+    active_leaf_id: Optional[int] = None
+
+
+class ForkRequest(BaseModel):
+    """Continue a session from one of its messages"""
+
+    message_id: Optional[int] = None  # None starts over with a new first message
+
+
+class BranchSwitchRequest(BaseModel):
+    """Switch a session to the branch containing a message"""
+
+    message_id: int
+
+
+class MessagePageResponse(BaseModel):
+    """A page of session history, oldest first"""
+
+    messages: List[MessageResponse] = []
+    next_cursor: Optional[str] = None  # Fetch older messages with ?before=<next_cursor>
+    has_more: bool = False
+
+
+# Search schemas
+class SearchHit(BaseModel):
+    """A message matching a full-text search"""
+
+    message_id: int
+    session_id: int
+    session_title: str
+    role: str
+    created_at: datetime
+    snippet: str
+    score: float  # bm25 rank, lower is more relevant
+
+
+class SearchResponse(BaseModel):
+    """A page of search hits, best first"""
+
+    hits: List[SearchHit] = []
+    next_cursor: Optional[str] = None
 
 
 # Chat request/response schemas
@@ -188,6 +237,16 @@ class ChatRequest(BaseModel):
     camera_fixed: Optional[bool] = None
 
 
+class RegenerateRequest(ChatRequest):
+    """Regenerate an assistant reply from the stored history"""
+
+    session_id: int
+    messages: List[MessageCreate] = Field(default_factory=list, max_length=0)
+    # Assistant message to replace (a user message gets a new reply);
+    # defaults to the session's active leaf
+    message_id: Optional[int] = None
+
+
 class ChatResponse(BaseModel):
     """Chat completion response (non-streaming)"""
 
@@ -145,6 +145,15 @@ def get_provider(provider_id: str) -> Optional[LLMProvider]:
     return _PROVIDER_REGISTRY.get(provider_id)
 
 
+def get_model_context_length(provider_id: str, model_id: str) -> Optional[int]:
+    """Context window of a model from the cached model list, if the provider reports one."""
+    for model in _get_cached_models(provider_id) or []:
+        if model.get("id") == model_id:
+            context_length = model.get("context_length")
+            return context_length if isinstance(context_length, int) else None
+    return None
+
+
 async def refresh_models_cache(provider: Optional[str] = None) -> None:
     if provider:
         _clear_cache(provider)
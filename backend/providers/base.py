@@ -2,6 +2,28 @@ from typing import List, Dict, Optional, Tuple, AsyncIterator
 import abc
 
 
+class ChatResult(tuple):
+    """
+    (content, reasoning) of a non-streamed reply plus metadata of that reply.
+
+    Unpacks like the plain tuple other providers return. The metadata lives
+    on the result rather than the (shared) client, so concurrent requests
+    cannot see each other's.
+    """
+
+    def __new__(
+        cls,
+        content: str,
+        reasoning: str,
+        thought_signatures: Optional[List[str]] = None,
+        search_results: Optional[List[Dict[str, str]]] = None,
+    ):
+        result = super().__new__(cls, (content, reasoning))
+        result.thought_signatures = thought_signatures or []
+        result.search_results = search_results or []
+        return result
+
+
 class LLMProvider(abc.ABC):
     id: str
     name: str
@@ -18,7 +40,8 @@ class LLMProvider(abc.ABC):
         **kwargs,
     ) -> Tuple[str, str]:
         """
-        Send a chat request and return (content, reasoning).
+        Send a chat request and return (content, reasoning), possibly as a
+        ChatResult carrying thought signatures and search results.
         """
         pass
 
@@ -32,7 +55,9 @@ class LLMProvider(abc.ABC):
         **kwargs,
     ) -> AsyncIterator[str]:
         """
-        Send a chat request and yield SSE-formatted chunks.
+        Send a chat request and yield SSE-formatted chunks: `content`,
+        `reasoning`, `search_results`, `thought_signatures` (stored with the
+        reply, not forwarded to clients), `error` and finally `done`.
         """
         pass
 
@@ -5,7 +5,7 @@ import traceback
 from google import genai
 from google.genai import types
 
-from .base import BaseClient
+from .base import BaseClient, ChatResult
 from .gemini_config import GeminiConfigMixin
 from .gemini_media import GeminiMediaMixin
 from .gemini_messages import GeminiMessagesMixin
@@ -39,8 +39,6 @@ class GeminiClient(
             api_key=settings.gemini_api_key,
             http_options=http_options,
         )
-        self._last_thought_signatures: List[str] = []
-        self._last_search_results: List[Dict[str, str]] = []
 
     async def _handle_gemini_image_generation(
         self,
@@ -87,12 +85,6 @@ class GeminiClient(
             config=config,
         )
 
-        self._last_thought_signatures = self._extract_thought_signatures(response)
-        self._last_search_results = (
-            self._extract_search_results(response)
-            or self._extract_url_context_results(response)
-        )
-
         text = self._extract_regular_text_from_response(response)
         images = self._extract_inline_images(response)
         saved_urls = [self._save_generated_image(img, mime) for img, mime in images]
@@ -101,7 +93,13 @@ class GeminiClient(
             content = f"{text}\n\n{markdown}"
         else:
             content = text or markdown
-        return content, ""
+        return ChatResult(
+            content,
+            "",
+            thought_signatures=self._extract_thought_signatures(response),
+            search_results=self._extract_search_results(response)
+            or self._extract_url_context_results(response),
+        )
 
     async def stream_chat(
         self,
@@ -112,8 +110,6 @@ class GeminiClient(
         **kwargs,
     ) -> AsyncIterator[str]:
         try:
-            self._last_thought_signatures = []
-            self._last_search_results = []
             if self._is_imagen_model(model):
                 content, _reasoning = await self._handle_imagen(model, messages, **kwargs)
                 if content:
@@ -121,9 +117,13 @@ class GeminiClient(
                 yield f"data: {json.dumps({'done': True})}\n\n"
                 return
             if self._is_gemini_image_model(model):
-                content, _reasoning = await self._handle_gemini_image_generation(model, messages, **kwargs)
-                if content:
-                    yield f"data: {json.dumps({'content': content})}\n\n"
+                result = await self._handle_gemini_image_generation(model, messages, **kwargs)
+                if result.search_results:
+                    yield f"data: {json.dumps({'search_results': result.search_results})}\n\n"
+                if result.thought_signatures:
+                    yield f"data: {json.dumps({'thought_signatures': result.thought_signatures})}\n\n"
+                if result[0]:
+                    yield f"data: {json.dumps({'content': result[0]})}\n\n"
                 yield f"data: {json.dumps({'done': True})}\n\n"
                 return
             contents, system_instruction = self._messages_to_contents_and_system(messages)
@@ -193,11 +193,10 @@ class GeminiClient(
                 if not search_results:
                     search_results = self._extract_url_context_results(chunk)
                 if search_results:
-                    self._last_search_results = search_results
                     yield f"data: {json.dumps({'search_results': search_results})}\n\n"
                 signatures = self._extract_thought_signatures(chunk)
                 if signatures:
-                    self._last_thought_signatures = signatures
+                    yield f"data: {json.dumps({'thought_signatures': signatures})}\n\n"
                 reasoning = self._extract_reasoning_from_response(chunk)
                 if reasoning:
                     yield f"data: {json.dumps({'reasoning': reasoning})}\n\n"
@@ -222,8 +221,6 @@ class GeminiClient(
         **kwargs,
     ) -> Tuple[str, str]:
         try:
-            self._last_thought_signatures = []
-            self._last_search_results = []
             if self._is_imagen_model(model):
                 return await self._handle_imagen(model, messages, **kwargs)
             if self._is_gemini_image_model(model):
@@ -288,15 +285,13 @@ class GeminiClient(
                 config=config,
             )
 
-            self._last_thought_signatures = self._extract_thought_signatures(response)
-            self._last_search_results = (
-                self._extract_search_results(response)
-                or self._extract_url_context_results(response)
+            return ChatResult(
+                self._extract_regular_text_from_response(response),
+                self._extract_reasoning_from_response(response),
+                thought_signatures=self._extract_thought_signatures(response),
+                search_results=self._extract_search_results(response)
+                or self._extract_url_context_results(response),
             )
-
-            content = self._extract_regular_text_from_response(response)
-            reasoning = self._extract_reasoning_from_response(response)
-            return content, reasoning
         except Exception as e:
             raise Exception(f"Gemini API error: {str(e)}")
 
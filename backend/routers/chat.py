@@ -1,61 +1,353 @@
 import asyncio
-import json
+import functools
+import time
 from datetime import datetime, timezone
+from typing import Optional
 
-from fastapi import APIRouter, Depends, HTTPException, Request, status
+from fastapi import APIRouter, Header, HTTPException, status
 from fastapi.responses import StreamingResponse
-from sqlalchemy.orm import Session
+from sqlalchemy import update
+from sqlalchemy.orm import Session, undefer_group
 
 from config import settings
-from database import ChatMessage, ChatSession, get_db
-from models import ChatRequest, ChatResponse, MessageResponse
-from provider_registry import get_provider
+from context_budget import fit_history, history_budget, message_tokens
+from context_cache import append_context, context_version, get_context, put_context
+from context_media import elide_history_media, elided_count, has_media, media_policy, media_report
+from database import ChatMessage, ChatSession, run_db
+from db_writer import write_db
+from generation_registry import (
+    cancel_generations,
+    get_generation,
+    get_session_generation,
+    list_generations,
+    running_generations,
+    sse_events,
+    start_generation,
+    ttft_stats,
+)
+from message_tree import path_cte
+from models import ChatRequest, ChatResponse, MessageResponse, RegenerateRequest
+from provider_registry import get_model_context_length, get_provider
+from search_sources import store_search_results
+from stage_timing import stage_stats
+from upload_store import has_data_uri, offload_data_uris
 from .chat_helpers import (
     _build_provider_kwargs,
+    _context_item,
     _ensure_list,
     _extract_think_tag,
     _format_api_content,
     _localize_markdown_images,
-    _localize_streaming_content,
-    _strip_think_stream,
 )
+from .chat_persistence import AssistantCheckpoint, advance_active_leaf
+from .chat_stream import StreamState, build_stream_pipeline
 
 
 router = APIRouter()
 
 
 @router.post(f"{settings.api_prefix}/chat")
-async def chat_completion(
-    chat_request: ChatRequest, request: Request, db: Session = Depends(get_db)
-):
+async def chat_completion(chat_request: ChatRequest):
     """
     Chat completion endpoint with streaming support
 
     Args:
         request: Chat request data
     """
-    if chat_request.session_id:
-        session = (
-            db.query(ChatSession)
-            .filter(ChatSession.id == chat_request.session_id)
-            .first()
+    return await _complete(chat_request, time.monotonic())
+
+
+@router.post(f"{settings.api_prefix}/chat/regenerate")
+async def regenerate_reply(regenerate_request: RegenerateRequest):
+    """
+    Generate a new reply from the stored history, keeping the old one as an alternative
+
+    The reply becomes a sibling of `message_id` (by default the session's
+    active leaf) and the session continues from it. Nothing is re-sent by
+    the client; accepts the same generation options as `POST /chat`.
+
+    Args:
+        regenerate_request: Session, message to replace and generation options
+    """
+    return await _complete(regenerate_request, time.monotonic(), regenerate=True)
+
+
+async def _complete(chat_request: ChatRequest, received_at: float, regenerate: bool = False):
+    (
+        persisted,
+        provider_client,
+        provider_id,
+        model_id,
+        api_messages,
+        context_report,
+    ) = await _prepare_chat(chat_request, regenerate)
+
+    if chat_request.stream:
+        generation = _start_stream(
+            chat_request,
+            persisted,
+            provider_client,
+            provider_id,
+            model_id,
+            api_messages,
+            context_report,
+            received_at=received_at,
         )
-        if not session:
+        return _sse_response(generation, initial=True)
+
+    provider_kwargs = _build_provider_kwargs(chat_request)
+    if provider_id not in ("openrouter", "gemini"):
+        provider_kwargs.pop("reasoning", None)
+        provider_kwargs.pop("modalities", None)
+        provider_kwargs.pop("image_config", None)
+
+    # Handle Seedream non-streaming if needed (though UI usually uses stream)
+    reply = asyncio.ensure_future(
+        provider_client.chat(model=model_id, messages=api_messages, **provider_kwargs)
+    )
+    try:
+        session_id, parent_id, start_leaf_id = await persisted
+    except BaseException as e:
+        await _discard(reply)
+        if isinstance(e, (HTTPException, asyncio.CancelledError)):
+            raise
+        print(f"Error saving incoming messages: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to save messages",
+        )
+
+    try:
+        result = await reply
+        response_content, reasoning_content = result
+
+        response_content, think_text = _extract_think_tag(response_content)
+        if think_text:
+            reasoning_content = f"{reasoning_content or ''}{think_text}"
+
+        # Process images for non-streaming response
+        response_content, _ = await _localize_markdown_images(response_content)
+
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Provider error: {str(e)}",
+        )
+
+    if not response_content:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Empty response from provider",
+        )
+
+    try:
+        # Reply metadata comes with the result (see providers.base.ChatResult)
+        thought_signatures = getattr(result, "thought_signatures", None) or None
+        search_results = getattr(result, "search_results", None) or None
+
+        assistant_message = dict(
+            session_id=session_id,
+            parent_id=parent_id,
+            role="assistant",
+            content=response_content,
+            thought_process=reasoning_content if reasoning_content else None,
+            thought_signatures=thought_signatures,
+            provider=provider_id,
+            model=model_id,
+            status="complete",
+            token_count=message_tokens(response_content),
+        )
+        message, context_item = await write_db(
+            _save_assistant_message, assistant_message, start_leaf_id, search_results
+        )
+        append_context(session_id, *context_item, parent_id=parent_id)
+    except Exception:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to save assistant message",
+        )
+
+    return ChatResponse(session_id=session_id, message=message)
+
+
+def _save_assistant_message(
+    db: Session, values: dict, start_leaf_id: Optional[int], search_results: Optional[list] = None
+):
+    """Group-commit write: store a complete assistant reply; returns (response, context item)."""
+    assistant_message = ChatMessage(**values)
+    db.add(assistant_message)
+    db.flush()
+    store_search_results(db, assistant_message.id, search_results)
+    db.execute(
+        update(ChatSession)
+        .where(ChatSession.id == assistant_message.session_id)
+        .values(
+            provider=assistant_message.provider,
+            model=assistant_message.model,
+            updated_at=datetime.now(timezone.utc),
+        )
+    )
+    advance_active_leaf(db, assistant_message.session_id, start_leaf_id, assistant_message.id)
+    # Built before the writer's commit expires the instance
+    response = MessageResponse.model_validate(assistant_message)
+    response.search_results = search_results or None
+    return response, _context_item(assistant_message)
+
+
+@router.get(f"{settings.api_prefix}/chat/generations")
+async def get_generations():
+    """List running and recently finished generations with their buffer usage"""
+    return list_generations()
+
+
+@router.get(f"{settings.api_prefix}/chat/stats")
+async def get_chat_stats():
+    """Time to first token of recent streamed generations and per-stage stream timings"""
+    return {"ttft": ttft_stats(), "stages": stage_stats()}
+
+
+@router.get(f"{settings.api_prefix}/chat/{{generation_id}}/events")
+async def resume_chat_stream(
+    generation_id: str,
+    last_event_id: Optional[int] = None,
+    last_event_id_header: Optional[str] = Header(default=None, alias="Last-Event-ID"),
+):
+    """
+    Reattach to an in-progress (or recently finished) streamed generation
+
+    Args:
+        generation_id: The generation ID announced in the first stream event
+        last_event_id: Last event ID the client received; the `Last-Event-ID`
+            header is used when the query parameter is absent
+    """
+    generation = get_generation(generation_id)
+    if not generation:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Generation {generation_id} not found",
+        )
+    return _resume_response(generation, last_event_id, last_event_id_header)
+
+
+@router.delete(
+    f"{settings.api_prefix}/chat/{{generation_id}}",
+    status_code=status.HTTP_204_NO_CONTENT,
+)
+async def cancel_chat_generation(generation_id: str):
+    """
+    Stop a streamed generation; what it generated so far is saved as 'aborted'
+
+    Returns once the reply is saved, so the session can be changed right away.
+
+    Args:
+        generation_id: The generation ID announced in the first stream event
+    """
+    generation = get_generation(generation_id)
+    if not generation:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Generation {generation_id} not found",
+        )
+    await cancel_generations([generation])
+
+
+@router.get(f"{settings.api_prefix}/sessions/{{session_id}}/generation")
+async def get_active_generation(session_id: int):
+    """
+    Get the in-progress (or recently finished) generation of a session
+
+    Args:
+        session_id: The session ID
+    """
+    generation = get_session_generation(session_id)
+    if not generation:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"No generation for session {session_id}",
+        )
+    return generation.info()
+
+
+@router.get(f"{settings.api_prefix}/sessions/{{session_id}}/generation/events")
+async def attach_session_generation(
+    session_id: int,
+    last_event_id: Optional[int] = None,
+    last_event_id_header: Optional[str] = Header(default=None, alias="Last-Event-ID"),
+):
+    """
+    Subscribe to the generation of a session, e.g. from a second tab
+
+    Args:
+        session_id: The session ID
+        last_event_id: Last event ID already seen (0 replays the buffered stream)
+    """
+    generation = get_session_generation(session_id)
+    if not generation:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"No generation for session {session_id}",
+        )
+    return _resume_response(generation, last_event_id, last_event_id_header)
+
+
+@router.delete(
+    f"{settings.api_prefix}/sessions/{{session_id}}/generation",
+    status_code=status.HTTP_204_NO_CONTENT,
+)
+async def cancel_session_generations(session_id: int):
+    """
+    Stop the running generations of a session, e.g. before its first event
+    announced the generation ID
+
+    Args:
+        session_id: The session ID
+    """
+    generations = running_generations(session_id)
+    if not generations:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"No running generation for session {session_id}",
+        )
+    await cancel_generations(generations)
+
+
+def _resume_response(
+    generation, last_event_id: Optional[int], last_event_id_header: Optional[str]
+) -> StreamingResponse:
+    if last_event_id is None:
+        try:
+            last_event_id = int(last_event_id_header) if last_event_id_header else 0
+        except ValueError:
             raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail=f"Session {chat_request.session_id} not found",
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Last-Event-ID must be an integer",
             )
-    else:
-        session = ChatSession(
-            title=chat_request.title
-            or f"Chat {datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M')}",
-            provider=chat_request.provider,
-            model=chat_request.model,
+
+    if not generation.can_replay(last_event_id):
+        raise HTTPException(
+            status_code=status.HTTP_410_GONE,
+            detail=f"Events after {last_event_id} are no longer buffered; reload the session",
         )
-        db.add(session)
-        db.commit()
-        db.refresh(session)
 
+    return _sse_response(generation, last_event_id)
+
+
+async def _prepare_chat(chat_request: ChatRequest, regenerate: bool = False):
+    """
+    Validate a chat request and build the provider message list within the
+    model's context budget.
+
+    The history is the session's active branch; with `regenerate`, the branch
+    up to the message that `chat_request.message_id` replies to.
+
+    Storing the incoming messages (and creating the session) is only started:
+    `persisted` is a task resolving to (session id, parent id of the reply,
+    active leaf once they are stored), so callers can send the upstream
+    request while it commits. Every caller must await it.
+
+    Returns (persisted, provider_client, provider_id, model_id, api_messages,
+    context_report).
+    """
     provider_id = chat_request.message_provider or chat_request.provider
     model_id = chat_request.message_model or chat_request.model
     provider_client = get_provider(provider_id)
@@ -65,12 +357,24 @@ async def chat_completion(
             detail=f"Unsupported provider: {provider_id}",
         )
 
-    existing_messages = (
-        db.query(ChatMessage)
-        .filter(ChatMessage.session_id == session.id)
-        .order_by(ChatMessage.created_at.asc())
-        .all()
-    )
+    context_length = get_model_context_length(provider_id, model_id)
+    # Only Gemini replays thought signatures; everyone else skips the column
+    signatures = provider_id == "gemini"
+    history: list = []
+    token_counts: list = []
+    parent_id = None
+    if chat_request.session_id:
+        upto = None
+        if regenerate:
+            upto = await run_db(
+                _regenerate_parent, chat_request.session_id, chat_request.message_id
+            )
+        cached = get_context(chat_request.session_id, signatures=signatures, upto=upto)
+        if cached is None:
+            cached, token_counts = await run_db(
+                _load_history, chat_request.session_id, signatures, upto
+            )
+        parent_id, history = cached
 
     incoming_data = [
         (
@@ -83,32 +387,13 @@ async def chat_completion(
         for msg in chat_request.messages
         if msg.role in ("user", "system")
     ]
+    # Inline media is stored in uploads/ so the database (and every later
+    # request built from it) only carries the reference
+    if any(has_data_uri(i, v, a) for _, _, i, v, a in incoming_data):
+        incoming_data = await asyncio.to_thread(_offload_incoming_media, incoming_data)
 
-    api_messages = [
-        {
-            "role": m.role,
-            "content": _format_api_content(
-                m.content,
-                m.images,
-                getattr(m, "videos", None),
-                getattr(m, "audios", None),
-            ),
-            "thought_signatures": _ensure_list(getattr(m, "thought_signatures", None)),
-        }
-        for m in existing_messages
-    ] + [
-        {"role": r, "content": _format_api_content(c, i, v, a)}
-        for r, c, i, v, a in incoming_data
-    ]
-
-    if chat_request.system_prompt:
-        api_messages = (
-            [{"role": "system", "content": chat_request.system_prompt}] + api_messages
-        )
-
-    incoming_msg_objects = [
-        ChatMessage(
-            session_id=session.id,
+    incoming_rows = [
+        dict(
             role=r,
             content=c,
             images=i,
@@ -116,245 +401,333 @@ async def chat_completion(
             audios=a,
             provider=provider_id,
             model=model_id,
+            token_count=message_tokens(c, i, v, a),
         )
         for r, c, i, v, a in incoming_data
     ]
 
-    if incoming_msg_objects:
-        db.add_all(incoming_msg_objects)
-        session.updated_at = datetime.now(timezone.utc)
-        db.commit()
-
-    if chat_request.stream:
-
-        async def generate():
-            yield f"data: {json.dumps({'session_id': session.id})}\n\n"
-            await asyncio.sleep(0)
-
-            full_response = ""
-            full_reasoning = ""
-            failed = False
-            think_state = {"pending": "", "in_think": False}
-            search_results_buffer = []
-            try:
-                provider_kwargs = _build_provider_kwargs(chat_request)
-                if provider_id not in ("openrouter", "gemini"):
-                    provider_kwargs.pop("reasoning", None)
-                    provider_kwargs.pop("modalities", None)
-                    provider_kwargs.pop("image_config", None)
-
-                stream = provider_client.stream_chat(
-                    model=model_id,
-                    messages=api_messages,
-                    **provider_kwargs,
-                )
-
-                client_gone = False
-                next_chunk_task = None
-                try:
-                    next_chunk_task = asyncio.ensure_future(stream.__anext__())
-                    while True:
-                        if await request.is_disconnected():
-                            client_gone = True
-                            break
-
-                        done, _ = await asyncio.wait({next_chunk_task}, timeout=0.5)
-                        if not done:
-                            continue
-
-                        try:
-                            chunk = next_chunk_task.result()
-                        except StopAsyncIteration:
-                            break
-                        except asyncio.CancelledError:
-                            return
-
-                        try:
-                            chunk_data = json.loads(chunk[6:])
-                            extra_chunk = None
-                            skip_chunk = False
-                            if "search_results" in chunk_data:
-                                chunk_results = chunk_data.get("search_results") or []
-                                if isinstance(chunk_results, list):
-                                    search_results_buffer.extend(chunk_results)
-                                else:
-                                    search_results_buffer.append(chunk_results)
-                            if "content" in chunk_data:
-                                content_val = chunk_data["content"]
-                                content_val, modified = await _localize_streaming_content(content_val)
-                                if modified:
-                                    chunk_data["content"] = content_val
-                                    chunk = f"data: {json.dumps(chunk_data)}\n\n"
-
-                                content_val, think_text = _strip_think_stream(content_val, think_state)
-                                reasoning_delta = ""
-                                if "reasoning" in chunk_data:
-                                    reasoning_delta += chunk_data.pop("reasoning")
-                                if think_text:
-                                    reasoning_delta += think_text
-                                if reasoning_delta:
-                                    full_reasoning += reasoning_delta
-                                    extra_chunk = f"data: {json.dumps({'reasoning': reasoning_delta})}\n\n"
-                                if content_val != chunk_data.get("content"):
-                                    chunk_data["content"] = content_val
-                                    chunk = f"data: {json.dumps(chunk_data)}\n\n"
-
-                                if not content_val and not reasoning_delta:
-                                    skip_chunk = True
-
-                                full_response += content_val
-                            elif "reasoning" in chunk_data:
-                                full_reasoning += chunk_data["reasoning"]
-                            if "error" in chunk_data:
-                                failed = True
-                                yield chunk  # Send the error chunk
-                                break
-                        except Exception as e:
-                            print(f"Error processing chunk: {e}")
-                            pass
-                        if extra_chunk:
-                            yield extra_chunk
-                            await asyncio.sleep(0)
-                        if skip_chunk:
-                            next_chunk_task = asyncio.ensure_future(stream.__anext__())
-                            continue
-                        yield chunk
-                        await asyncio.sleep(0)
-                        next_chunk_task = asyncio.ensure_future(stream.__anext__())
-                finally:
-                    if next_chunk_task is not None and not next_chunk_task.done():
-                        next_chunk_task.cancel()
-
-                    aclose = getattr(stream, "aclose", None)
-                    if callable(aclose):
-                        try:
-                            await aclose()
-                        except Exception:
-                            pass
-
-                if not client_gone and think_state.get("pending"):
-                    pending_text = think_state.get("pending", "")
-                    if think_state.get("in_think"):
-                        full_reasoning += pending_text
-                        pending_chunk = f"data: {json.dumps({'reasoning': pending_text})}\n\n"
-                    else:
-                        full_response += pending_text
-                        pending_chunk = f"data: {json.dumps({'content': pending_text})}\n\n"
-                    yield pending_chunk
-                    await asyncio.sleep(0)
-                    think_state["pending"] = ""
-
-                if client_gone:
-                    return
-
-            except Exception as e:
-                yield f"data: {json.dumps({'error': str(e)})}\n\n"
-                return
-
-            if failed:
-                return
-
-            try:
-                if full_response:
-                    full_response, _ = await _localize_markdown_images(full_response)
-                    thought_signatures = None
-                    search_results = search_results_buffer or None
-                    if provider_id == "gemini":
-                        thought_signatures = getattr(provider_client.client, "_last_thought_signatures", None)
-                        if not search_results:
-                            search_results = getattr(
-                                provider_client.client, "_last_search_results", None
-                            )
-
-                    assistant_message = ChatMessage(
-                        session_id=session.id,
-                        role="assistant",
-                        content=full_response,
-                        thought_process=full_reasoning if full_reasoning else None,
-                        thought_signatures=thought_signatures,
-                        search_results=search_results,
-                        provider=provider_id,
-                        model=model_id,
-                    )
-                    db.add(assistant_message)
-                    session.provider = provider_id
-                    session.model = model_id
-                    session.updated_at = datetime.now(timezone.utc)
-                    db.commit()
-            except Exception as e:
-                print(f"Error saving assistant response: {e}")
-                yield f"data: {json.dumps({'error': 'Failed to save assistant response'})}\n\n"
-
-        headers = {
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "X-Accel-Buffering": "no",
+    # Only the newest turns keep their media in full
+    policy = media_policy(provider_id, model_id)
+    current_turns = sum(1 for row in incoming_data if row[0] == "user")
+    elided = elided_count(history, current_turns)
+    media = media_report(policy)
+    if policy != "full" and has_media(history[:elided]):
+        history, media = await asyncio.to_thread(elide_history_media, history, elided, policy)
+
+    # The system prompt and the new messages are always sent; older history
+    # fills what is left of the window, newest first
+    fixed_tokens = sum(row["token_count"] for row in incoming_rows)
+    if chat_request.system_prompt:
+        fixed_tokens += message_tokens(chat_request.system_prompt)
+    budget = history_budget(context_length, chat_request.max_tokens, fixed_tokens)
+    kept_history, context_report = fit_history(history, budget)
+    context_report.update(
+        {
+            "context_length": context_length or settings.context_default_length or None,
+            "budget": budget,
+            "fixed_tokens": fixed_tokens,
+            **media,
         }
-        return StreamingResponse(generate(), media_type="text/event-stream", headers=headers)
+    )
 
-    try:
-        provider_kwargs = _build_provider_kwargs(chat_request)
-        if provider_id not in ("openrouter", "gemini"):
-            provider_kwargs.pop("reasoning", None)
-            provider_kwargs.pop("modalities", None)
-            provider_kwargs.pop("image_config", None)
-
-        # Handle Seedream non-streaming if needed (though UI usually uses stream)
-        response_content, reasoning_content = await provider_client.chat(
-            model=model_id,
-            messages=api_messages,
-            **provider_kwargs,
+    api_messages = kept_history + [
+        {"role": r, "content": _format_api_content(c, i, v, a)}
+        for r, c, i, v, a in incoming_data
+    ]
+
+    if chat_request.system_prompt:
+        api_messages = (
+            [{"role": "system", "content": chat_request.system_prompt}] + api_messages
         )
 
-        response_content, think_text = _extract_think_tag(response_content)
-        if think_text:
-            reasoning_content = f"{reasoning_content or ''}{think_text}"
+    persisted = asyncio.ensure_future(
+        _store_incoming(chat_request, incoming_rows, token_counts, parent_id)
+    )
+    return persisted, provider_client, provider_id, model_id, api_messages, context_report
 
-        # Process images for non-streaming response
-        response_content, _ = await _localize_markdown_images(response_content)
 
-    except Exception as e:
+def _offload_incoming_media(incoming_data: list) -> list:
+    offloaded = []
+    for role, content, *media in incoming_data:
+        media = [offload_data_uris(items)[0] for items in media]
+        offloaded.append((role, content, *media))
+    return offloaded
+
+
+async def _store_incoming(
+    chat_request: ChatRequest, incoming_rows: list, token_counts: list, parent_id: Optional[int]
+):
+    session_id, new_items, start_leaf_id = await write_db(
+        _persist_incoming, chat_request, incoming_rows, token_counts, parent_id
+    )
+    if not chat_request.session_id:
+        put_context(session_id, new_items, signatures=True)
+    else:
+        for message_id, tokens, entry in new_items:
+            append_context(session_id, message_id, tokens, entry, parent_id=parent_id)
+            parent_id = message_id
+    if new_items:
+        parent_id = new_items[-1][0]
+    return session_id, parent_id, start_leaf_id
+
+
+def _regenerate_parent(db: Session, session_id: int, message_id: Optional[int]) -> int:
+    """
+    The message a regenerated reply answers: the parent of an assistant
+    message, else the message itself.
+    """
+    session = _get_session_or_404(db, session_id)
+    target_id = message_id if message_id is not None else session.active_leaf_id
+    target = None
+    if target_id is not None:
+        target = (
+            db.query(ChatMessage.id, ChatMessage.role, ChatMessage.parent_id)
+            .filter(ChatMessage.session_id == session_id, ChatMessage.id == target_id)
+            .first()
+        )
+    if target is None:
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Provider error: {str(e)}",
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Message {target_id} not found in session {session_id}",
         )
-
-    if not response_content:
+    if target.role != "assistant":
+        return target.id
+    if target.parent_id is None:
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Empty response from provider",
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Message {target.id} does not answer any message",
         )
+    return target.parent_id
 
-    try:
-        thought_signatures = None
-        search_results = None
-        if provider_id == "gemini":
-            thought_signatures = getattr(provider_client.client, "_last_thought_signatures", None)
-            search_results = getattr(provider_client.client, "_last_search_results", None)
-
-        assistant_message = ChatMessage(
-            session_id=session.id,
-            role="assistant",
-            content=response_content,
-            thought_process=reasoning_content if reasoning_content else None,
-            thought_signatures=thought_signatures,
-            search_results=search_results,
-            provider=provider_id,
-            model=model_id,
+
+def _load_history(db: Session, session_id: int, signatures: bool, upto: Optional[int] = None):
+    """
+    Load the stored conversation of a session: its active branch, or the
+    branch ending at `upto`. The active branch is cached.
+
+    Returns (leaf id, (token_count, message) history) and the token
+    estimates still to be stored for rows written before the column existed.
+    """
+    version = context_version(session_id)
+    session = _get_session_or_404(db, session_id)
+    leaf_id = upto if upto is not None else session.active_leaf_id
+    path = path_cte(leaf_id)
+    query = (
+        db.query(ChatMessage)
+        .join(path, path.c.id == ChatMessage.id)
+        .order_by(path.c.depth.desc())
+    )
+    if signatures:
+        query = query.options(undefer_group("signatures"))
+    existing_messages = query.all()
+    items = [_context_item(m) for m in existing_messages]
+    if upto is None and all(m.status != "partial" for m in existing_messages):
+        put_context(session_id, items, signatures=signatures, version=version)
+    token_counts = [
+        {"id": msg.id, "token_count": tokens}
+        for msg, (_, tokens, _) in zip(existing_messages, items)
+        if msg.token_count is None
+    ]
+    history = [(tokens, entry) for _, tokens, entry in items]
+    return (leaf_id if existing_messages else None, history), token_counts
+
+
+def _persist_incoming(
+    db: Session,
+    chat_request: ChatRequest,
+    incoming_rows: list,
+    token_counts: list,
+    parent_id: Optional[int] = None,
+):
+    """
+    Group-commit write: store the incoming messages as a chain below
+    `parent_id`, creating the session if needed. Returns the session id,
+    the context items of the new messages and the session's active leaf.
+    """
+    if chat_request.session_id:
+        session = _get_session_or_404(db, chat_request.session_id)
+    else:
+        session = ChatSession(
+            title=chat_request.title
+            or f"Chat {datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M')}",
+            provider=chat_request.provider,
+            model=chat_request.model,
         )
-        db.add(assistant_message)
-        session.provider = provider_id
-        session.model = model_id
+        db.add(session)
+        db.flush()
+
+    if token_counts:
+        db.execute(update(ChatMessage), token_counts)
+    messages = []
+    for row in incoming_rows:
+        message = ChatMessage(session_id=session.id, parent_id=parent_id, **row)
+        db.add(message)
+        db.flush()
+        messages.append(message)
+        parent_id = message.id
+    if messages:
+        session.active_leaf_id = parent_id
         session.updated_at = datetime.now(timezone.utc)
-        db.commit()
-        db.refresh(assistant_message)
-    except Exception:
+    db.flush()
+    return session.id, [_context_item(m) for m in messages], session.active_leaf_id
+
+
+def _get_session_or_404(db: Session, session_id: int) -> ChatSession:
+    session = db.query(ChatSession).filter(ChatSession.id == session_id).first()
+    if not session:
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Failed to save assistant message",
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Session {session_id} not found",
         )
+    return session
+
+
+def _start_stream(
+    chat_request: ChatRequest,
+    persisted: asyncio.Future,
+    provider_client,
+    provider_id: str,
+    model_id: str,
+    api_messages: list,
+    context_report: Optional[dict] = None,
+    received_at: Optional[float] = None,
+):
+    producer = functools.partial(
+        _stream_generation,
+        chat_request=chat_request,
+        persisted=persisted,
+        provider_client=provider_client,
+        provider_id=provider_id,
+        model_id=model_id,
+        api_messages=api_messages,
+        context_report=context_report,
+    )
+    return start_generation(chat_request.session_id, producer, started_at=received_at)
+
+
+def _sse_response(generation, last_event_id: int = 0, initial: bool = False) -> StreamingResponse:
+    headers = {
+        "Cache-Control": "no-cache",
+        "Connection": "keep-alive",
+        "X-Accel-Buffering": "no",
+        "X-Generation-Id": generation.id,
+    }
+    return StreamingResponse(
+        sse_events(generation, last_event_id, initial=initial),
+        media_type="text/event-stream",
+        headers=headers,
+    )
+
+
+async def _stream_generation(
+    generation,
+    chat_request: ChatRequest,
+    persisted: asyncio.Future,
+    provider_client,
+    provider_id: str,
+    model_id: str,
+    api_messages: list,
+    context_report: Optional[dict] = None,
+):
+    """
+    Run the upstream stream and publish its events to `generation`.
 
-    return ChatResponse(
-        session_id=session.id,
-        message=MessageResponse.model_validate(assistant_message),
+    The upstream request is sent first and the incoming messages are
+    committed meanwhile; nothing is published until they are durable.
+    """
+    provider_kwargs = _build_provider_kwargs(chat_request)
+    if provider_id not in ("openrouter", "gemini"):
+        provider_kwargs.pop("reasoning", None)
+        provider_kwargs.pop("modalities", None)
+        provider_kwargs.pop("image_config", None)
+    stream = provider_client.stream_chat(
+        model=model_id,
+        messages=api_messages,
+        **provider_kwargs,
     )
+    first_chunk = asyncio.ensure_future(stream.__anext__())
+
+    try:
+        session_id, parent_id, start_leaf_id = await persisted
+    except BaseException as e:
+        await _discard(first_chunk)
+        await _close_stream(stream)
+        if isinstance(e, asyncio.CancelledError):
+            raise
+        detail = e.detail if isinstance(e, HTTPException) else "Failed to save messages"
+        print(f"Error saving incoming messages: {e}")
+        await generation.publish({"error": detail})
+        return
+
+    generation.bind_session(session_id, parent_id)
+    await generation.publish({"session_id": session_id, "generation_id": generation.id})
+    if context_report:
+        await generation.publish({"context": context_report})
+
+    state = StreamState()
+    checkpoint = AssistantCheckpoint(session_id, provider_id, model_id, parent_id, start_leaf_id)
+    pipeline = build_stream_pipeline(state, checkpoint, generation)
+
+    try:
+        try:
+            async for chunk in _after_first(first_chunk, stream):
+                for event in await pipeline.feed(chunk):
+                    await generation.publish(event)
+                    if "error" in event:
+                        # The persist stage already saved the reply as aborted
+                        return
+        finally:
+            await _discard(first_chunk)
+            await _close_stream(stream)
+
+        for event in await pipeline.flush():
+            await generation.publish(event)
+
+    except asyncio.CancelledError:
+        await pipeline.abort()
+        raise
+    except Exception as e:
+        await pipeline.abort()
+        await generation.publish({"error": str(e)})
+        return
+
+    full_response = state.content
+    try:
+        if full_response:
+            full_response, _ = await _localize_markdown_images(full_response)
+            await checkpoint.finish(
+                full_response,
+                state.reasoning,
+                "complete",
+                thought_signatures=state.thought_signatures or None,
+                search_results=state.search_results or None,
+            )
+    except Exception as e:
+        print(f"Error saving assistant response: {e}")
+        await generation.publish({"error": "Failed to save assistant response"})
+
+
+async def _after_first(first_chunk: asyncio.Future, stream):
+    """Iterate `stream` whose first chunk is already being fetched by `first_chunk`."""
+    try:
+        chunk = await first_chunk
+    except StopAsyncIteration:
+        return
+    yield chunk
+    async for chunk in stream:
+        yield chunk
+
+
+async def _discard(task: asyncio.Future) -> None:
+    """Cancel `task` if still running and wait for it, ignoring its outcome."""
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+
+async def _close_stream(stream) -> None:
+    aclose = getattr(stream, "aclose", None)
+    if callable(aclose):
+        try:
+            await aclose()
+        except Exception:
+            pass
@@ -7,6 +7,9 @@ from typing import List, Optional, Tuple, Dict
 
 
 import httpx
+from sqlalchemy import inspect
+
+from context_budget import message_tokens
 
 
 def _ensure_list(data):
@@ -107,6 +110,49 @@ def _format_api_content(
     return parts
 
 
+def _loaded(msg, attribute: str):
+    """Attribute of a ChatMessage if it was loaded, None for deferred columns left unloaded."""
+    state = inspect(msg, raiseerr=False)
+    if state is not None and attribute in state.unloaded:
+        return None
+    return getattr(msg, attribute, None)
+
+
+def _context_entry(msg) -> Dict:
+    """
+    Provider-neutral api message for a stored ChatMessage.
+
+    Thought signatures are included only when they were loaded with the row.
+    """
+    return {
+        "role": msg.role,
+        "content": _format_api_content(
+            msg.content,
+            msg.images,
+            getattr(msg, "videos", None),
+            getattr(msg, "audios", None),
+        ),
+        "thought_signatures": _ensure_list(_loaded(msg, "thought_signatures")),
+    }
+
+
+def _message_token_count(msg) -> int:
+    """Stored token estimate of a ChatMessage, computed when the row predates it."""
+    if getattr(msg, "token_count", None) is not None:
+        return msg.token_count
+    return message_tokens(
+        msg.content,
+        _ensure_list(msg.images),
+        _ensure_list(getattr(msg, "videos", None)),
+        _ensure_list(getattr(msg, "audios", None)),
+    )
+
+
+def _context_item(msg) -> Tuple[int, int, Dict]:
+    """(message_id, token_count, api message) triple for the context cache."""
+    return msg.id, _message_token_count(msg), _context_entry(msg)
+
+
 def _extract_think_tag(content: str) -> Tuple[str, Optional[str]]:
     if not content:
         return content, None
@@ -122,41 +168,60 @@ def _extract_think_tag(content: str) -> Tuple[str, Optional[str]]:
     return cleaned, thinking_text
 
 
-def _strip_think_stream(content: str, state: Dict) -> Tuple[str, Optional[str]]:
-    text = f"{state.get('pending', '')}{content or ''}"
-    state["pending"] = ""
-    in_think = state.get("in_think", False)
-    output_parts: List[str] = []
-    reasoning_parts: List[str] = []
-    i = 0
-    while i < len(text):
-        if in_think:
-            close_idx = text.find("</think>", i)
-            if close_idx == -1:
-                tail_start = max(i, len(text) - 8)
-                reasoning_parts.append(text[i:tail_start])
-                state["pending"] = text[tail_start:]
-                state["in_think"] = True
-                return "".join(output_parts), "".join(reasoning_parts) or None
-            reasoning_parts.append(text[i:close_idx])
-            i = close_idx + 8
-            in_think = False
-            state["in_think"] = False
-        else:
-            open_idx = text.find("<think>", i)
-            if open_idx == -1:
-                tail_start = max(i, len(text) - 7)
-                output_parts.append(text[i:tail_start])
-                state["pending"] = text[tail_start:]
-                state["in_think"] = False
-                return "".join(output_parts), "".join(reasoning_parts) or None
-            output_parts.append(text[i:open_idx])
-            i = open_idx + 7
-            in_think = True
-            state["in_think"] = True
-    state["pending"] = ""
-    state["in_think"] = in_think
-    return "".join(output_parts), "".join(reasoning_parts) or None
+class ThinkTagSplitter:
+    """
+    Incremental splitter of streamed text into content and `<think>` reasoning.
+
+    Each chunk is scanned once. Only a trailing fragment that could still
+    become a tag (e.g. "<thi") is held back until the next chunk, so text
+    without tags passes through without delay.
+    """
+
+    OPEN = "<think>"
+    CLOSE = "</think>"
+
+    def __init__(self):
+        self.in_think = False
+        self._pending = ""
+
+    def feed(self, text: str) -> Tuple[str, str]:
+        """Split the next chunk; returns (content, reasoning) ready to emit."""
+        if self._pending:
+            text = self._pending + text
+            self._pending = ""
+        elif not self.in_think and "<" not in text:
+            return text, ""
+
+        content: List[str] = []
+        reasoning: List[str] = []
+        start = 0
+        while True:
+            tag = self.CLOSE if self.in_think else self.OPEN
+            out = reasoning if self.in_think else content
+            index = text.find(tag, start)
+            if index == -1:
+                end = len(text) - _partial_tag(text, start, tag)
+                out.append(text[start:end])
+                self._pending = text[end:]
+                return "".join(content), "".join(reasoning)
+            out.append(text[start:index])
+            start = index + len(tag)
+            self.in_think = not self.in_think
+
+    def flush(self) -> Tuple[str, str]:
+        """Release the held-back fragment at the end of the stream."""
+        pending, self._pending = self._pending, ""
+        return ("", pending) if self.in_think else (pending, "")
+
+
+def _partial_tag(text: str, start: int, tag: str) -> int:
+    """Length of the longest suffix of text[start:] that is a proper prefix of `tag`."""
+    index = text.find("<", max(start, len(text) - len(tag) + 1))
+    while index != -1:
+        if tag.startswith(text[index:]):
+            return len(text) - index
+        index = text.find("<", index + 1)
+    return 0
 
 
 def _build_provider_kwargs(chat_request):
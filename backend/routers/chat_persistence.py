@@ -0,0 +1,228 @@
+import asyncio
+import time
+from datetime import datetime, timezone
+from typing import List, Optional
+
+from sqlalchemy import func, select, update
+from sqlalchemy.orm import Session
+
+from compression import uncompressed
+from config import settings
+from context_budget import message_tokens
+from context_cache import append_context
+from database import ChatMessage, ChatSession
+from db_writer import write_db
+from search_sources import store_search_results
+from .chat_helpers import _context_entry
+
+
+def advance_active_leaf(
+    db: Session, session_id: int, start_leaf_id: Optional[int], message_id: int
+) -> None:
+    """
+    Make `message_id` the session's active leaf, unless the active leaf moved
+    away from `start_leaf_id` (the leaf the reply was started from) meanwhile,
+    e.g. because the user switched branches while a reply was generating.
+    """
+    db.execute(
+        update(ChatSession)
+        .where(
+            ChatSession.id == session_id,
+            ChatSession.active_leaf_id.is_not_distinct_from(start_leaf_id),
+        )
+        .values(active_leaf_id=message_id)
+    )
+
+
+class AssistantCheckpoint:
+    """
+    Incrementally persists a streamed assistant message.
+
+    The row is inserted with status 'partial' as soon as the first content
+    arrives and is then extended with batched appends, so a killed worker or a
+    disconnected client keeps everything generated so far. Writes go through
+    the group-commit writer, so checkpoints of concurrent streams share
+    transactions and the stream never blocks the event loop.
+
+    The reply is a child of `parent_id` and becomes the session's active leaf
+    when its row is inserted, if the active leaf is still `start_leaf_id`
+    (by default the parent). If the parent was deleted meanwhile (the branch
+    was truncated) nothing is stored.
+    """
+
+    def __init__(
+        self,
+        session_id: int,
+        provider_id: str,
+        model_id: str,
+        parent_id: Optional[int] = None,
+        start_leaf_id: Optional[int] = None,
+    ):
+        self.session_id = session_id
+        self.provider_id = provider_id
+        self.model_id = model_id
+        self.parent_id = parent_id
+        self.start_leaf_id = start_leaf_id if start_leaf_id is not None else parent_id
+        self.message_id: Optional[int] = None
+        # Set when the parent no longer exists; the reply is then discarded
+        self.detached = False
+        # The insert of the row; it outlives a cancelled caller
+        self._creating: Optional[asyncio.Future] = None
+        self._content_len = 0
+        self._reasoning_len = 0
+        self._pending = 0
+        self._last_flush = time.monotonic()
+
+    async def track(self, content: str, reasoning: str) -> None:
+        """Record that the accumulated stream grew; checkpoint when a batch is due."""
+        if self.detached:
+            return
+        if self.message_id is None:
+            if content:
+                await self._create(content, reasoning)
+            return
+
+        self._pending += 1
+        elapsed_ms = (time.monotonic() - self._last_flush) * 1000
+        if (
+            self._pending >= settings.stream_checkpoint_tokens
+            or elapsed_ms >= settings.stream_checkpoint_interval_ms
+        ):
+            await self._append(content, reasoning)
+
+    async def finish(
+        self,
+        content: str,
+        reasoning: str,
+        status: str,
+        thought_signatures: Optional[List[str]] = None,
+        search_results: Optional[List[dict]] = None,
+    ) -> Optional[int]:
+        """Write the final state of the message and mark it with `status`."""
+        if self.message_id is None:
+            if self.detached or not (content or self._creating):
+                return None
+            await self._create(content, reasoning)
+            if self.detached:
+                return None
+
+        values = {
+            "content": content,
+            "thought_process": reasoning or None,
+            "status": status,
+            "token_count": message_tokens(content),
+        }
+        if thought_signatures:
+            values["thought_signatures"] = thought_signatures
+        if await write_db(self._write_final, values, search_results):
+            # Skipped when the row was deleted or already finished meanwhile
+            append_context(
+                self.session_id,
+                self.message_id,
+                values["token_count"],
+                _context_entry(
+                    ChatMessage(
+                        role="assistant",
+                        content=content,
+                        thought_signatures=values.get("thought_signatures"),
+                    )
+                ),
+                parent_id=self.parent_id,
+            )
+        return self.message_id
+
+    def _own_row(self):
+        """Conditions matching the row while this checkpoint still owns it."""
+        return (
+            ChatMessage.id == self.message_id,
+            ChatMessage.session_id == self.session_id,
+            ChatMessage.status == "partial",
+        )
+
+    def _write_final(self, db: Session, values: dict, search_results: Optional[List[dict]]) -> bool:
+        result = db.execute(update(ChatMessage).where(*self._own_row()).values(**values))
+        if result.rowcount == 0:
+            return False
+        store_search_results(db, self.message_id, search_results)
+        db.execute(
+            update(ChatSession)
+            .where(ChatSession.id == self.session_id)
+            .values(
+                provider=self.provider_id,
+                model=self.model_id,
+                updated_at=datetime.now(timezone.utc),
+            )
+        )
+        return True
+
+    async def _create(self, content: str, reasoning: str) -> None:
+        """
+        Insert the row, or wait for the insert already under way.
+
+        The insert is shielded: if the stream is cancelled while it is queued
+        or running, it still completes, and finish() updates that row rather
+        than inserting a second one.
+        """
+        if self._creating is None:
+            self._creating = asyncio.ensure_future(self._insert_row(content, reasoning))
+        try:
+            await asyncio.shield(self._creating)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Failed inserts are retried by the next call
+            self._creating = None
+            raise
+
+    async def _insert_row(self, content: str, reasoning: str) -> None:
+        self.message_id = await write_db(self._insert, content, reasoning)
+        self.detached = self.message_id is None
+        self._mark_flushed(content, reasoning)
+
+    def _insert(self, db: Session, content: str, reasoning: str) -> Optional[int]:
+        if self.parent_id is not None and db.execute(
+            select(ChatMessage.id).where(
+                ChatMessage.id == self.parent_id, ChatMessage.session_id == self.session_id
+            )
+        ).scalar() is None:
+            return None
+        # Stored uncompressed until finish(): appends concatenate in SQL
+        message = ChatMessage(
+            session_id=self.session_id,
+            parent_id=self.parent_id,
+            role="assistant",
+            content=uncompressed(content),
+            thought_process=uncompressed(reasoning or None),
+            provider=self.provider_id,
+            model=self.model_id,
+            status="partial",
+        )
+        db.add(message)
+        db.flush()
+        if message.parent_id == message.id:
+            raise ValueError(f"message {message.id} would be its own parent")
+        advance_active_leaf(db, self.session_id, self.start_leaf_id, message.id)
+        return message.id
+
+    async def _append(self, content: str, reasoning: str) -> None:
+        content_delta = content[self._content_len:]
+        reasoning_delta = reasoning[self._reasoning_len:]
+        if content_delta or reasoning_delta:
+            values = {}
+            if content_delta:
+                values["content"] = ChatMessage.content + uncompressed(content_delta)
+            if reasoning_delta:
+                values["thought_process"] = func.coalesce(
+                    ChatMessage.thought_process, uncompressed("")
+                ) + uncompressed(reasoning_delta)
+            await write_db(self._update, values)
+        self._mark_flushed(content, reasoning)
+
+    def _update(self, db: Session, values: dict) -> None:
+        db.execute(update(ChatMessage).where(*self._own_row()).values(**values))
+
+    def _mark_flushed(self, content: str, reasoning: str) -> None:
+        self._content_len = len(content)
+        self._reasoning_len = len(reasoning)
+        self._pending = 0
+        self._last_flush = time.monotonic()
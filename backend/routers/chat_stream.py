@@ -0,0 +1,303 @@
+import asyncio
+import json
+import time
+from typing import Any, Dict, List, Optional
+
+from stage_timing import record_stage
+from .chat_helpers import ThinkTagSplitter, _localize_streaming_content
+from .chat_persistence import AssistantCheckpoint
+
+
+class StreamDelta:
+    """One step of a streamed reply as it moves through the stages."""
+
+    __slots__ = ("content", "reasoning", "search_results", "thought_signatures", "error", "done", "extra")
+
+    def __init__(
+        self,
+        content: Optional[str] = None,
+        reasoning: str = "",
+        search_results: Optional[list] = None,
+        thought_signatures: Optional[List[str]] = None,
+        error: Any = None,
+        done: bool = False,
+        extra: Optional[Dict] = None,
+    ):
+        self.content = content
+        self.reasoning = reasoning
+        self.search_results = search_results
+        self.thought_signatures = thought_signatures
+        self.error = error
+        self.done = done
+        self.extra = extra
+
+
+class StreamState:
+    """What the reply has accumulated so far."""
+
+    def __init__(self):
+        self.content = ""
+        self.reasoning = ""
+        self.search_results: List[dict] = []
+        # Signatures of the latest chunk that carried any (Gemini)
+        self.thought_signatures: List[str] = []
+
+
+class Stage:
+    """
+    One step of the pipeline. `feed` turns an item into zero or more items
+    for the next stage; `flush` releases anything held back at the end.
+
+    Errors in a `recoverable` stage are logged and the item passes on
+    unchanged; other errors end the stream.
+    """
+
+    name = "stage"
+    recoverable = True
+
+    async def feed(self, item) -> list:
+        return [item]
+
+    async def flush(self) -> list:
+        return []
+
+    async def abort(self) -> None:
+        """The stream ended early (cancelled or failed)."""
+
+
+class DecodeStage(Stage):
+    """Upstream SSE line -> StreamDelta."""
+
+    name = "decode"
+
+    async def feed(self, chunk: str) -> List[StreamDelta]:
+        try:
+            data = json.loads(chunk[6:])
+        except Exception as e:
+            print(f"Error processing chunk: {e}")
+            return []
+        if not isinstance(data, dict):
+            return []
+        search_results = data.pop("search_results", None)
+        if search_results is not None and not isinstance(search_results, list):
+            search_results = [search_results]
+        return [
+            StreamDelta(
+                content=data.pop("content", None),
+                reasoning=data.pop("reasoning", None) or "",
+                search_results=search_results,
+                thought_signatures=data.pop("thought_signatures", None),
+                error=data.pop("error", None),
+                done=bool(data.pop("done", False)),
+                extra=data or None,
+            )
+        ]
+
+
+class ThinkSplitStage(Stage):
+    """Moves `<think>` sections of the content into the reasoning."""
+
+    name = "think_split"
+
+    def __init__(self):
+        self.splitter = ThinkTagSplitter()
+
+    async def feed(self, delta: StreamDelta) -> List[StreamDelta]:
+        if delta.done or delta.error is not None:
+            # Anything held back by the scanner precedes the end of the stream
+            held = await self.flush()
+            return held + [delta]
+        if delta.content:
+            delta.content, think_text = self.splitter.feed(delta.content)
+            delta.reasoning += think_text
+        return [delta]
+
+    async def flush(self) -> List[StreamDelta]:
+        content, reasoning = self.splitter.flush()
+        if not content and not reasoning:
+            return []
+        return [StreamDelta(content=content or None, reasoning=reasoning)]
+
+
+class MediaLocalizeStage(Stage):
+    """Downloads images the content links to into uploads/."""
+
+    name = "media_localize"
+
+    async def feed(self, delta: StreamDelta) -> List[StreamDelta]:
+        if delta.content:
+            delta.content, _ = await _localize_streaming_content(delta.content)
+        return [delta]
+
+
+class CoalesceStage(Stage):
+    """One event per upstream chunk: empty deltas are dropped."""
+
+    name = "coalesce"
+
+    async def feed(self, delta: StreamDelta) -> List[StreamDelta]:
+        if delta.content == "":
+            delta.content = None
+        if (
+            delta.content is None
+            and not delta.reasoning
+            and delta.search_results is None
+            and not delta.thought_signatures
+            and delta.error is None
+            and not delta.done
+            and not delta.extra
+        ):
+            return []
+        return [delta]
+
+
+class AccumulateStage(Stage):
+    name = "accumulate"
+
+    def __init__(self, state: StreamState):
+        self.state = state
+
+    async def feed(self, delta: StreamDelta) -> List[StreamDelta]:
+        if delta.content:
+            self.state.content += delta.content
+        if delta.reasoning:
+            self.state.reasoning += delta.reasoning
+        if delta.search_results:
+            self.state.search_results.extend(delta.search_results)
+        if delta.thought_signatures:
+            self.state.thought_signatures = delta.thought_signatures
+        return [delta]
+
+
+class PersistStage(Stage):
+    """
+    Checkpoints the accumulated reply and announces its message id once the
+    row exists. An upstream error saves what was generated as 'aborted'.
+    """
+
+    name = "persist"
+    recoverable = False
+
+    def __init__(self, state: StreamState, checkpoint: AssistantCheckpoint, generation):
+        self.state = state
+        self.checkpoint = checkpoint
+        self.generation = generation
+        self._aborted = False
+
+    async def feed(self, delta: StreamDelta) -> List[StreamDelta]:
+        if delta.error is not None:
+            await self.abort()
+            return [delta]
+        await self.checkpoint.track(self.state.content, self.state.reasoning)
+        message_id = self.checkpoint.message_id
+        if self.generation.message_id is None and message_id is not None:
+            self.generation.bind_message(message_id)
+            return [StreamDelta(extra={"message_id": message_id}), delta]
+        return [delta]
+
+    async def abort(self) -> None:
+        if self._aborted:
+            return
+        self._aborted = True
+        try:
+            await self.checkpoint.finish(
+                self.state.content,
+                self.state.reasoning,
+                "aborted",
+                search_results=self.state.search_results or None,
+            )
+        except Exception as e:
+            print(f"Error saving partial assistant response: {e}")
+
+
+class EncodeStage(Stage):
+    """StreamDelta -> event published to subscribers (thought signatures stay server-side)."""
+
+    name = "encode"
+
+    async def feed(self, delta: StreamDelta) -> List[Dict]:
+        event: Dict[str, Any] = {}
+        if delta.extra:
+            event.update(delta.extra)
+        if delta.reasoning:
+            event["reasoning"] = delta.reasoning
+        if delta.content is not None:
+            event["content"] = delta.content
+        if delta.search_results is not None:
+            event["search_results"] = delta.search_results
+        if delta.error is not None:
+            event["error"] = delta.error
+        if delta.done:
+            event["done"] = True
+        return [event] if event else []
+
+
+class StreamPipeline:
+    """
+    Runs upstream chunks through a sequence of stages, timing every stage
+    call into the `stage_timing` histograms.
+    """
+
+    def __init__(self, stages: List[Stage]):
+        self.stages = stages
+
+    async def feed(self, item) -> list:
+        return await self._run([item], 0)
+
+    async def flush(self) -> list:
+        """Flush the stages in order, passing what each releases through the rest."""
+        events = []
+        for index, stage in enumerate(self.stages):
+            started = time.perf_counter()
+            released = await stage.flush()
+            record_stage(stage.name, time.perf_counter() - started)
+            if released:
+                events.extend(await self._run(released, index + 1))
+        return events
+
+    async def abort(self) -> None:
+        """Take in what the stages held back, without publishing it, then abort each stage."""
+        try:
+            await self.flush()
+        except Exception as e:
+            print(f"Error flushing stream pipeline: {e}")
+        for stage in self.stages:
+            await stage.abort()
+
+    async def _run(self, items: list, start: int) -> list:
+        for stage in self.stages[start:]:
+            produced = []
+            for item in items:
+                started = time.perf_counter()
+                try:
+                    produced.extend(await stage.feed(item))
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    if not stage.recoverable:
+                        raise
+                    print(f"Error processing chunk in {stage.name}: {e}")
+                    produced.append(item)
+                finally:
+                    record_stage(stage.name, time.perf_counter() - started)
+            items = produced
+            if not items:
+                break
+        return items
+
+
+def build_stream_pipeline(
+    state: StreamState, checkpoint: AssistantCheckpoint, generation
+) -> StreamPipeline:
+    """decode -> think_split -> media_localize -> coalesce -> accumulate -> persist -> encode"""
+    return StreamPipeline(
+        [
+            DecodeStage(),
+            ThinkSplitStage(),
+            MediaLocalizeStage(),
+            CoalesceStage(),
+            AccumulateStage(state),
+            PersistStage(state, checkpoint, generation),
+            EncodeStage(),
+        ]
+    )
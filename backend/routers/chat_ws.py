@@ -0,0 +1,216 @@
+import asyncio
+import json
+import time
+from typing import Dict
+
+from fastapi import APIRouter, HTTPException, WebSocket, WebSocketDisconnect
+from pydantic import ValidationError
+
+from config import settings
+from generation_registry import ReplayGapError, get_generation
+from models import ChatRequest
+from .chat import _prepare_chat, _start_stream
+
+
+router = APIRouter()
+
+
+class _Connection:
+    """Outbound side of one WebSocket carrying many generations."""
+
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        self.forwarders: Dict[str, asyncio.Task] = {}
+        self._send_lock = asyncio.Lock()
+
+    async def send(self, text: str) -> None:
+        # A slow socket blocks the forwarder, which stops advancing its
+        # cursor and so applies the generation's backpressure upstream.
+        async with self._send_lock:
+            await self.websocket.send_text(text)
+
+    async def send_json(self, data: Dict) -> None:
+        await self.send(json.dumps(data))
+
+    def forward(self, generation, last_event_id: int = 0, initial: bool = False) -> None:
+        previous = self.forwarders.pop(generation.id, None)
+        if previous is not None:
+            previous.cancel()
+        self.forwarders[generation.id] = asyncio.create_task(
+            self._forward(generation, last_event_id, initial)
+        )
+
+    async def _forward(self, generation, last_event_id: int, initial: bool) -> None:
+        prefix = json.dumps({"type": "event", "generation_id": generation.id})[:-1]
+        try:
+            async for event_id, data in generation.subscribe(last_event_id, initial=initial):
+                # Same payload as the SSE `data:` field, tagged with the generation id
+                await self.send(f'{prefix}, "id": {event_id}, "data": {data}}}')
+            await self.send_json({"type": "end", "generation_id": generation.id})
+        except ReplayGapError as e:
+            await self.send_json(
+                {"type": "error", "generation_id": generation.id, "error": str(e)}
+            )
+        except (WebSocketDisconnect, RuntimeError):
+            pass
+        finally:
+            if self.forwarders.get(generation.id) is asyncio.current_task():
+                self.forwarders.pop(generation.id, None)
+
+    def close(self) -> None:
+        for task in self.forwarders.values():
+            task.cancel()
+        self.forwarders.clear()
+
+
+@router.websocket(f"{settings.api_prefix}/chat/ws")
+async def chat_websocket(websocket: WebSocket):
+    """
+    Multiplexed chat transport
+
+    Client messages:
+        {"type": "start", "request_id": ..., "request": {<ChatRequest>}}
+        {"type": "attach", "generation_id": ..., "last_event_id": 0}
+        {"type": "cancel", "generation_id": ...}
+
+    Server messages:
+        {"type": "started", "request_id": ..., "generation_id": ..., "session_id": ...}
+        {"type": "event", "generation_id": ..., "id": <event id>, "data": {<SSE payload>}}
+        {"type": "end", "generation_id": ...}
+        {"type": "error", "request_id"/"generation_id": ..., "error": ...}
+    """
+    await websocket.accept()
+    connection = _Connection(websocket)
+    try:
+        while True:
+            try:
+                message = json.loads(await websocket.receive_text())
+            except json.JSONDecodeError:
+                await connection.send_json({"type": "error", "error": "Invalid JSON"})
+                continue
+            if not isinstance(message, dict):
+                await connection.send_json({"type": "error", "error": "Expected a JSON object"})
+                continue
+
+            msg_type = message.get("type")
+            if msg_type == "start":
+                await _handle_start(connection, message)
+            elif msg_type == "attach":
+                await _handle_attach(connection, message)
+            elif msg_type == "cancel":
+                await _handle_cancel(connection, message)
+            else:
+                await connection.send_json(
+                    {"type": "error", "error": f"Unknown message type: {msg_type}"}
+                )
+    except WebSocketDisconnect:
+        pass
+    finally:
+        connection.close()
+
+
+async def _handle_start(connection: _Connection, message: Dict) -> None:
+    request_id = message.get("request_id")
+    request = message.get("request") or {}
+    if not isinstance(request, dict):
+        await connection.send_json(
+            {"type": "error", "request_id": request_id, "error": "request must be a JSON object"}
+        )
+        return
+    try:
+        chat_request = ChatRequest(**request)
+        chat_request.stream = True
+    except ValidationError as e:
+        await connection.send_json(
+            {"type": "error", "request_id": request_id, "error": json.loads(e.json())}
+        )
+        return
+
+    received_at = time.monotonic()
+    try:
+        (
+            persisted,
+            provider_client,
+            provider_id,
+            model_id,
+            api_messages,
+            context_report,
+        ) = await _prepare_chat(chat_request)
+        generation = _start_stream(
+            chat_request,
+            persisted,
+            provider_client,
+            provider_id,
+            model_id,
+            api_messages,
+            context_report,
+            received_at=received_at,
+        )
+    except HTTPException as e:
+        await connection.send_json(
+            {"type": "error", "request_id": request_id, "error": e.detail}
+        )
+        return
+    except Exception as e:
+        # Fails this request only; other generations on the socket keep streaming
+        print(f"Error starting chat over WebSocket: {e}")
+        await connection.send_json(
+            {"type": "error", "request_id": request_id, "error": f"Failed to start chat: {e}"}
+        )
+        return
+
+    await connection.send_json(
+        {
+            "type": "started",
+            "request_id": request_id,
+            "generation_id": generation.id,
+            # None for a new chat; its first stream event carries the id
+            "session_id": chat_request.session_id,
+        }
+    )
+    connection.forward(generation, initial=True)
+
+
+async def _handle_attach(connection: _Connection, message: Dict) -> None:
+    generation_id = message.get("generation_id")
+    generation = get_generation(generation_id) if isinstance(generation_id, str) else None
+    if not generation:
+        await connection.send_json(
+            {
+                "type": "error",
+                "generation_id": generation_id,
+                "error": f"Generation {generation_id} not found",
+            }
+        )
+        return
+
+    try:
+        last_event_id = int(message.get("last_event_id") or 0)
+    except (TypeError, ValueError):
+        last_event_id = -1
+    if last_event_id < 0 or not generation.can_replay(last_event_id):
+        await connection.send_json(
+            {
+                "type": "error",
+                "generation_id": generation_id,
+                "error": f"Events after {message.get('last_event_id')} are no longer buffered",
+            }
+        )
+        return
+    connection.forward(generation, last_event_id)
+
+
+async def _handle_cancel(connection: _Connection, message: Dict) -> None:
+    generation_id = message.get("generation_id")
+    generation = get_generation(generation_id) if isinstance(generation_id, str) else None
+    if not generation:
+        await connection.send_json(
+            {
+                "type": "error",
+                "generation_id": generation_id,
+                "error": f"Generation {generation_id} not found",
+            }
+        )
+        return
+    # Cancelling the task closes the provider stream and saves the partial reply
+    generation.cancel()
@@ -0,0 +1,18 @@
+from fastapi import APIRouter
+
+from config import settings
+from database import pool_stats
+from db_writer import writer
+
+
+router = APIRouter()
+
+
+@router.get(f"{settings.api_prefix}/db/stats")
+async def get_db_stats():
+    """Connection pool usage and group-commit write metrics"""
+    return {
+        "pool": pool_stats(),
+        "group_commit": settings.db_group_commit,
+        "writer": writer.stats(),
+    }
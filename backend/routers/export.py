@@ -0,0 +1,435 @@
+import asyncio
+import base64
+import json
+import os
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Optional, Set
+
+from fastapi import APIRouter, HTTPException, Query, Request, status
+from fastapi.responses import StreamingResponse
+from sqlalchemy import insert, update
+from sqlalchemy.orm import Session, undefer_group
+
+from config import settings
+from database import ChatMessage, ChatSession, SessionLocal, run_db
+from search_sources import load_search_results, store_search_results
+from upload_store import is_upload_name, upload_refs
+
+
+# 2: messages carry their id and parent_id, sessions their active_leaf_id
+EXPORT_FORMAT_VERSION = 2
+
+_MESSAGE_FIELDS = (
+    "role",
+    "content",
+    "images",
+    "videos",
+    "audios",
+    "thought_process",
+    "thought_signatures",
+    "search_results",
+    "provider",
+    "model",
+    "status",
+    "token_count",
+)
+
+
+def _line(record: Dict) -> bytes:
+    return (json.dumps(record, ensure_ascii=False, default=_json_default) + "\n").encode("utf-8")
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+
+def _parse_datetime(value) -> Optional[datetime]:
+    if not value:
+        return None
+    return datetime.fromisoformat(value)
+
+
+def _session_batch(db: Session, session_ids: Optional[List[int]], after_id: int) -> List[Dict]:
+    """Export records of the next batch of sessions after `after_id`."""
+    query = db.query(ChatSession).filter(ChatSession.id > after_id)
+    if session_ids:
+        query = query.filter(ChatSession.id.in_(session_ids))
+    return [
+        {
+            "type": "session",
+            "id": session.id,
+            "title": session.title,
+            "provider": session.provider,
+            "model": session.model,
+            "created_at": session.created_at,
+            "updated_at": session.updated_at,
+            "active_leaf_id": session.active_leaf_id,
+        }
+        for session in query.order_by(ChatSession.id.asc()).limit(settings.export_batch_size)
+    ]
+
+
+def _message_ids(db: Session, session_id: int) -> List[int]:
+    """Ids of a session's messages in conversation order."""
+    rows = (
+        db.query(ChatMessage.id)
+        .filter(ChatMessage.session_id == session_id)
+        .order_by(ChatMessage.created_at.asc(), ChatMessage.id.asc())
+    )
+    return [message_id for (message_id,) in rows]
+
+
+def _message_batch(db: Session, session_id: int, message_ids: List[int]) -> List[Dict]:
+    """Export records of the given messages, in the order of `message_ids`."""
+    search_results = load_search_results(db, ChatMessage.id.in_(message_ids))
+    messages = {
+        msg.id: msg
+        for msg in db.query(ChatMessage)
+        .options(undefer_group("details"), undefer_group("signatures"))
+        .filter(ChatMessage.id.in_(message_ids))
+    }
+    records = []
+    for message_id in message_ids:
+        msg = messages.get(message_id)
+        if msg is None:  # deleted since the ids were read
+            continue
+        record = {
+            "type": "message",
+            "session_id": session_id,
+            "id": msg.id,
+            "parent_id": msg.parent_id,
+        }
+        record.update({field: getattr(msg, field) for field in _MESSAGE_FIELDS})
+        record["search_results"] = search_results.get(msg.id) or msg.search_results
+        record["created_at"] = msg.created_at
+        records.append(record)
+    return records
+
+
+def get_router(upload_dir: str) -> APIRouter:
+    router = APIRouter()
+
+    @router.get(f"{settings.api_prefix}/export")
+    async def export_sessions(
+        session_id: Optional[List[int]] = Query(None),
+        include_media: bool = False,
+    ):
+        """
+        Export sessions as NDJSON: a header line, then each session followed by its messages
+
+        Args:
+            session_id: Sessions to export (repeatable); all sessions when omitted
+            include_media: Also embed referenced files from uploads/ as base64 `media` lines
+        """
+        filename = f"chat-export-{datetime.now(timezone.utc).strftime('%Y%m%d-%H%M%S')}.ndjson"
+        return StreamingResponse(
+            _export_lines(session_id, include_media),
+            media_type="application/x-ndjson",
+            headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+        )
+
+    def _export_lines(session_ids: Optional[List[int]], include_media: bool) -> Iterator[bytes]:
+        # A sync generator: Starlette advances it on its thread pool. Rows are
+        # read a batch at a time, each batch in its own short session, so a
+        # slow download neither pins a pooled connection nor holds a read
+        # transaction open between batches
+        yield _line(
+            {
+                "type": "header",
+                "version": EXPORT_FORMAT_VERSION,
+                "exported_at": datetime.now(timezone.utc),
+            }
+        )
+        exported_media: Set[str] = set()
+        after_id = 0
+        while True:
+            with SessionLocal() as db:
+                sessions = _session_batch(db, session_ids, after_id)
+            if not sessions:
+                break
+            after_id = sessions[-1]["id"]
+            for session in sessions:
+                yield _line(session)
+                with SessionLocal() as db:
+                    message_ids = _message_ids(db, session["id"])
+                for i in range(0, len(message_ids), settings.export_batch_size):
+                    with SessionLocal() as db:
+                        records = _message_batch(
+                            db, session["id"], message_ids[i:i + settings.export_batch_size]
+                        )
+                    for record in records:
+                        if include_media:
+                            for name in sorted(
+                                upload_refs(
+                                    record["content"],
+                                    record["images"],
+                                    record["videos"],
+                                    record["audios"],
+                                )
+                                - exported_media
+                            ):
+                                exported_media.add(name)
+                                media = _media_line(name)
+                                if media:
+                                    yield media
+                        yield _line(record)
+
+    def _media_line(name: str) -> Optional[bytes]:
+        path = os.path.join(upload_dir, name)
+        if not os.path.isfile(path):
+            return None
+        with open(path, "rb") as f:
+            data = base64.b64encode(f.read()).decode("ascii")
+        return _line({"type": "media", "name": name, "data": data})
+
+    @router.post(f"{settings.api_prefix}/import")
+    async def import_sessions(request: Request):
+        """
+        Import an NDJSON export as new sessions
+
+        The body is read as a stream and written in batched transactions of
+        `import_batch_size` records. Imported sessions get new ids; `media`
+        lines are restored into uploads/ unless a file of that name exists.
+        """
+        state = {
+            "session_ids": {},
+            "sessions": 0,
+            "messages": 0,
+            "media": 0,
+            # Tree bookkeeping across batches (see _import_batch)
+            "message_ids": {},
+            "last_keys": {},
+            "leaf_keys": {},
+            "updated_at": {},
+        }
+        batch: List[Dict] = []
+        buffer = bytearray()
+        line_no = 0
+
+        async def handle(raw: bytes) -> None:
+            nonlocal line_no
+            line_no += 1
+            record = _parse_record(raw, line_no)
+            if record is None:
+                return
+            if record.get("type") == "media":
+                await asyncio.to_thread(_restore_media, record, line_no)
+                state["media"] += 1
+                return
+            batch.append(record)
+            if len(batch) >= settings.import_batch_size:
+                await flush()
+
+        async def flush() -> None:
+            if batch:
+                await run_db(_import_batch, list(batch), state)
+                batch.clear()
+
+        # Media lines can be large; only scan bytes not searched before
+        scanned = 0
+        async for chunk in request.stream():
+            buffer.extend(chunk)
+            while True:
+                end = buffer.find(b"\n", scanned)
+                if end < 0:
+                    scanned = len(buffer)
+                    break
+                raw = bytes(buffer[:end])
+                del buffer[: end + 1]
+                scanned = 0
+                await handle(raw)
+        await handle(bytes(buffer))
+        await flush()
+
+        return {
+            "sessions": state["sessions"],
+            "messages": state["messages"],
+            "media": state["media"],
+            "session_ids": state["session_ids"],
+        }
+
+    def _restore_media(record: Dict, line_no: int) -> None:
+        name = record.get("name") or ""
+        if not is_upload_name(name):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Line {line_no}: invalid media name",
+            )
+        path = os.path.join(upload_dir, name)
+        if os.path.exists(path):
+            return
+        try:
+            data = base64.b64decode(record.get("data") or "", validate=True)
+        except ValueError:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Line {line_no}: invalid media data",
+            )
+        with open(path, "wb") as f:
+            f.write(data)
+
+    return router
+
+
+def _parse_record(raw: bytes, line_no: int) -> Optional[Dict]:
+    raw = raw.strip()
+    if not raw:
+        return None
+    try:
+        record = json.loads(raw)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Line {line_no}: invalid JSON",
+        )
+    if not isinstance(record, dict):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Line {line_no}: expected an object",
+        )
+    if record.get("type") == "header":
+        version = record.get("version", 1)
+        if not isinstance(version, int) or isinstance(version, bool) or version > EXPORT_FORMAT_VERSION:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Line {line_no}: unsupported export version {version!r}",
+            )
+    error = _record_error(record)
+    if error:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Line {line_no}: {error}",
+        )
+    return record
+
+
+def _record_error(record: Dict) -> Optional[str]:
+    """What keeps a session or message record from being imported, if anything."""
+    kind = record.get("type")
+    if kind not in ("session", "message"):
+        return None
+    for field in ("id", "session_id", "parent_id", "active_leaf_id"):
+        if isinstance(record.get(field), (dict, list)):
+            return f"invalid {field}"
+    for field in ("created_at", "updated_at"):
+        try:
+            _parse_datetime(record.get(field))
+        except (TypeError, ValueError):
+            return f"invalid {field} {record.get(field)!r}"
+    if kind == "message":
+        role = record.get("role")
+        if not role or not isinstance(role, str):
+            return "message without a role"
+        content = record.get("content")
+        if content is not None and not isinstance(content, str):
+            return "message content must be a string"
+    return None
+
+
+def _import_batch(db: Session, records: List[Dict], state: Dict) -> None:
+    """
+    Insert one batch of session/message records in a single transaction.
+
+    Message trees are rebuilt from the exported ids: every message gets a
+    key (its exported id, or its position for version 1 exports, which are
+    linear) and parents and active leaves are resolved to the new ids once
+    the rows exist.
+    """
+    session_ids: Dict[int, int] = state["session_ids"]
+    message_ids: Dict = state["message_ids"]
+    last_keys: Dict[int, object] = state["last_keys"]
+    leaf_keys: Dict[int, object] = state["leaf_keys"]
+    updated_at: Dict[int, datetime] = state["updated_at"]
+    messages: List[Dict] = []
+    parents: List = []
+    touched: Set[int] = set()
+
+    def remember(keys: List, new_ids: List[int]) -> None:
+        for key, new_id in zip(keys, new_ids):
+            message_ids[key] = new_id
+
+    def write_messages():
+        if messages:
+            keys = [row.pop("_key") for row in messages]
+            new_ids = db.execute(
+                insert(ChatMessage).returning(ChatMessage.id, sort_by_parameter_order=True),
+                messages,
+            ).scalars().all()
+            remember(keys, new_ids)
+            state["messages"] += len(messages)
+            messages.clear()
+
+    for record in records:
+        kind = record.get("type")
+        if kind == "session":
+            # Messages reference the new id, so earlier ones must be written first
+            write_messages()
+            session = ChatSession(
+                title=record.get("title") or "Imported chat",
+                provider=record.get("provider") or "",
+                model=record.get("model") or "",
+            )
+            for field in ("created_at", "updated_at"):
+                value = _parse_datetime(record.get(field))
+                if value is not None:
+                    setattr(session, field, value)
+            db.add(session)
+            db.flush()
+            session_ids[record.get("id")] = session.id
+            updated_at[session.id] = session.updated_at
+            if record.get("active_leaf_id") is not None:
+                leaf_keys[session.id] = ("id", record["active_leaf_id"])
+            state["sessions"] += 1
+        elif kind == "message":
+            session_id = session_ids.get(record.get("session_id"))
+            if session_id is None:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail=f"Message refers to unknown session {record.get('session_id')}",
+                )
+            if "id" in record:
+                key = ("id", record["id"])
+                parent_key = ("id", record["parent_id"]) if record.get("parent_id") is not None else None
+            else:
+                key = ("line", state["messages"] + len(messages))
+                parent_key = last_keys.get(session_id)
+            last_keys[session_id] = key
+            touched.add(session_id)
+            parents.append((key, parent_key))
+
+            row = {field: record.get(field) for field in _MESSAGE_FIELDS}
+            row["session_id"] = session_id
+            row["content"] = row["content"] or ""
+            row["status"] = row["status"] or "complete"
+            row["created_at"] = _parse_datetime(record.get("created_at")) or datetime.now(timezone.utc)
+            search_results = row.pop("search_results")
+            if search_results:
+                # Needs the new message id, so it cannot join the batched insert
+                write_messages()
+                message_id = db.execute(insert(ChatMessage).values(**row)).inserted_primary_key[0]
+                store_search_results(db, message_id, search_results)
+                remember([key], [message_id])
+                state["messages"] += 1
+            else:
+                row["_key"] = key
+                messages.append(row)
+    write_messages()
+
+    links = [
+        {"id": message_ids[key], "parent_id": message_ids[parent_key]}
+        for key, parent_key in parents
+        if parent_key is not None and key in message_ids and parent_key in message_ids
+    ]
+    if links:
+        db.execute(update(ChatMessage), links)
+    leaves = []
+    for session_id in touched:
+        leaf = message_ids.get(leaf_keys.get(session_id, last_keys[session_id]))
+        if leaf is not None:
+            # Given explicitly, or setting the leaf would stamp the session as updated now
+            leaves.append({"id": session_id, "active_leaf_id": leaf, "updated_at": updated_at[session_id]})
+    if leaves:
+        db.execute(update(ChatSession), leaves)
+    db.commit()
@@ -0,0 +1,119 @@
+from typing import Optional
+
+from fastapi import APIRouter, HTTPException, Query, status
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from config import settings
+from database import run_db
+from models import SearchHit, SearchResponse
+from pagination import InvalidCursorError, decode_cursor, encode_cursor
+
+
+router = APIRouter()
+
+# Column numbers in chat_messages_fts
+_CONTENT_COLUMN = 0
+_ANY_COLUMN = -1
+
+
+def _match_expression(q: str, include_reasoning: bool) -> str:
+    """Turn free text into an FTS5 query: every word must match, no operators."""
+    terms = ['"{}"'.format(term.replace('"', '""')) for term in q.split()]
+    if not terms:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Search query is empty",
+        )
+    expression = " ".join(terms)
+    if include_reasoning:
+        return expression
+    return f"{{content}} : ({expression})"
+
+
+@router.get(f"{settings.api_prefix}/search", response_model=SearchResponse)
+async def search_messages(
+    q: str,
+    limit: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = None,
+    session_id: Optional[int] = None,
+    include_reasoning: bool = False,
+):
+    """
+    Full-text search over message history, best matches first
+
+    Args:
+        q: Words to search for; all of them must appear
+        limit: Maximum number of hits to return
+        cursor: `next_cursor` from the previous page
+        session_id: Only search this session
+        include_reasoning: Also match reasoning/thinking content
+    """
+    match = _match_expression(q, include_reasoning)
+    after = None
+    if cursor:
+        try:
+            score, message_id = decode_cursor(cursor, 2)
+            after = (float(score), int(message_id))
+        except (InvalidCursorError, TypeError, ValueError) as e:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+    return await run_db(_search, match, limit, after, session_id, include_reasoning)
+
+
+def _search(
+    db: Session,
+    match: str,
+    limit: int,
+    after: Optional[tuple],
+    session_id: Optional[int],
+    include_reasoning: bool,
+) -> SearchResponse:
+    filters = ""
+    params = {
+        "match": match,
+        "limit": limit + 1,
+        "column": _ANY_COLUMN if include_reasoning else _CONTENT_COLUMN,
+    }
+    if session_id is not None:
+        filters += " AND m.session_id = :session_id"
+        params["session_id"] = session_id
+    if after is not None:
+        # Keyset on (rank, rowid); bm25 ranks are negative, best first
+        filters += (
+            " AND (chat_messages_fts.rank > :after_rank"
+            " OR (chat_messages_fts.rank = :after_rank AND chat_messages_fts.rowid > :after_id))"
+        )
+        params["after_rank"], params["after_id"] = after
+
+    rows = db.execute(
+        text(
+            "SELECT chat_messages_fts.rowid, chat_messages_fts.rank, "
+            "snippet(chat_messages_fts, :column, '<mark>', '</mark>', '…', 16), "
+            "m.session_id, m.role, m.created_at, s.title "
+            "FROM chat_messages_fts "
+            "JOIN chat_messages AS m ON m.id = chat_messages_fts.rowid "
+            "JOIN chat_sessions AS s ON s.id = m.session_id "
+            f"WHERE chat_messages_fts MATCH :match{filters} "
+            "ORDER BY chat_messages_fts.rank, chat_messages_fts.rowid LIMIT :limit"
+        ),
+        params,
+    ).all()
+
+    hits = [
+        SearchHit(
+            message_id=row[0],
+            score=row[1],
+            snippet=row[2] or "",
+            session_id=row[3],
+            role=row[4],
+            created_at=row[5],
+            session_title=row[6],
+        )
+        for row in rows[:limit]
+    ]
+    next_cursor = None
+    if len(rows) > limit:
+        last = hits[-1]
+        next_cursor = encode_cursor(last.score, last.message_id)
+    return SearchResponse(hits=hits, next_cursor=next_cursor)
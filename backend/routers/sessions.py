@@ -1,34 +1,99 @@
 import json
+import time
 from datetime import datetime, timezone
-from typing import List
+from typing import Dict, Iterable, List, Literal, Optional, Set, Tuple
 
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, BackgroundTasks, HTTPException, Query, Response, status
+from sqlalchemy import exists, select, tuple_
+from sqlalchemy.orm import Session, undefer_group
 
 from config import settings
-from database import get_db, ChatSession, ChatMessage
-from models import SessionCreate, SessionUpdate, SessionResponse, SessionDetailResponse, MessageResponse
+from context_cache import context_version, invalidate_context, put_context
+from database import run_db, ChatSession, ChatMessage, MessageSource
+from generation_registry import cancel_generations, get_session_generation, running_generations
+from message_tree import branch_lengths, newest_leaf, path_cte, sibling_ids, subtree_ids
+from upload_store import collect_upload_refs, remove_unreferenced_uploads
+from search_sources import load_search_results
+from pagination import InvalidCursorError, decode_cursor, encode_cursor, parse_cursor_datetime
+from models import (
+    SessionCreate,
+    SessionUpdate,
+    SessionResponse,
+    SessionDetailResponse,
+    MessageResponse,
+    MessagePageResponse,
+    ForkRequest,
+    BranchSwitchRequest,
+)
+from .chat_helpers import _context_item
 
 
 router = APIRouter()
 
 
+def _get_session_or_404(db: Session, session_id: int) -> ChatSession:
+    session = db.query(ChatSession).filter(ChatSession.id == session_id).first()
+
+    if not session:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Session {session_id} not found",
+        )
+    return session
+
+
+def _message_counts(db: Session, session_ids: Iterable[int]) -> Dict[int, int]:
+    """
+    Count the messages of several sessions' active branches, as the session
+    detail does, with one query and without loading rows.
+    """
+    return branch_lengths(db, session_ids)
+
+
 @router.get(f"{settings.api_prefix}/sessions", response_model=List[SessionResponse])
-async def get_sessions(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
+async def get_sessions(
+    response: Response,
+    skip: int = 0,
+    limit: int = 100,
+    cursor: Optional[str] = None,
+):
     """
-    Get list of chat sessions
+    Get list of chat sessions, most recently updated first
 
     Args:
-        skip: Number of records to skip
+        skip: Number of records to skip (ignored when `cursor` is given)
         limit: Maximum number of records to return
+        cursor: Opaque cursor from the previous page's `X-Next-Cursor` header
     """
-    sessions = (
-        db.query(ChatSession)
-        .order_by(ChatSession.updated_at.desc())
-        .offset(skip)
-        .limit(limit)
-        .all()
+    after = None
+    if cursor:
+        try:
+            updated_at, session_id = decode_cursor(cursor, 2)
+            after = (parse_cursor_datetime(updated_at), int(session_id))
+        except (InvalidCursorError, TypeError, ValueError) as e:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+    sessions = await run_db(_list_sessions, skip, limit, after)
+    if limit > 0 and len(sessions) == limit:
+        last = sessions[-1]
+        response.headers["X-Next-Cursor"] = encode_cursor(last.updated_at, last.id)
+    return sessions
+
+
+def _list_sessions(
+    db: Session, skip: int, limit: int, after: Optional[Tuple[datetime, int]] = None
+) -> List[SessionResponse]:
+    query = db.query(ChatSession).order_by(
+        ChatSession.updated_at.desc(), ChatSession.id.desc()
     )
+    if after is not None:
+        # Keyset: resume strictly after the last row of the previous page
+        query = query.filter(tuple_(ChatSession.updated_at, ChatSession.id) < after)
+    else:
+        query = query.offset(skip)
+    sessions = query.limit(limit).all()
+
+    counts = _message_counts(db, (session.id for session in sessions))
 
     result = []
     for session in sessions:
@@ -39,7 +104,7 @@ async def get_sessions(skip: int = 0, limit: int = 100, db: Session = Depends(ge
             "model": session.model,
             "created_at": session.created_at,
             "updated_at": session.updated_at,
-            "message_count": len(session.messages),
+            "message_count": counts.get(session.id, 0),
         }
         result.append(SessionResponse(**session_dict))
 
@@ -50,44 +115,96 @@ async def get_sessions(skip: int = 0, limit: int = 100, db: Session = Depends(ge
     f"{settings.api_prefix}/sessions/{{session_id}}",
     response_model=SessionDetailResponse,
 )
-async def get_session_detail(session_id: int, db: Session = Depends(get_db)):
+async def get_session_detail(session_id: int):
     """
     Get detailed information about a specific session including messages
 
     Args:
         session_id: The session ID
     """
-    session = db.query(ChatSession).filter(ChatSession.id == session_id).first()
+    detail = await run_db(_load_session_detail, session_id)
+    generation = get_session_generation(session_id)
+    if generation and not generation.done:
+        detail.active_generation_id = generation.id
+    return detail
 
-    if not session:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"Session {session_id} not found",
+
+def _json_list(value):
+    if isinstance(value, str):
+        return json.loads(value) if value else []
+    return value
+
+
+def _message_response(
+    msg: ChatMessage,
+    has_details: Optional[bool] = None,
+    search_results: Optional[Dict[int, List[Dict]]] = None,
+    siblings: Optional[Dict[int, List[int]]] = None,
+) -> MessageResponse:
+    """
+    Build the API view of a message.
+
+    `has_details` marks a summary view: reasoning and search results were not
+    loaded and are left empty. Otherwise `search_results` holds the results
+    loaded for the page (load_search_results); older rows keep theirs inline.
+    `siblings` maps messages to their alternatives (sibling_ids).
+    """
+    msg_dict = {
+        "id": msg.id,
+        "parent_id": msg.parent_id,
+        "sibling_ids": (siblings or {}).get(msg.id, []),
+        "role": msg.role,
+        "content": msg.content,
+        "provider": msg.provider,
+        "model": msg.model,
+        "status": msg.status,
+        "created_at": msg.created_at,
+        "images": _json_list(msg.images),
+        "videos": _json_list(msg.videos),
+        "audios": _json_list(msg.audios),
+    }
+    if has_details is None:
+        msg_dict["thought_process"] = msg.thought_process
+        msg_dict["search_results"] = (search_results or {}).get(msg.id) or _json_list(
+            msg.search_results
         )
+    else:
+        msg_dict["has_details"] = has_details
+    return MessageResponse(**msg_dict)
+
+
+def _load_session_detail(db: Session, session_id: int) -> SessionDetailResponse:
+    """The session with the messages of its active branch."""
+    version = context_version(session_id)
+    session = _get_session_or_404(db, session_id)
 
-    session_messages = (
+    signatures = session.provider == "gemini"
+    path = path_cte(session.active_leaf_id)
+    query = (
         db.query(ChatMessage)
-        .filter(ChatMessage.session_id == session_id)
-        .order_by(ChatMessage.created_at.asc())
-        .all()
+        .options(undefer_group("details"))
+        .join(path, path.c.id == ChatMessage.id)
+        .order_by(path.c.depth.desc())
     )
-
-    processed_messages = []
-    for msg in session_messages:
-        msg_dict = {
-            "id": msg.id,
-            "role": msg.role,
-            "content": msg.content,
-            "provider": msg.provider,
-            "model": msg.model,
-            "thought_process": msg.thought_process,
-            "created_at": msg.created_at,
-            "images": msg.images if not isinstance(msg.images, str) else (json.loads(msg.images) if msg.images else []),
-            "videos": msg.videos if not isinstance(msg.videos, str) else (json.loads(msg.videos) if msg.videos else []),
-            "audios": msg.audios if not isinstance(msg.audios, str) else (json.loads(msg.audios) if msg.audios else []),
-            "search_results": msg.search_results if not isinstance(msg.search_results, str) else (json.loads(msg.search_results) if msg.search_results else []),
-        }
-        processed_messages.append(MessageResponse(**msg_dict))
+    if signatures:
+        query = query.options(undefer_group("signatures"))
+    session_messages = query.all()
+    search_results = load_search_results(db, ChatMessage.id.in_(select(path.c.id)))
+    siblings = sibling_ids(db, session_id, session_messages)
+
+    processed_messages = [
+        _message_response(msg, search_results=search_results, siblings=siblings)
+        for msg in session_messages
+    ]
+    # Opening a session usually precedes sending to it. A reply still being
+    # written is left out of the cache; its final text is appended when done
+    if all(msg.status != "partial" for msg in session_messages):
+        put_context(
+            session_id,
+            [_context_item(msg) for msg in session_messages],
+            signatures=signatures,
+            version=version,
+        )
 
     return SessionDetailResponse(
         id=session.id,
@@ -98,7 +215,121 @@ async def get_session_detail(session_id: int, db: Session = Depends(get_db)):
         updated_at=session.updated_at,
         message_count=len(session_messages),
         messages=processed_messages,
+        active_leaf_id=session.active_leaf_id,
+    )
+
+
+@router.get(
+    f"{settings.api_prefix}/sessions/{{session_id}}/messages",
+    response_model=MessagePageResponse,
+)
+async def get_session_messages(
+    session_id: int,
+    before: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=500),
+    view: Literal["summary", "full"] = "summary",
+):
+    """
+    Page backwards through a session's active branch, newest page first
+
+    Args:
+        session_id: The session ID
+        before: Cursor from the previous page's `next_cursor`; omit for the newest messages
+        limit: Maximum number of messages to return
+        view: `summary` omits reasoning and search results (fetch them per message),
+            `full` includes them
+    """
+    older_than = None
+    if before:
+        try:
+            (message_id,) = decode_cursor(before, 1)
+            older_than = int(message_id)
+        except (InvalidCursorError, TypeError, ValueError) as e:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+    return await run_db(_load_message_page, session_id, older_than, limit, view == "summary")
+
+
+def _load_message_page(
+    db: Session,
+    session_id: int,
+    older_than: Optional[int],
+    limit: int,
+    summary: bool,
+) -> MessagePageResponse:
+    session = _get_session_or_404(db, session_id)
+
+    has_details = (
+        ChatMessage.thought_process.isnot(None)
+        | ChatMessage.search_results.isnot(None)
+        | exists().where(MessageSource.message_id == ChatMessage.id)
+    ).label("has_details")
+    # Walk up the branch from the newest message, or from the oldest one of
+    # the previous page, only as far as this page (plus one to see if there
+    # is more) needs
+    if older_than is None:
+        path = path_cte(session.active_leaf_id, max_depth=limit)
+    else:
+        path = path_cte(older_than, max_depth=limit + 1)
+    query = (
+        db.query(ChatMessage, has_details)
+        .join(path, path.c.id == ChatMessage.id)
+        .filter(ChatMessage.session_id == session_id)
+    )
+    if not summary:
+        query = query.options(undefer_group("details"))
+    if older_than is not None:
+        query = query.filter(path.c.depth > 0)
+    rows = query.order_by(path.c.depth.asc()).limit(limit + 1).all()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    rows.reverse()
+    search_results = None
+    if not summary and rows:
+        search_results = load_search_results(db, ChatMessage.id.in_([msg.id for msg, _ in rows]))
+    siblings = sibling_ids(db, session_id, (msg for msg, _ in rows))
+    messages = [
+        _message_response(msg, bool(details) if summary else None, search_results, siblings)
+        for msg, details in rows
+    ]
+    next_cursor = None
+    if has_more and rows:
+        oldest = rows[0][0]
+        next_cursor = encode_cursor(oldest.id)
+    return MessagePageResponse(messages=messages, next_cursor=next_cursor, has_more=has_more)
+
+
+@router.get(
+    f"{settings.api_prefix}/sessions/{{session_id}}/messages/{{message_id}}",
+    response_model=MessageResponse,
+)
+async def get_session_message(session_id: int, message_id: int):
+    """
+    Get one message with its reasoning and search results
+
+    Args:
+        session_id: The session ID
+        message_id: The message ID
+    """
+    return await run_db(_load_message, session_id, message_id)
+
+
+def _load_message(db: Session, session_id: int, message_id: int) -> MessageResponse:
+    msg = (
+        db.query(ChatMessage)
+        .options(undefer_group("details"))
+        .filter(ChatMessage.session_id == session_id, ChatMessage.id == message_id)
+        .first()
     )
+    if not msg:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Message {message_id} not found in session {session_id}",
+        )
+    search_results = load_search_results(db, ChatMessage.id == message_id)
+    siblings = sibling_ids(db, session_id, [msg])
+    return _message_response(msg, search_results=search_results, siblings=siblings)
 
 
 @router.post(
@@ -106,13 +337,17 @@ async def get_session_detail(session_id: int, db: Session = Depends(get_db)):
     response_model=SessionResponse,
     status_code=status.HTTP_201_CREATED,
 )
-async def create_session(session_data: SessionCreate, db: Session = Depends(get_db)):
+async def create_session(session_data: SessionCreate):
     """
     Create a new chat session
 
     Args:
         session_data: Session creation data
     """
+    return await run_db(_create_session, session_data)
+
+
+def _create_session(db: Session, session_data: SessionCreate) -> SessionResponse:
     session = ChatSession(
         title=session_data.title,
         provider=session_data.provider,
@@ -137,9 +372,7 @@ async def create_session(session_data: SessionCreate, db: Session = Depends(get_
 @router.patch(
     f"{settings.api_prefix}/sessions/{{session_id}}", response_model=SessionResponse
 )
-async def update_session(
-    session_id: int, session_data: SessionUpdate, db: Session = Depends(get_db)
-):
+async def update_session(session_id: int, session_data: SessionUpdate):
     """
     Update a chat session
 
@@ -147,13 +380,11 @@ async def update_session(
         session_id: The session ID
         session_data: Session update data
     """
-    session = db.query(ChatSession).filter(ChatSession.id == session_id).first()
+    return await run_db(_update_session, session_id, session_data)
 
-    if not session:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"Session {session_id} not found",
-        )
+
+def _update_session(db: Session, session_id: int, session_data: SessionUpdate) -> SessionResponse:
+    session = _get_session_or_404(db, session_id)
 
     if session_data.title:
         session.title = session_data.title
@@ -169,68 +400,181 @@ async def update_session(
         model=session.model,
         created_at=session.created_at,
         updated_at=session.updated_at,
-        message_count=len(session.messages),
+        message_count=_message_counts(db, [session.id]).get(session.id, 0),
     )
 
 
+def _delete_messages(db: Session, *criteria) -> int:
+    """
+    Delete matching messages in batches of `delete_batch_size`, committing each.
+
+    Short transactions let streaming checkpoints and other writers interleave
+    with a large delete instead of waiting on one long write lock.
+    """
+    batch_size = max(1, settings.delete_batch_size)
+    total = 0
+    while True:
+        batch = select(ChatMessage.id).where(*criteria).limit(batch_size).scalar_subquery()
+        deleted = (
+            db.query(ChatMessage)
+            .filter(ChatMessage.id.in_(batch))
+            .delete(synchronize_session=False)
+        )
+        db.commit()
+        total += deleted
+        if deleted < batch_size:
+            return total
+
+
 @router.delete(
     f"{settings.api_prefix}/sessions/{{session_id}}",
     status_code=status.HTTP_204_NO_CONTENT,
 )
-async def delete_session(session_id: int, db: Session = Depends(get_db)):
+async def delete_session(session_id: int, background_tasks: BackgroundTasks):
     """
     Delete a chat session
 
     Args:
         session_id: The session ID
     """
-    session = db.query(ChatSession).filter(ChatSession.id == session_id).first()
+    started = time.time()
+    await cancel_generations(running_generations(session_id))
+    uploads = await run_db(_delete_session, session_id)
+    background_tasks.add_task(run_db, remove_unreferenced_uploads, uploads, started)
 
-    if not session:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"Session {session_id} not found",
-        )
 
-    db.delete(session)
+def _delete_session(db: Session, session_id: int) -> Set[str]:
+    _get_session_or_404(db, session_id)
+
+    uploads = collect_upload_refs(db, ChatMessage.session_id == session_id)
+    _delete_messages(db, ChatMessage.session_id == session_id)
+    # Anything written meanwhile goes with the session via ON DELETE CASCADE
+    db.query(ChatSession).filter(ChatSession.id == session_id).delete(synchronize_session=False)
     db.commit()
+    invalidate_context(session_id)
+    return uploads
 
 
 @router.delete(
     f"{settings.api_prefix}/sessions/{{session_id}}/truncate/{{message_id}}",
     status_code=status.HTTP_204_NO_CONTENT,
 )
-async def truncate_session(
-    session_id: int, message_id: int, db: Session = Depends(get_db)
-):
+async def truncate_session(session_id: int, message_id: int, background_tasks: BackgroundTasks):
     """
-    Delete all messages in a session starting from a specific message ID (inclusive)
+    Delete a message and every message after it on any branch (its subtree)
 
     Args:
         session_id: The session ID
         message_id: The ID of the message from which to start deleting
     """
-    session = db.query(ChatSession).filter(ChatSession.id == session_id).first()
+    started = time.time()
+    # Replies being written in the subtree are stopped first; what they save
+    # on the way out is deleted with it
+    ids = await run_db(subtree_ids, session_id, message_id)
+    if ids:
+        await cancel_generations(running_generations(session_id, ids))
+    uploads = await run_db(_truncate_session, session_id, message_id)
+    background_tasks.add_task(run_db, remove_unreferenced_uploads, uploads, started)
+
+
+def _truncate_session(db: Session, session_id: int, message_id: int) -> Set[str]:
+    session = _get_session_or_404(db, session_id)
+
+    parent_id = (
+        db.query(ChatMessage.parent_id)
+        .filter(ChatMessage.session_id == session_id, ChatMessage.id == message_id)
+        .scalar()
+    )
+    # Collected up front: deleting a batch cuts the tree walked by the next one
+    ids = subtree_ids(db, session_id, message_id)
+    uploads: Set[str] = set()
+    batch_size = max(1, settings.delete_batch_size)
+    for start in range(0, len(ids), batch_size):
+        criteria = (ChatMessage.id.in_(ids[start:start + batch_size]),)
+        uploads |= collect_upload_refs(db, *criteria)
+        _delete_messages(db, *criteria)
+
+    if session.active_leaf_id in ids:
+        session.active_leaf_id = parent_id
+    session.updated_at = datetime.now(timezone.utc)
+    db.commit()
+    invalidate_context(session_id)
+    return uploads
 
-    if not session:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"Session {session_id} not found",
-        )
 
-    db.query(ChatMessage).filter(
-        ChatMessage.session_id == session_id, ChatMessage.id >= message_id
-    ).delete()
+@router.post(
+    f"{settings.api_prefix}/sessions/{{session_id}}/fork",
+    response_model=SessionDetailResponse,
+)
+async def fork_session(session_id: int, fork_request: ForkRequest):
+    """
+    Continue a session from one of its messages, keeping what followed as another branch
 
-    session.updated_at = datetime.now(timezone.utc)
+    Nothing is copied: the next message sent to the session becomes a new
+    child of `message_id` (a new first message when it is null). Replies
+    still being generated in the session are stopped.
+
+    Args:
+        session_id: The session ID
+        fork_request: Message to continue from
+    """
+    await cancel_generations(running_generations(session_id))
+    return await run_db(_set_active_leaf, session_id, fork_request.message_id, False)
+
+
+@router.post(
+    f"{settings.api_prefix}/sessions/{{session_id}}/switch",
+    response_model=SessionDetailResponse,
+)
+async def switch_branch(session_id: int, switch_request: BranchSwitchRequest):
+    """
+    Show and continue the branch through a message, down to its newest reply
+
+    Args:
+        session_id: The session ID
+        switch_request: Any message of the branch, e.g. one of `sibling_ids`
+    """
+    return await run_db(_set_active_leaf, session_id, switch_request.message_id, True)
+
+
+def _set_active_leaf(
+    db: Session, session_id: int, message_id: Optional[int], descend: bool
+) -> SessionDetailResponse:
+    session = _get_session_or_404(db, session_id)
+    if message_id is not None:
+        found = (
+            db.query(ChatMessage.id)
+            .filter(ChatMessage.session_id == session_id, ChatMessage.id == message_id)
+            .first()
+        )
+        if not found:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Message {message_id} not found in session {session_id}",
+            )
+        if descend:
+            message_id = newest_leaf(db, message_id)
+    session.active_leaf_id = message_id
     db.commit()
+    invalidate_context(session_id)
+    return _load_session_detail(db, session_id)
 
 
 @router.delete(f"{settings.api_prefix}/sessions", status_code=status.HTTP_204_NO_CONTENT)
-async def delete_all_sessions(db: Session = Depends(get_db)):
+async def delete_all_sessions(background_tasks: BackgroundTasks):
     """
     Delete all chat sessions
     """
-    db.query(ChatMessage).delete()
-    db.query(ChatSession).delete()
+    started = time.time()
+    await cancel_generations(running_generations())
+    uploads = await run_db(_delete_all_sessions)
+    background_tasks.add_task(run_db, remove_unreferenced_uploads, uploads, started)
+
+
+def _delete_all_sessions(db: Session) -> Set[str]:
+    uploads = collect_upload_refs(db)
+    _delete_messages(db)
+    db.query(ChatSession).delete(synchronize_session=False)
     db.commit()
+    invalidate_context()
+    return uploads
@@ -0,0 +1,89 @@
+"""
+Search results of messages, with sources interned by URL
+"""
+from typing import Dict, List, Optional
+
+from sqlalchemy import insert, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+try:
+    from .database import ChatMessage, MessageSource, SearchSource
+except (ImportError, ValueError):
+    from database import ChatMessage, MessageSource, SearchSource
+
+
+def _source_ids(db: Session, sources: Dict[str, Optional[str]]) -> Dict[str, int]:
+    """Ids of the given {url: title} sources, inserting the ones not seen before."""
+    rows = [{"url": url, "title": title} for url, title in sources.items()]
+    if db.get_bind().dialect.name == "sqlite":
+        # Concurrent writers may intern the same URL; the first one wins
+        db.execute(sqlite_insert(SearchSource).on_conflict_do_nothing(index_elements=["url"]), rows)
+    else:
+        known = set(
+            db.execute(select(SearchSource.url).where(SearchSource.url.in_(sources))).scalars()
+        )
+        missing = [row for row in rows if row["url"] not in known]
+        if missing:
+            db.execute(insert(SearchSource), missing)
+    return dict(
+        db.execute(select(SearchSource.url, SearchSource.id).where(SearchSource.url.in_(sources))).all()
+    )
+
+
+def store_search_results(db: Session, message_id: int, results: Optional[List]) -> None:
+    """
+    Attach `results` ({"url", "title", "content"} dicts) to a message.
+
+    Entries without a URL are skipped. The caller commits.
+    """
+    entries = [
+        item for item in results or [] if isinstance(item, dict) and isinstance(item.get("url"), str)
+    ]
+    if not entries:
+        return
+    sources: Dict[str, Optional[str]] = {}
+    for item in entries:
+        sources.setdefault(item["url"], item.get("title"))
+    ids = _source_ids(db, sources)
+    titles = dict(
+        db.execute(select(SearchSource.id, SearchSource.title).where(SearchSource.id.in_(ids.values()))).all()
+    )
+    links = []
+    for position, item in enumerate(entries):
+        source_id = ids[item["url"]]
+        title = item.get("title")
+        links.append(
+            {
+                "message_id": message_id,
+                "position": position,
+                "source_id": source_id,
+                "title": title if title != titles.get(source_id) else None,
+                "content": item.get("content"),
+            }
+        )
+    db.execute(insert(MessageSource), links)
+
+
+def load_search_results(db: Session, *criteria) -> Dict[int, List[Dict]]:
+    """Search results of the messages matching `criteria`, keyed by message id."""
+    rows = db.execute(
+        select(
+            MessageSource.message_id,
+            SearchSource.url,
+            MessageSource.title,
+            SearchSource.title,
+            MessageSource.content,
+        )
+        .join(SearchSource, SearchSource.id == MessageSource.source_id)
+        .join(ChatMessage, ChatMessage.id == MessageSource.message_id)
+        .where(*criteria)
+        .order_by(MessageSource.message_id, MessageSource.position)
+    ).all()
+    results: Dict[int, List[Dict]] = {}
+    for message_id, url, title, source_title, content in rows:
+        entry = {"url": url, "title": title or source_title or url}
+        if content:
+            entry["content"] = content
+        results.setdefault(message_id, []).append(entry)
+    return results
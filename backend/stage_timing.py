@@ -0,0 +1,71 @@
+"""
+Latency histograms of the stages a streamed reply passes through
+"""
+import bisect
+from typing import Dict, List
+
+# Bucket upper bounds in microseconds: 1-2-5 steps from 1 µs to 10 s
+BUCKET_BOUNDS_US: List[float] = [
+    mantissa * 10 ** exponent for exponent in range(7) for mantissa in (1, 2, 5)
+] + [10_000_000]
+
+
+class Histogram:
+    """Fixed-bucket latency histogram; recording is O(log buckets) and allocation free."""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKET_BOUNDS_US) + 1)
+        self.count = 0
+        self.total_us = 0.0
+        self.max_us = 0.0
+
+    def record(self, seconds: float) -> None:
+        micros = seconds * 1_000_000
+        self.counts[bisect.bisect_left(BUCKET_BOUNDS_US, micros)] += 1
+        self.count += 1
+        self.total_us += micros
+        if micros > self.max_us:
+            self.max_us = micros
+
+    def quantile(self, q: float) -> float:
+        """Upper bound (µs) of the bucket holding the `q` quantile, at most the largest sample."""
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank and index < len(BUCKET_BOUNDS_US):
+                return min(BUCKET_BOUNDS_US[index], round(self.max_us, 3))
+        return round(self.max_us, 3)
+
+    def stats(self) -> Dict[str, object]:
+        if not self.count:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "avg_us": round(self.total_us / self.count, 3),
+            "p50_us": self.quantile(0.5),
+            "p90_us": self.quantile(0.9),
+            "p99_us": self.quantile(0.99),
+            "max_us": round(self.max_us, 3),
+            # Upper bound in µs -> samples, empty buckets left out
+            "buckets": {
+                (str(BUCKET_BOUNDS_US[index]) if index < len(BUCKET_BOUNDS_US) else "inf"): count
+                for index, count in enumerate(self.counts)
+                if count
+            },
+        }
+
+
+_STAGES: Dict[str, Histogram] = {}
+
+
+def record_stage(name: str, seconds: float) -> None:
+    histogram = _STAGES.get(name)
+    if histogram is None:
+        histogram = _STAGES[name] = Histogram()
+    histogram.record(seconds)
+
+
+def stage_stats() -> Dict[str, Dict[str, object]]:
+    """Per-stage latency since startup, in pipeline order of first use."""
+    return {name: histogram.stats() for name, histogram in _STAGES.items()}
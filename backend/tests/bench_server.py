@@ -0,0 +1,54 @@
+"""
+The app with the scripted provider on a real socket, for the transport benchmark
+
+    python tests/bench_server.py PORT CHUNKS DELAY
+
+`GET /bench/stats` reports the server's CPU time and the client sockets that
+reached the app since the previous call.
+"""
+import sys
+import time
+
+import uvicorn
+
+from conftest import FakeProvider
+
+import provider_registry
+from app_factory import create_app
+
+
+class ConnectionCounter:
+    """ASGI wrapper remembering the distinct client sockets of requests."""
+
+    def __init__(self, app):
+        self.app = app
+        self.clients = set()
+
+    async def __call__(self, scope, receive, send):
+        client = scope.get("client")
+        if scope["type"] in ("http", "websocket") and client and not scope["path"].startswith("/bench"):
+            self.clients.add(tuple(client))
+        await self.app(scope, receive, send)
+
+
+def main() -> None:
+    port, chunks, delay = int(sys.argv[1]), int(sys.argv[2]), float(sys.argv[3])
+    provider = FakeProvider()
+    provider.delay = delay
+    provider.reply = lambda messages: [f"{messages[-1]['content']}:{index} " for index in range(chunks)]
+    provider_registry._PROVIDER_REGISTRY[provider.id] = provider
+
+    app = create_app()
+    counter = ConnectionCounter(app)
+
+    @app.get("/bench/stats")
+    async def bench_stats():
+        connections = len(counter.clients)
+        counter.clients.clear()
+        return {"cpu_seconds": time.process_time(), "connections": connections}
+
+    uvicorn.run(counter, host="127.0.0.1", port=port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Shared fixtures: a throwaway database and a scripted provider
+"""
+import asyncio
+import json
+import os
+import sys
+import tempfile
+
+# Settings are read on import, so the database must be chosen first
+_DB_DIR = tempfile.mkdtemp(prefix="lite-llm-chat-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_DB_DIR, 'chat_history.db')}"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from fastapi.testclient import TestClient
+
+import context_media
+import provider_registry
+import upload_store
+from app_factory import create_app
+
+
+def pytest_addoption(parser):
+    parser.addoption("--benchmarks", action="store_true", help="also run the benchmarks (slow)")
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "benchmark: slow benchmark, only run with --benchmarks")
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--benchmarks"):
+        return
+    skip = pytest.mark.skip(reason="benchmark, run with --benchmarks")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip)
+
+
+class FakeProvider:
+    """
+    Provider whose replies are scripted per test.
+
+    `reply(messages)` returns the chunks of the reply to a conversation; by
+    default it echoes the last user message. `delay` is slept before every
+    chunk, and the time each chunk was produced is kept in `chunk_times`.
+    """
+
+    id = "fake"
+    name = "Fake"
+    description = "Scripted replies for tests"
+    supported = True
+
+    def __init__(self):
+        self.client = object()
+        self.delay = 0.0
+        self.reply = lambda messages: [messages[-1]["content"]]
+        self.chunk_times = []
+
+    async def chat(self, model, messages, **kwargs):
+        return "".join(self.reply(messages)), ""
+
+    async def stream_chat(self, model, messages, **kwargs):
+        loop = asyncio.get_running_loop()
+        for chunk in self.reply(messages):
+            await asyncio.sleep(self.delay)
+            self.chunk_times.append(loop.time())
+            yield f"data: {json.dumps({'content': chunk})}\n\n"
+        yield f"data: {json.dumps({'done': True})}\n\n"
+
+    async def list_models(self):
+        return [{"id": "fake-model", "name": "Fake", "provider": self.id, "description": ""}]
+
+
+@pytest.fixture
+def provider():
+    fake = FakeProvider()
+    provider_registry._PROVIDER_REGISTRY[fake.id] = fake
+    yield fake
+    provider_registry._PROVIDER_REGISTRY.pop(fake.id, None)
+
+
+@pytest.fixture
+def client(provider):
+    with TestClient(create_app()) as test_client:
+        yield test_client
+
+
+@pytest.fixture
+def uploads(tmp_path, monkeypatch):
+    """An empty uploads/ directory for the test."""
+    for module in (upload_store, context_media):
+        monkeypatch.setattr(module, "UPLOAD_DIR", str(tmp_path))
+    return tmp_path
@@ -0,0 +1,208 @@
+"""
+Many generations multiplexed over one WebSocket stay separate, and a request
+that fails to start does not disturb the others.
+"""
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import httpx
+import pytest
+import websockets
+
+from config import settings
+from routers import chat_ws
+
+STREAMS = 50
+CHUNKS = 20
+
+
+def _chunks(tag: str) -> list:
+    return [f"<{tag}:{index}>" for index in range(CHUNKS)]
+
+
+def _start(websocket, request_id: str, content: str) -> None:
+    websocket.send_text(
+        json.dumps(
+            {
+                "type": "start",
+                "request_id": request_id,
+                "request": {
+                    "provider": "fake",
+                    "model": "fake-model",
+                    "messages": [{"role": "user", "content": content}],
+                },
+            }
+        )
+    )
+
+
+def _run(websocket, expected_ends: int):
+    """Frames until `expected_ends` generations ended: (started, errors, content per generation)."""
+    started, errors, content = {}, {}, {}
+    ends = 0
+    while ends < expected_ends:
+        frame = json.loads(websocket.receive_text())
+        if frame["type"] == "started":
+            started[frame["request_id"]] = frame["generation_id"]
+        elif frame["type"] == "error":
+            errors[frame.get("request_id") or frame.get("generation_id")] = frame["error"]
+        elif frame["type"] == "event":
+            assert "error" not in frame["data"]
+            content.setdefault(frame["generation_id"], []).append(frame["data"].get("content", ""))
+        elif frame["type"] == "end":
+            ends += 1
+    return started, errors, {key: "".join(parts) for key, parts in content.items()}
+
+
+def test_generations_are_multiplexed_over_one_socket(client, provider):
+    provider.delay = 0.001
+    provider.reply = lambda messages: _chunks(messages[-1]["content"])
+    tags = [f"ws{index}" for index in range(STREAMS)]
+
+    with client.websocket_connect(f"{settings.api_prefix}/chat/ws") as websocket:
+        for tag in tags:
+            _start(websocket, tag, tag)
+        started, errors, content = _run(websocket, STREAMS)
+
+    assert not errors
+    assert len(set(started.values())) == STREAMS
+    for tag in tags:
+        assert content[started[tag]] == "".join(_chunks(tag))
+
+
+def test_failed_start_keeps_the_socket_open(client, provider, monkeypatch):
+    provider.delay = 0.005
+    provider.reply = lambda messages: _chunks(messages[-1]["content"])
+    prepare_chat = chat_ws._prepare_chat
+
+    async def failing_prepare(chat_request):
+        if chat_request.messages[-1].content == "broken":
+            raise RuntimeError("database is locked")
+        return await prepare_chat(chat_request)
+
+    monkeypatch.setattr(chat_ws, "_prepare_chat", failing_prepare)
+
+    with client.websocket_connect(f"{settings.api_prefix}/chat/ws") as websocket:
+        _start(websocket, "before", "before")
+        _start(websocket, "broken", "broken")
+        _start(websocket, "after", "after")
+        started, errors, content = _run(websocket, 2)
+
+    assert set(started) == {"before", "after"}
+    assert errors == {"broken": "Failed to start chat: database is locked"}
+    assert content[started["before"]] == "".join(_chunks("before"))
+    assert content[started["after"]] == "".join(_chunks("after"))
+
+
+async def _sse_streams(base_url: str, count: int) -> list:
+    """Seconds to the first content event of each of `count` concurrent SSE streams."""
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=120) as http:
+
+        async def one(index: int) -> float:
+            started = time.perf_counter()
+            first = None
+            body = {
+                "provider": "fake",
+                "model": "fake-model",
+                "messages": [{"role": "user", "content": f"sse{index}"}],
+            }
+            async with http.stream("POST", f"{settings.api_prefix}/chat", json=body) as response:
+                async for line in response.aiter_lines():
+                    if first is None and line.startswith("data:") and '"content"' in line:
+                        first = time.perf_counter() - started
+            return first
+
+        return await asyncio.gather(*(one(index) for index in range(count)))
+
+
+async def _ws_streams(base_url: str, count: int) -> list:
+    """Seconds to the first content event of each of `count` generations on one WebSocket."""
+    url = base_url.replace("http", "ws", 1) + f"{settings.api_prefix}/chat/ws"
+    async with websockets.connect(url, max_size=None) as websocket:
+        started = {}
+        for index in range(count):
+            request_id = f"ws{index}"
+            started[request_id] = time.perf_counter()
+            await websocket.send(
+                json.dumps(
+                    {
+                        "type": "start",
+                        "request_id": request_id,
+                        "request": {
+                            "provider": "fake",
+                            "model": "fake-model",
+                            "messages": [{"role": "user", "content": request_id}],
+                        },
+                    }
+                )
+            )
+        requests, first = {}, {}
+        ends = 0
+        while ends < count:
+            frame = json.loads(await websocket.recv())
+            if frame["type"] == "started":
+                requests[frame["generation_id"]] = frame["request_id"]
+            elif frame["type"] == "event" and "content" in frame["data"]:
+                request_id = requests[frame["generation_id"]]
+                first.setdefault(request_id, time.perf_counter() - started[request_id])
+            elif frame["type"] == "end":
+                ends += 1
+            else:
+                assert frame["type"] == "event", frame
+        return list(first.values())
+
+
+def _percentile(values: list, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+@pytest.mark.benchmark
+def test_benchmark_websocket_against_sse(tmp_path):
+    streams, chunks, delay = 500, 20, 0.01
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(os.path.dirname(__file__), "bench_server.py"), str(port), str(chunks), str(delay)],
+        cwd=tmp_path,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        for _ in range(100):
+            try:
+                httpx.get(f"{base_url}/bench/stats")
+                break
+            except httpx.TransportError:
+                time.sleep(0.1)
+
+        results = {}
+        for transport, run in (("sse", _sse_streams), ("websocket", _ws_streams)):
+            before = httpx.get(f"{base_url}/bench/stats").json()
+            started = time.perf_counter()
+            first = asyncio.run(run(base_url, streams))
+            elapsed = time.perf_counter() - started
+            after = httpx.get(f"{base_url}/bench/stats").json()
+            assert len(first) == streams and all(value is not None for value in first)
+            results[transport] = {
+                "connections": after["connections"],
+                "first_p50_ms": round(_percentile(first, 0.5) * 1000, 1),
+                "first_p99_ms": round(_percentile(first, 0.99) * 1000, 1),
+                "wall_s": round(elapsed, 2),
+                "server_cpu_s": round(after["cpu_seconds"] - before["cpu_seconds"], 2),
+            }
+    finally:
+        server.terminate()
+        server.wait()
+
+    print(f"\n{streams} concurrent streams of {chunks} chunks")
+    for transport, row in results.items():
+        print(f"{transport:>10}: " + ", ".join(f"{key} {value}" for key, value in row.items()))
+    assert results["websocket"]["connections"] == 1
+    assert results["sse"]["connections"] == streams
@@ -0,0 +1,83 @@
+"""
+Streamed replies are checkpointed into a single row, however the stream ends.
+"""
+import asyncio
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app_factory import create_app
+from config import settings
+from database import ChatMessage, ChatSession, SessionLocal
+from db_writer import writer
+from routers.chat_persistence import AssistantCheckpoint
+
+
+def _rows(session_id: int):
+    db = SessionLocal()
+    try:
+        messages = [
+            (m.id, m.role, m.content, m.status)
+            for m in db.query(ChatMessage).filter(ChatMessage.session_id == session_id)
+        ]
+        return messages, db.get(ChatSession, session_id).active_leaf_id
+    finally:
+        db.close()
+
+
+def test_cancel_during_first_checkpoint_keeps_one_row(client, monkeypatch):
+    session_id = client.post(
+        f"{settings.api_prefix}/sessions",
+        json={"title": "cancelled", "provider": "fake", "model": "fake-model"},
+    ).json()["id"]
+    insert = AssistantCheckpoint._insert
+
+    def slow_insert(self, db, content, reasoning):
+        time.sleep(0.2)
+        return insert(self, db, content, reasoning)
+
+    monkeypatch.setattr(AssistantCheckpoint, "_insert", slow_insert)
+
+    async def stream_then_cancel():
+        checkpoint = AssistantCheckpoint(session_id, "fake", "fake-model")
+        first = asyncio.ensure_future(checkpoint.track("a", ""))
+        await asyncio.sleep(0.05)
+        # The generation is cancelled while its row is being inserted
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        message_id = await checkpoint.finish("a", "", "aborted")
+        await writer.close()
+        return message_id
+
+    message_id = asyncio.run(stream_then_cancel())
+
+    messages, active_leaf_id = _rows(session_id)
+    assert messages == [(message_id, "assistant", "a", "aborted")]
+    assert active_leaf_id == message_id
+
+
+def test_startup_aborts_interrupted_replies(client):
+    session_id = client.post(
+        f"{settings.api_prefix}/sessions",
+        json={"title": "interrupted", "provider": "fake", "model": "fake-model"},
+    ).json()["id"]
+    db = SessionLocal()
+    try:
+        # What a worker killed mid-stream leaves behind
+        message = ChatMessage(
+            session_id=session_id, role="assistant", content="zanzibar halfway", status="partial"
+        )
+        db.add(message)
+        db.commit()
+        message_id = message.id
+    finally:
+        db.close()
+
+    with TestClient(create_app()) as restarted:
+        hits = restarted.get(f"{settings.api_prefix}/search", params={"q": "zanzibar"}).json()["hits"]
+
+    messages, _ = _rows(session_id)
+    assert messages == [(message_id, "assistant", "zanzibar halfway", "aborted")]
+    assert [hit["message_id"] for hit in hits] == [message_id]
@@ -0,0 +1,128 @@
+"""
+Context assembly: what of the stored history is sent to the provider.
+"""
+import copy
+import os
+
+import pytest
+
+import upload_store
+from config import settings
+from context_media import media_policy
+
+
+def _chat(client, content: str, session_id=None) -> dict:
+    body = {
+        "provider": "fake",
+        "model": "fake-model",
+        "stream": False,
+        "messages": [{"role": "user", "content": content}],
+    }
+    if session_id is not None:
+        body["session_id"] = session_id
+    response = client.post(f"{settings.api_prefix}/chat", json=body)
+    assert response.status_code == 200
+    return response.json()
+
+
+def test_unknown_context_length_sends_full_history(client, provider, monkeypatch):
+    # The reply is the number of messages the provider was sent
+    provider.reply = lambda messages: [str(len(messages))]
+    # About 150k estimated tokens, more than a 128k window holds
+    session_id = _chat(client, "word " * 120_000)["session_id"]
+
+    assert _chat(client, "again", session_id)["message"]["content"] == "3"
+
+    # With a window to fit, the first turn is dropped
+    monkeypatch.setattr(settings, "context_default_length", 131072)
+    assert _chat(client, "once more", session_id)["message"]["content"] == "3"
+
+
+def _record_requests(provider) -> list:
+    """Messages of every provider request, as sent."""
+    requests = []
+
+    def reply(messages):
+        requests.append(copy.deepcopy(messages))
+        return ["ok"]
+
+    provider.reply = reply
+    return requests
+
+
+def _image_turn(client, name: str, session_id=None) -> int:
+    body = {
+        "provider": "fake",
+        "model": "fake-model",
+        "stream": False,
+        "messages": [{"role": "user", "content": f"picture {name}", "images": [f"/uploads/{name}"]}],
+    }
+    if session_id is not None:
+        body["session_id"] = session_id
+    response = client.post(f"{settings.api_prefix}/chat", json=body)
+    assert response.status_code == 200
+    return response.json()["session_id"]
+
+
+def _image_urls(message: dict) -> list:
+    content = message["content"]
+    if isinstance(content, str):
+        return []
+    return [part["image_url"]["url"] for part in content if part.get("type") == "image_url"]
+
+
+@pytest.mark.skipif(upload_store.Image is None, reason="needs Pillow")
+def test_older_images_are_sent_as_thumbnails(client, provider, uploads, monkeypatch):
+    monkeypatch.setattr(settings, "context_media_policy", "thumbnail")
+    monkeypatch.setattr(settings, "context_media_full_turns", 2)
+    monkeypatch.setattr(settings, "context_media_thumbnail_px", 32)
+    for name in ("one.png", "two.png", "three.png"):
+        upload_store.Image.new("RGB", (400, 300), "red").save(os.path.join(uploads, name))
+    requests = _record_requests(provider)
+
+    session_id = _image_turn(client, "one.png")
+    _image_turn(client, "two.png", session_id)
+    _image_turn(client, "three.png", session_id)
+
+    users = [message for message in requests[-1] if message["role"] == "user"]
+    thumb = upload_store.thumbnail_name("one.png", 32)
+    assert [_image_urls(message) for message in users] == [
+        [f"/uploads/{thumb}"],
+        ["/uploads/two.png"],
+        ["/uploads/three.png"],
+    ]
+    with upload_store.Image.open(os.path.join(uploads, thumb)) as image:
+        assert max(image.size) <= 32
+    # Stored messages keep the full image
+    stored = client.get(f"{settings.api_prefix}/sessions/{session_id}").json()["messages"]
+    assert stored[0]["images"] == ["/uploads/one.png"]
+
+
+def test_older_media_can_be_replaced_by_a_note(client, provider, uploads, monkeypatch):
+    monkeypatch.setattr(settings, "context_media_policy", "placeholder")
+    monkeypatch.setattr(settings, "context_media_full_turns", 1)
+    for name in ("old.png", "new.png"):
+        with open(os.path.join(uploads, name), "wb") as f:
+            f.write(b"\x89PNG")
+    requests = _record_requests(provider)
+
+    session_id = _image_turn(client, "old.png")
+    _image_turn(client, "new.png", session_id)
+
+    users = [message for message in requests[-1] if message["role"] == "user"]
+    assert users[0]["content"] == "picture old.png\n\n[image from an earlier turn omitted]"
+    assert _image_urls(users[1]) == ["/uploads/new.png"]
+
+
+def test_media_policy_overrides(monkeypatch):
+    monkeypatch.setattr(settings, "context_media_policy", "placeholder")
+    monkeypatch.setattr(
+        settings,
+        "context_media_policy_overrides",
+        {"gemini": "full", "gemini/gemini-lite": "thumbnail", "openrouter": "bogus"},
+    )
+    assert media_policy("gemini", "gemini-pro") == "full"
+    assert media_policy("gemini", "gemini-lite") == "thumbnail"
+    assert media_policy("deepseek", "deepseek-chat") == "placeholder"
+    # Unknown policies fall back to sending everything
+    assert media_policy("openrouter", "any") == "full"
@@ -0,0 +1,52 @@
+"""
+The context cache never keeps history older than what is stored.
+"""
+from config import settings
+from context_cache import append_context, context_version, get_context, invalidate_context, put_context
+from database import ChatMessage, ChatSession, SessionLocal
+
+
+def _message(content: str) -> dict:
+    return {"role": "user", "content": content}
+
+
+def test_load_older_than_an_append_is_not_cached():
+    session_id = 10_001
+    invalidate_context(session_id)
+    version = context_version(session_id)
+    # A message is stored and appended while the history is being loaded
+    append_context(session_id, 2, 5, _message("new"), parent_id=1)
+    put_context(session_id, [(1, 5, _message("old"))], version=version)
+    assert get_context(session_id) is None
+
+    put_context(session_id, [(1, 5, _message("old"))], version=context_version(session_id))
+    append_context(session_id, 2, 5, _message("new"), parent_id=1)
+    assert get_context(session_id) == (2, [(5, _message("old")), (5, _message("new"))])
+
+
+def test_load_older_than_an_invalidation_is_not_cached():
+    session_id = 10_002
+    version = context_version(session_id)
+    invalidate_context()
+    put_context(session_id, [(1, 5, _message("old"))], version=version)
+    assert get_context(session_id) is None
+
+
+def test_reply_being_written_is_not_cached(client):
+    session_id = client.post(
+        f"{settings.api_prefix}/sessions",
+        json={"title": "streaming", "provider": "fake", "model": "fake-model"},
+    ).json()["id"]
+    db = SessionLocal()
+    try:
+        message = ChatMessage(session_id=session_id, role="assistant", content="half", status="partial")
+        db.add(message)
+        db.flush()
+        db.get(ChatSession, session_id).active_leaf_id = message.id
+        db.commit()
+    finally:
+        db.close()
+
+    detail = client.get(f"{settings.api_prefix}/sessions/{session_id}").json()
+    assert [m["status"] for m in detail["messages"]] == ["partial"]
+    assert get_context(session_id) is None
@@ -0,0 +1,45 @@
+"""
+NDJSON import: sessions keep their exported metadata, malformed lines get a 400.
+"""
+import json
+
+from config import settings
+
+
+def _ndjson(*records) -> bytes:
+    return b"".join(json.dumps(record).encode() + b"\n" for record in records)
+
+
+def test_import_keeps_updated_at(client):
+    body = _ndjson(
+        {"type": "header", "version": 2},
+        {
+            "type": "session",
+            "id": 1,
+            "title": "old chat",
+            "provider": "fake",
+            "model": "fake-model",
+            "created_at": "2020-01-01T00:00:00",
+            "updated_at": "2020-01-02T00:00:00",
+            "active_leaf_id": 2,
+        },
+        {"type": "message", "id": 1, "session_id": 1, "role": "user", "content": "hi"},
+        {"type": "message", "id": 2, "session_id": 1, "parent_id": 1, "role": "assistant", "content": "hello"},
+    )
+    response = client.post(f"{settings.api_prefix}/import", content=body)
+    assert response.status_code == 200
+
+    sessions = client.get(f"{settings.api_prefix}/sessions", params={"limit": 100}).json()
+    imported = next(session for session in sessions if session["title"] == "old chat")
+    assert imported["updated_at"].startswith("2020-01-02")
+    detail = client.get(f"{settings.api_prefix}/sessions/{imported['id']}").json()
+    assert [m["content"] for m in detail["messages"]] == ["hi", "hello"]
+    assert detail["active_leaf_id"] == detail["messages"][-1]["id"]
+
+
+def test_import_rejects_invalid_version(client):
+    for version in ("2", 3, None, [2]):
+        body = _ndjson({"type": "header", "version": version})
+        response = client.post(f"{settings.api_prefix}/import", content=body)
+        assert response.status_code == 400
+        assert response.json()["detail"].startswith("Line 1: unsupported export version")
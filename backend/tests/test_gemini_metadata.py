@@ -0,0 +1,132 @@
+"""
+Thought signatures and search results belong to the reply that produced
+them, even when several Gemini requests share one client concurrently.
+"""
+import asyncio
+import base64
+import json
+import random
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+
+types = pytest.importorskip("google.genai.types")
+
+import provider_registry
+from config import settings
+from database import ChatMessage, SessionLocal
+from providers.base import BaseLLMProvider
+
+REQUESTS = 16
+
+
+def _response(tag: str, text: str, last: bool):
+    parts = [types.Part(text=text)]
+    grounding = None
+    if last:
+        # Gemini sends the signature and the grounding with the final chunk
+        parts = [types.Part(text=text, thought_signature=f"sig-{tag}".encode())]
+        grounding = types.GroundingMetadata(
+            grounding_chunks=[
+                types.GroundingChunk(
+                    web=types.GroundingChunkWeb(uri=f"https://example.com/{tag}", title=tag)
+                )
+            ]
+        )
+    content = types.Content(role="model", parts=parts)
+    return types.GenerateContentResponse(
+        candidates=[types.Candidate(content=content, grounding_metadata=grounding)]
+    )
+
+
+def _last_user_text(contents) -> str:
+    part = contents[-1]["parts"][0]
+    return part["text"] if isinstance(part, dict) else part.text
+
+
+class FakeModels:
+    """Replies `reply <tag>` with signature `sig-<tag>`, after random pauses."""
+
+    async def generate_content(self, model, contents, config):
+        tag = _last_user_text(contents)
+        await asyncio.sleep(random.uniform(0, 0.05))
+        return _response(tag, f"reply {tag}", last=True)
+
+    async def generate_content_stream(self, model, contents, config):
+        tag = _last_user_text(contents)
+
+        async def chunks():
+            for index, text in enumerate(["reply ", tag]):
+                await asyncio.sleep(random.uniform(0, 0.05))
+                yield _response(tag, text, last=index == 1)
+
+        return chunks()
+
+
+class FakeGeminiProvider(BaseLLMProvider):
+    id = "gemini"
+    name = "Gemini"
+    description = "Gemini client with a faked SDK"
+
+
+@pytest.fixture
+def gemini(monkeypatch):
+    # The client module builds its singleton on import, which needs a key;
+    # no request reaches Google, only the SDK calls below are faked
+    monkeypatch.setattr(settings, "gemini_api_key", settings.gemini_api_key or "test-key")
+    from providers.gemini_client import GeminiClient
+
+    gemini_client = GeminiClient()
+    gemini_client._client = SimpleNamespace(aio=SimpleNamespace(models=FakeModels()))
+    monkeypatch.setitem(
+        provider_registry._PROVIDER_REGISTRY, "gemini", FakeGeminiProvider(gemini_client)
+    )
+
+
+def _chat(client, tag: str, stream: bool) -> int:
+    response = client.post(
+        f"{settings.api_prefix}/chat",
+        json={
+            "provider": "gemini",
+            "model": "gemini-2.5-flash",
+            "stream": stream,
+            "messages": [{"role": "user", "content": tag}],
+        },
+    )
+    assert response.status_code == 200
+    if not stream:
+        return response.json()["session_id"]
+    events = [
+        json.loads(line[len("data:"):])
+        for line in response.text.splitlines()
+        if line.startswith("data:")
+    ]
+    # Signatures are stored with the reply, never sent to the browser
+    assert not any("thought_signatures" in event for event in events)
+    return next(event["session_id"] for event in events if "session_id" in event)
+
+
+def test_concurrent_replies_keep_their_own_metadata(client, gemini):
+    random.seed(50)
+    requests = [(f"tag{index}", index % 2 == 0) for index in range(REQUESTS)]
+    with ThreadPoolExecutor(REQUESTS) as pool:
+        session_ids = list(pool.map(lambda request: _chat(client, *request), requests))
+
+    for (tag, stream), session_id in zip(requests, session_ids):
+        db = SessionLocal()
+        try:
+            reply = (
+                db.query(ChatMessage)
+                .filter(ChatMessage.session_id == session_id, ChatMessage.role == "assistant")
+                .one()
+            )
+            content, signatures = reply.content, reply.thought_signatures
+        finally:
+            db.close()
+        assert content == f"reply {tag}", (tag, stream)
+        assert signatures == [base64.b64encode(f"sig-{tag}".encode()).decode()], (tag, stream)
+
+        detail = client.get(f"{settings.api_prefix}/sessions/{session_id}").json()
+        sources = detail["messages"][-1]["search_results"]
+        assert [source["url"] for source in sources] == [f"https://example.com/{tag}"], (tag, stream)
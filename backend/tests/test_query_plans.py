@@ -0,0 +1,120 @@
+"""
+The listing endpoints must stay index lookups as the tables grow: the
+queries they actually run are captured and checked with EXPLAIN QUERY PLAN.
+"""
+import re
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import event
+
+from config import settings
+from database import engine
+
+# A full pass over a table; "SCAN x USING INDEX" walks an index in order instead
+_TABLE_SCAN = re.compile(r"^SCAN (chat_messages|chat_sessions)(_\d+)?$")
+
+
+@contextmanager
+def _captured_queries():
+    queries = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(("SELECT", "WITH")):
+            queries.append((statement, parameters))
+
+    event.listen(engine, "before_cursor_execute", capture)
+    try:
+        yield queries
+    finally:
+        event.remove(engine, "before_cursor_execute", capture)
+
+
+def _plans(queries):
+    """(statement, query plan lines) of each captured query."""
+    with engine.connect() as conn:
+        return [
+            (statement, [row[3] for row in conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters)])
+            for statement, parameters in queries
+        ]
+
+
+def _assert_no_table_scan(plans):
+    for statement, plan in plans:
+        scans = [line for line in plan if _TABLE_SCAN.match(line)]
+        assert not scans, f"{scans} in plan of {statement}"
+
+
+@pytest.fixture
+def conversation(client):
+    """A session with a few turns, among other sessions."""
+    for _ in range(3):
+        client.post(
+            f"{settings.api_prefix}/chat",
+            json={
+                "provider": "fake",
+                "model": "fake-model",
+                "stream": False,
+                "messages": [{"role": "user", "content": "hello"}],
+            },
+        )
+    session_id = client.get(f"{settings.api_prefix}/sessions").json()[0]["id"]
+    for turn in range(4):
+        client.post(
+            f"{settings.api_prefix}/chat",
+            json={
+                "provider": "fake",
+                "model": "fake-model",
+                "stream": False,
+                "session_id": session_id,
+                "messages": [{"role": "user", "content": f"turn {turn}"}],
+            },
+        )
+    return session_id
+
+
+def test_session_list_uses_keyset_index(client, conversation):
+    with _captured_queries() as first:
+        response = client.get(f"{settings.api_prefix}/sessions", params={"limit": 2})
+    cursor = response.headers["X-Next-Cursor"]
+    with _captured_queries() as second:
+        client.get(f"{settings.api_prefix}/sessions", params={"limit": 2, "cursor": cursor})
+
+    first_plans, second_plans = _plans(first), _plans(second)
+    _assert_no_table_scan(first_plans + second_plans)
+    listing = [plan for statement, plan in first_plans if "FROM chat_sessions" in statement][0]
+    assert any("ix_chat_sessions_updated_at_id" in line for line in listing)
+    assert not any("TEMP B-TREE" in line for line in listing)
+    page = [plan for statement, plan in second_plans if "FROM chat_sessions" in statement][0]
+    assert any(
+        line.startswith("SEARCH chat_sessions") and "ix_chat_sessions_updated_at_id" in line
+        for line in page
+    )
+    # Message counts walk the active branches of the listed sessions
+    counts = [plan for statement, plan in first_plans if "branch_path" in statement][0]
+    assert any("chat_sessions USING INTEGER PRIMARY KEY" in line for line in counts)
+    assert any("chat_messages_1 USING INTEGER PRIMARY KEY" in line for line in counts)
+
+
+def test_message_page_uses_indexes(client, conversation):
+    url = f"{settings.api_prefix}/sessions/{conversation}/messages"
+    with _captured_queries() as queries:
+        response = client.get(url, params={"limit": 3})
+        client.get(url, params={"limit": 3, "cursor": response.json()["next_cursor"]})
+
+    plans = _plans(queries)
+    _assert_no_table_scan(plans)
+    paths = [plan for statement, plan in plans if "message_path" in statement]
+    assert paths
+    for plan in paths:
+        # Every step up the branch is a primary key lookup
+        assert any("chat_messages USING INTEGER PRIMARY KEY" in line for line in plan)
+
+
+def test_session_detail_path_uses_indexes(client, conversation):
+    with _captured_queries() as queries:
+        client.get(f"{settings.api_prefix}/sessions/{conversation}")
+
+    plans = _plans(queries)
+    _assert_no_table_scan(plans)
+    assert any("message_path" in statement for statement, _ in plans)
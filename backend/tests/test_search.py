@@ -0,0 +1,88 @@
+"""
+Full-text search: ranking, paging, and the index over compressed columns.
+"""
+from sqlalchemy import text
+
+from config import settings
+from database import ChatMessage, ChatSession, SessionLocal
+
+
+def _session(*messages) -> int:
+    """A session with `messages`, (content, thought_process) pairs."""
+    db = SessionLocal()
+    try:
+        session = ChatSession(title="searchable", provider="fake", model="fake-model")
+        db.add(session)
+        db.flush()
+        for content, reasoning in messages:
+            db.add(ChatMessage(session_id=session.id, role="user", content=content, thought_process=reasoning))
+        db.commit()
+        return session.id
+    finally:
+        db.close()
+
+
+def _search(client, q: str, **params) -> dict:
+    response = client.get(f"{settings.api_prefix}/search", params={"q": q, **params})
+    assert response.status_code == 200
+    return response.json()
+
+
+def test_best_match_first(client):
+    _session(
+        ("the quokka " + "and some unrelated filler words " * 10, None),
+        ("quokka quokka", None),
+    )
+    hits = _search(client, "quokka")["hits"]
+    assert [hit["snippet"] for hit in hits][0] == "<mark>quokka</mark> <mark>quokka</mark>"
+    assert len(hits) == 2
+    assert hits[0]["score"] <= hits[1]["score"]
+
+
+def test_pages_cover_every_hit_once(client):
+    session_id = _session(*((f"wombat number {index}", None) for index in range(7)))
+    seen = []
+    cursor = None
+    while True:
+        params = {"limit": 3, "session_id": session_id}
+        if cursor:
+            params["cursor"] = cursor
+        page = _search(client, "wombat", **params)
+        assert len(page["hits"]) <= 3
+        seen.extend(hit["message_id"] for hit in page["hits"])
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    assert len(seen) == len(set(seen)) == 7
+
+
+def test_reasoning_is_searched_on_request(client):
+    _session(("the answer", "thinking about a numbat"))
+    assert _search(client, "numbat")["hits"] == []
+    assert len(_search(client, "numbat", include_reasoning="true")["hits"]) == 1
+
+
+def test_compressed_messages_are_indexed(client):
+    long_text = "padding words to get past the compression threshold " * 40 + "pangolin"
+    session_id = _session((long_text, None))
+    db = SessionLocal()
+    try:
+        stored = db.execute(
+            text("SELECT typeof(content) FROM chat_messages WHERE session_id = :id"), {"id": session_id}
+        ).scalar()
+    finally:
+        db.close()
+    assert stored == "blob"
+
+    hits = _search(client, "pangolin")["hits"]
+    assert [hit["session_id"] for hit in hits] == [session_id]
+    assert "<mark>pangolin</mark>" in hits[0]["snippet"]
+
+    # Deleting decompresses the old row to take it out of the index
+    assert client.delete(f"{settings.api_prefix}/sessions/{session_id}").status_code in (200, 204)
+    assert _search(client, "pangolin")["hits"] == []
+
+
+def test_invalid_cursor_is_rejected(client):
+    response = client.get(f"{settings.api_prefix}/search", params={"q": "x", "cursor": "not-a-cursor"})
+    assert response.status_code == 400
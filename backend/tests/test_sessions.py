@@ -0,0 +1,157 @@
+"""
+Session listing and message paging follow the active branch.
+"""
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from sqlalchemy import create_engine, event, insert, update
+from sqlalchemy.orm import sessionmaker
+
+import database
+from config import settings
+from database import Base, ChatMessage, ChatSession, SessionLocal, engine
+from pagination import decode_cursor
+from routers import sessions
+
+
+def _branched_session() -> int:
+    """A session whose first question has two answers; the second is active."""
+    db = SessionLocal()
+    try:
+        session = ChatSession(title="branched", provider="fake", model="fake-model")
+        db.add(session)
+        db.flush()
+        question = ChatMessage(session_id=session.id, role="user", content="q")
+        db.add(question)
+        db.flush()
+        answers = [
+            ChatMessage(session_id=session.id, parent_id=question.id, role="assistant", content=content)
+            for content in ("first", "second")
+        ]
+        db.add_all(answers)
+        db.flush()
+        follow_up = ChatMessage(session_id=session.id, parent_id=answers[1].id, role="user", content="more")
+        db.add(follow_up)
+        db.flush()
+        session.active_leaf_id = follow_up.id
+        db.commit()
+        return session.id
+    finally:
+        db.close()
+
+
+def test_list_and_detail_count_the_active_branch(client):
+    session_id = _branched_session()
+    listed = client.get(f"{settings.api_prefix}/sessions", params={"limit": 100}).json()
+    detail = client.get(f"{settings.api_prefix}/sessions/{session_id}").json()
+
+    assert [m["content"] for m in detail["messages"]] == ["q", "second", "more"]
+    count = next(session["message_count"] for session in listed if session["id"] == session_id)
+    assert count == detail["message_count"] == 3
+
+
+def test_message_pages_walk_the_active_branch(client):
+    session_id = _branched_session()
+    url = f"{settings.api_prefix}/sessions/{session_id}/messages"
+
+    newest = client.get(url, params={"limit": 2}).json()
+    assert [m["content"] for m in newest["messages"]] == ["second", "more"]
+    assert newest["has_more"]
+    assert decode_cursor(newest["next_cursor"], 1) == [newest["messages"][0]["id"]]
+
+    older = client.get(url, params={"limit": 2, "before": newest["next_cursor"]}).json()
+    assert [m["content"] for m in older["messages"]] == ["q"]
+    assert not older["has_more"] and older["next_cursor"] is None
+
+
+def test_session_list_query_count_is_constant(client):
+    for _ in range(3):
+        _branched_session()
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", count)
+    try:
+        listed = client.get(f"{settings.api_prefix}/sessions", params={"limit": 100}).json()
+    finally:
+        event.remove(engine, "before_cursor_execute", count)
+
+    assert len(listed) >= 3
+    # The page and the counts of all its sessions, no query per session
+    assert len(statements) == 2
+
+
+def _seed(engine, sessions: int, messages: int) -> None:
+    """`sessions` sessions of `messages` linear messages each."""
+    Base.metadata.create_all(engine)
+    now = datetime.now(timezone.utc)
+    with engine.begin() as conn:
+        conn.execute(
+            insert(ChatSession),
+            [
+                {"title": f"s{index}", "provider": "fake", "model": "fake-model", "updated_at": now + timedelta(seconds=index)}
+                for index in range(sessions)
+            ],
+        )
+        rows = []
+        for session_id in range(1, sessions + 1):
+            first_id = (session_id - 1) * messages + 1
+            for offset in range(messages):
+                rows.append(
+                    {
+                        "id": first_id + offset,
+                        "session_id": session_id,
+                        "parent_id": first_id + offset - 1 if offset else None,
+                        "role": "user" if offset % 2 == 0 else "assistant",
+                        "content": "message text " * 8,
+                        "created_at": now,
+                    }
+                )
+        conn.execute(insert(ChatMessage), rows)
+        conn.execute(update(ChatSession).values(active_leaf_id=ChatSession.id * messages))
+
+
+def _list_loading_messages(db, limit: int) -> list:
+    """The listing as it was: each session's rows loaded to count them."""
+    listed = db.query(ChatSession).order_by(ChatSession.updated_at.desc(), ChatSession.id.desc()).limit(limit).all()
+    return [(session.id, len(session.messages)) for session in listed]
+
+
+@pytest.mark.benchmark
+def test_benchmark_session_list(tmp_path):
+    session_count, message_count, limit, rounds = 1000, 500, 100, 5
+    url = f"sqlite:///{os.path.join(tmp_path, 'listing.db')}"
+    bench_engine = create_engine(url, **database._engine_kwargs(url))
+    event.listen(bench_engine, "connect", database._apply_sqlite_pragmas)
+    _seed(bench_engine, session_count, message_count)
+    Session = sessionmaker(bind=bench_engine)
+
+    def timed(list_page) -> float:
+        best = None
+        for _ in range(rounds):
+            with Session() as db:
+                started = time.perf_counter()
+                list_page(db)
+                elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        return round(best * 1000, 1)
+
+    with Session() as db:
+        first_page = sessions._list_sessions(db, 0, limit)
+        last = first_page[-1]
+    assert [s.message_count for s in first_page] == [message_count] * limit
+    results = {
+        "loading rows (before)": timed(lambda db: _list_loading_messages(db, limit)),
+        "first page": timed(lambda db: sessions._list_sessions(db, 0, limit)),
+        "keyset page": timed(lambda db: sessions._list_sessions(db, 0, limit, (last.updated_at, last.id))),
+        "offset page 9": timed(lambda db: sessions._list_sessions(db, 8 * limit, limit)),
+    }
+    bench_engine.dispose()
+
+    print(f"\n{session_count} sessions x {message_count} messages, {limit} sessions per page (best of {rounds}, ms)")
+    for name, milliseconds in results.items():
+        print(f"{name:>22}: {milliseconds}")
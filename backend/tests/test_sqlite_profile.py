@@ -0,0 +1,122 @@
+"""
+The SQLite profile applied to every connection, and what it buys concurrent writers.
+"""
+import os
+import threading
+import time
+
+import pytest
+from sqlalchemy import create_engine, event, exc, select, text, update
+from sqlalchemy.orm import sessionmaker
+
+import database
+from database import Base, ChatMessage, ChatSession, SessionLocal
+
+
+def test_connections_use_the_profile(client):
+    db = SessionLocal()
+    try:
+        pragmas = {
+            name: db.execute(text(f"PRAGMA {name}")).scalar()
+            for name in ("journal_mode", "synchronous", "foreign_keys", "busy_timeout", "temp_store")
+        }
+    finally:
+        db.close()
+    # synchronous 1 is NORMAL, temp_store 2 is MEMORY
+    assert pragmas == {
+        "journal_mode": "wal",
+        "synchronous": 1,
+        "foreign_keys": 1,
+        "busy_timeout": 5000,
+        "temp_store": 2,
+    }
+
+
+def _default_engine(url: str):
+    """The engine as created before the profile: driver defaults, rollback journal."""
+    return create_engine(url, connect_args={"check_same_thread": False})
+
+
+def _profile_engine(url: str):
+    engine = create_engine(url, **database._engine_kwargs(url))
+    event.listen(engine, "connect", database._apply_sqlite_pragmas)
+    return engine
+
+
+def _run_writers(engine, writers: int, writes: int, readers: int) -> dict:
+    """
+    `writers` threads each commit `writes` small transactions (a message
+    insert and a session update, like a stream checkpoint) while `readers`
+    threads keep reading the newest messages.
+    """
+    Base.metadata.create_all(engine)
+    Session = sessionmaker(bind=engine)
+    with Session() as db:
+        session = ChatSession(title="bench", provider="fake", model="fake-model")
+        db.add(session)
+        db.commit()
+        session_id = session.id
+
+    latencies, errors = [], []
+    lock = threading.Lock()
+    done = threading.Event()
+
+    def write(worker: int) -> None:
+        for index in range(writes):
+            started = time.perf_counter()
+            try:
+                with Session() as db:
+                    db.add(ChatMessage(session_id=session_id, role="assistant", content=f"{worker}:{index} " * 20))
+                    db.execute(update(ChatSession).where(ChatSession.id == session_id).values(title=f"{worker}:{index}"))
+                    db.commit()
+            except exc.OperationalError as e:
+                with lock:
+                    errors.append(str(e.orig))
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - started)
+
+    def read() -> None:
+        while not done.is_set():
+            try:
+                with Session() as db:
+                    db.execute(select(ChatMessage.id, ChatMessage.content).order_by(ChatMessage.id.desc()).limit(50)).all()
+            except exc.OperationalError:
+                pass
+
+    reader_threads = [threading.Thread(target=read) for _ in range(readers)]
+    writer_threads = [threading.Thread(target=write, args=(worker,)) for worker in range(writers)]
+    for thread in reader_threads:
+        thread.start()
+    started = time.perf_counter()
+    for thread in writer_threads:
+        thread.start()
+    for thread in writer_threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    done.set()
+    for thread in reader_threads:
+        thread.join()
+    engine.dispose()
+
+    latencies.sort()
+    return {
+        "commits_per_s": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 2) if latencies else None,
+        "p99_ms": round(latencies[int(len(latencies) * 0.99)] * 1000, 2) if latencies else None,
+        "errors": len(errors),
+    }
+
+
+@pytest.mark.benchmark
+def test_benchmark_concurrent_writers(tmp_path):
+    writers, writes, readers = 16, 50, 4
+    results = {}
+    for name, make_engine in (("default", _default_engine), ("profile", _profile_engine)):
+        url = f"sqlite:///{os.path.join(tmp_path, name + '.db')}"
+        results[name] = _run_writers(make_engine(url), writers, writes, readers)
+
+    print(f"\n{writers} writers x {writes} commits, {readers} readers")
+    for name, row in results.items():
+        print(f"{name:>8}: " + ", ".join(f"{key} {value}" for key, value in row.items()))
+    assert results["profile"]["errors"] == 0
@@ -0,0 +1,131 @@
+"""
+Stages of a streamed reply: `<think>` splitting and per-stage timings.
+"""
+import random
+from typing import Dict, List, Optional, Tuple
+
+from config import settings
+from routers.chat_helpers import ThinkTagSplitter
+from stage_timing import BUCKET_BOUNDS_US, Histogram
+
+
+def _reference_split(content: str, state: Dict) -> Tuple[str, Optional[str]]:
+    """The splitter the pipeline replaced, which held back the last 7-8 characters."""
+    text = f"{state.get('pending', '')}{content or ''}"
+    state["pending"] = ""
+    in_think = state.get("in_think", False)
+    output_parts: List[str] = []
+    reasoning_parts: List[str] = []
+    i = 0
+    while i < len(text):
+        if in_think:
+            close_idx = text.find("</think>", i)
+            if close_idx == -1:
+                tail_start = max(i, len(text) - 8)
+                reasoning_parts.append(text[i:tail_start])
+                state["pending"] = text[tail_start:]
+                state["in_think"] = True
+                return "".join(output_parts), "".join(reasoning_parts) or None
+            reasoning_parts.append(text[i:close_idx])
+            i = close_idx + 8
+            in_think = False
+            state["in_think"] = False
+        else:
+            open_idx = text.find("<think>", i)
+            if open_idx == -1:
+                tail_start = max(i, len(text) - 7)
+                output_parts.append(text[i:tail_start])
+                state["pending"] = text[tail_start:]
+                state["in_think"] = False
+                return "".join(output_parts), "".join(reasoning_parts) or None
+            output_parts.append(text[i:open_idx])
+            i = open_idx + 7
+            in_think = True
+            state["in_think"] = True
+    state["pending"] = ""
+    state["in_think"] = in_think
+    return "".join(output_parts), "".join(reasoning_parts) or None
+
+
+def _random_chunks(rng: random.Random, text: str) -> List[str]:
+    cuts = sorted(rng.sample(range(1, len(text)), min(len(text) - 1, rng.randint(1, 12))))
+    return [text[start:end] for start, end in zip([0] + cuts, cuts + [len(text)])]
+
+
+def test_splitter_matches_the_reference_on_split_tags():
+    rng = random.Random(49)
+    words = ["<think>", "</think>", "<thi", "</th", "<", ">", "a", "think", " ", "x<y", "\n"]
+    for _ in range(2000):
+        text = "".join(rng.choice(words) for _ in range(rng.randint(2, 30)))
+        chunks = _random_chunks(rng, text)
+
+        splitter = ThinkTagSplitter()
+        content, reasoning = "", ""
+        for chunk in chunks:
+            out, think = splitter.feed(chunk)
+            content, reasoning = content + out, reasoning + think
+        out, think = splitter.flush()
+        content, reasoning = content + out, reasoning + think
+
+        state: Dict = {}
+        expected_content, expected_reasoning = "", ""
+        for chunk in chunks:
+            out, think = _reference_split(chunk, state)
+            expected_content, expected_reasoning = expected_content + out, expected_reasoning + (think or "")
+        if state.get("in_think"):
+            expected_reasoning += state.get("pending", "")
+        else:
+            expected_content += state.get("pending", "")
+
+        assert (content, reasoning) == (expected_content, expected_reasoning), chunks
+
+
+def test_plain_text_is_not_held_back():
+    splitter = ThinkTagSplitter()
+    assert splitter.feed("no tags here") == ("no tags here", "")
+    assert splitter.feed("a <b> c") == ("a <b> c", "")
+    # Only a fragment that can still become a tag waits for the next chunk
+    assert splitter.feed("then <thi") == ("then ", "")
+    assert splitter.feed("nk>inside</think>out") == ("out", "inside")
+
+
+def test_quantiles_are_bucket_bounds_capped_at_the_largest_sample():
+    histogram = Histogram()
+    for micros in [3] * 90 + [40] * 9 + [700]:
+        histogram.record(micros / 1_000_000)
+
+    stats = histogram.stats()
+    assert stats["count"] == 100
+    assert stats["p50_us"] == 5
+    assert stats["p90_us"] == 5
+    assert stats["p99_us"] == 50
+    assert stats["max_us"] == 700
+    assert stats["buckets"] == {"5": 90, "50": 9, "1000": 1}
+
+    single = Histogram()
+    single.record(0.000_003)
+    # Never above what was measured, though the bucket bound is 5 µs
+    assert single.quantile(0.99) == 3
+    beyond = Histogram()
+    beyond.record(20)
+    assert beyond.quantile(0.5) == 20_000_000
+    assert beyond.stats()["buckets"] == {"inf": 1}
+    assert BUCKET_BOUNDS_US[-1] == 10_000_000
+
+
+def test_stages_are_timed(client, provider):
+    provider.reply = lambda messages: ["<think>hm</think>", "answer"]
+    response = client.post(
+        f"{settings.api_prefix}/chat",
+        json={
+            "provider": "fake",
+            "model": "fake-model",
+            "stream": True,
+            "messages": [{"role": "user", "content": "hi"}],
+        },
+    )
+    assert response.status_code == 200
+
+    stages = client.get(f"{settings.api_prefix}/chat/stats").json()["stages"]
+    assert set(stages) == {"decode", "think_split", "media_localize", "coalesce", "accumulate", "persist", "encode"}
+    assert all(stats["count"] > 0 for stats in stages.values())
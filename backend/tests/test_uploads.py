@@ -0,0 +1,180 @@
+"""
+Files under uploads/: stored from inline media, removed with the last message
+referencing them.
+"""
+import asyncio
+import base64
+import hashlib
+import os
+import stat
+import time
+
+from sqlalchemy import func, select
+
+import maintenance
+import upload_store
+from config import settings
+from database import ChatMessage, ChatSession, MessageSource, SessionLocal, init_db
+from search_sources import store_search_results
+
+
+def _session_with_images(*images) -> int:
+    db = SessionLocal()
+    try:
+        session = ChatSession(title="pictures", provider="fake", model="fake-model")
+        db.add(session)
+        db.flush()
+        message = ChatMessage(
+            session_id=session.id,
+            role="user",
+            content="look",
+            images=[f"/uploads/{name}" for name in images],
+        )
+        db.add(message)
+        db.flush()
+        store_search_results(db, message.id, [{"url": "https://example.com", "title": "Example"}])
+        db.commit()
+        return session.id
+    finally:
+        db.close()
+
+
+def _write(uploads, name: str, age: float = 60) -> str:
+    path = os.path.join(uploads, name)
+    with open(path, "wb") as f:
+        f.write(b"image")
+    past = time.time() - age
+    os.utime(path, (past, past))
+    return path
+
+
+def test_delete_removes_rows_and_unshared_uploads(client, uploads):
+    own = _write(uploads, "own.png")
+    thumb = _write(uploads, "own.png.thumb256.jpg")
+    shared = _write(uploads, "shared.png")
+    session_id = _session_with_images("own.png", "shared.png")
+    _session_with_images("shared.png")
+
+    assert client.delete(f"{settings.api_prefix}/sessions/{session_id}").status_code == 204
+
+    db = SessionLocal()
+    try:
+        assert db.scalar(select(func.count()).where(ChatMessage.session_id == session_id)) == 0
+        orphaned = select(func.count()).select_from(MessageSource).where(
+            MessageSource.message_id.not_in(select(ChatMessage.id))
+        )
+        assert db.scalar(orphaned) == 0
+    finally:
+        db.close()
+    assert not os.path.exists(own) and not os.path.exists(thumb)
+    assert os.path.exists(shared)
+
+
+def test_delete_keeps_uploads_stored_meanwhile(client, uploads):
+    # Written again by a request that is not committed yet
+    fresh = _write(uploads, "fresh.png", age=0)
+    session_id = _session_with_images("fresh.png")
+
+    assert client.delete(f"{settings.api_prefix}/sessions/{session_id}").status_code == 204
+    assert os.path.exists(fresh)
+
+
+def test_truncate_removes_only_the_subtree(client, uploads):
+    kept = _write(uploads, "kept.png")
+    dropped = _write(uploads, "dropped.png")
+    db = SessionLocal()
+    try:
+        session = ChatSession(title="truncated", provider="fake", model="fake-model")
+        db.add(session)
+        db.flush()
+        first = ChatMessage(session_id=session.id, role="user", content="a", images=["/uploads/kept.png"])
+        db.add(first)
+        db.flush()
+        second = ChatMessage(
+            session_id=session.id, parent_id=first.id, role="user", content="b", images=["/uploads/dropped.png"]
+        )
+        db.add(second)
+        db.flush()
+        session.active_leaf_id = second.id
+        db.commit()
+        session_id, first_id, second_id = session.id, first.id, second.id
+    finally:
+        db.close()
+
+    response = client.delete(f"{settings.api_prefix}/sessions/{session_id}/truncate/{second_id}")
+    assert response.status_code == 204
+    detail = client.get(f"{settings.api_prefix}/sessions/{session_id}").json()
+    assert [m["id"] for m in detail["messages"]] == [first_id]
+    assert os.path.exists(kept) and not os.path.exists(dropped)
+
+
+def _data_uri(payload: bytes, mime_type: str = "image/png") -> str:
+    return f"data:{mime_type};base64,{base64.b64encode(payload).decode()}"
+
+
+def _stored_images(session_id: int) -> list:
+    db = SessionLocal()
+    try:
+        return [
+            images
+            for (images,) in db.execute(
+                select(ChatMessage.images)
+                .where(ChatMessage.session_id == session_id, ChatMessage.role == "user")
+                .order_by(ChatMessage.id)
+            )
+        ]
+    finally:
+        db.close()
+
+
+def test_inline_media_is_stored_once(client, provider, uploads):
+    provider.reply = lambda messages: ["seen"]
+    image = _data_uri(b"\x89PNG same picture")
+    body = {
+        "provider": "fake",
+        "model": "fake-model",
+        "stream": False,
+        "messages": [{"role": "user", "content": "look", "images": [image]}],
+    }
+    session_id = client.post(f"{settings.api_prefix}/chat", json=body).json()["session_id"]
+    body["session_id"] = session_id
+    assert client.post(f"{settings.api_prefix}/chat", json=body).status_code == 200
+
+    name = hashlib.sha256(b"\x89PNG same picture").hexdigest() + ".png"
+    assert _stored_images(session_id) == [[f"/uploads/{name}"], [f"/uploads/{name}"]]
+    assert os.listdir(uploads) == [name]
+    with open(os.path.join(uploads, name), "rb") as f:
+        assert f.read() == b"\x89PNG same picture"
+    assert stat.S_IMODE(os.stat(os.path.join(uploads, name)).st_mode) == upload_store._FILE_MODE
+
+
+def test_undecodable_media_stays_inline(uploads):
+    broken = "data:image/png;base64,not base64!"
+    unknown = _data_uri(b"x", "application/x-unknown-type")
+    assert upload_store.offload_data_uris([broken, unknown, "/uploads/a.png"]) == (
+        [broken, unknown, "/uploads/a.png"],
+        0,
+    )
+    assert os.listdir(uploads) == []
+
+
+def test_backfill_moves_stored_inline_media(uploads):
+    # Without the app, whose startup runs the same backfill in the background
+    init_db()
+    image = _data_uri(b"old picture", "image/jpeg")
+    db = SessionLocal()
+    try:
+        session = ChatSession(title="legacy", provider="fake", model="fake-model")
+        db.add(session)
+        db.flush()
+        db.add(ChatMessage(session_id=session.id, role="user", content="old", images=[image, "/uploads/b.png"]))
+        db.commit()
+        session_id = session.id
+    finally:
+        db.close()
+
+    assert asyncio.run(maintenance.extract_inline_media()) >= 1
+
+    name = hashlib.sha256(b"old picture").hexdigest() + ".jpg"
+    assert _stored_images(session_id) == [[f"/uploads/{name}", "/uploads/b.png"]]
+    assert os.path.exists(os.path.join(uploads, name))
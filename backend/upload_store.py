@@ -0,0 +1,281 @@
+"""
+Files under uploads/ and the messages that reference them
+"""
+import base64
+import binascii
+import glob
+import hashlib
+import mimetypes
+import os
+import re
+import tempfile
+import time
+from typing import Iterable, List, Optional, Set, Tuple
+from urllib.parse import unquote_to_bytes
+
+from sqlalchemy import exists, func, or_
+from sqlalchemy.orm import Query, Session
+
+try:
+    from .database import ChatMessage
+except (ImportError, ValueError):
+    from database import ChatMessage
+
+try:
+    from PIL import Image
+except ImportError:  # optional; without it older images are not downscaled
+    Image = None
+
+
+UPLOAD_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "uploads")
+
+UPLOAD_REF = re.compile(r"/uploads/([A-Za-z0-9][A-Za-z0-9._-]*)")
+
+# Files are written to private temporary files (mkstemp uses 0600) and
+# renamed into place; they get the mode an upload written with open() has
+_umask = os.umask(0)
+os.umask(_umask)
+_FILE_MODE = 0o644 & ~_umask
+
+
+def is_upload_name(name: str) -> bool:
+    """True for a plain file name that can live directly under uploads/."""
+    return bool(name) and UPLOAD_REF.fullmatch(f"/uploads/{name}") is not None
+
+
+def upload_refs(content: Optional[str], *media: Optional[Iterable]) -> Set[str]:
+    """Names of uploaded files referenced by message content and media lists."""
+    refs = set(UPLOAD_REF.findall(content or ""))
+    for items in media:
+        if isinstance(items, str):
+            items = [items]
+        for item in items or []:
+            if isinstance(item, str):
+                refs.update(UPLOAD_REF.findall(item))
+    return refs
+
+
+# Extensions that mimetypes.guess_extension gets wrong or leaves ambiguous
+_MEDIA_EXTENSIONS = {
+    "image/jpeg": ".jpg",
+    "image/jpg": ".jpg",
+    "image/webp": ".webp",
+    "audio/mpeg": ".mp3",
+    "audio/mp3": ".mp3",
+    "audio/wav": ".wav",
+    "audio/x-wav": ".wav",
+    "video/mp4": ".mp4",
+}
+
+
+def _data_uri_bytes(uri: str) -> Optional[Tuple[bytes, str]]:
+    """Decoded payload and file extension of a `data:` URI, None if it cannot be stored."""
+    header, sep, payload = uri.partition(",")
+    if not sep:
+        return None
+    params = header[len("data:"):].split(";")
+    mime_type = params[0].strip().lower()
+    ext = _MEDIA_EXTENSIONS.get(mime_type) or mimetypes.guess_extension(mime_type)
+    if not ext:
+        # The providers derive the MIME type from the extension, so keep unknown types inline
+        return None
+    if "base64" in params[1:]:
+        try:
+            data = base64.b64decode("".join(payload.split()), validate=True)
+        except (binascii.Error, ValueError):
+            return None
+    else:
+        data = unquote_to_bytes(payload)
+    return data, ext
+
+
+def store_data_uri(uri: str) -> Optional[str]:
+    """
+    Write the payload of a `data:` URI to uploads/ and return its `/uploads/...` URL.
+
+    Files are named after the SHA-256 of their bytes, so a payload sent again
+    (e.g. the same image on every turn) is stored once.
+    """
+    decoded = _data_uri_bytes(uri)
+    if decoded is None:
+        return None
+    data, ext = decoded
+    name = f"{hashlib.sha256(data).hexdigest()}{ext}"
+    path = os.path.join(UPLOAD_DIR, name)
+    try:
+        # A fresh mtime keeps a concurrent cleanup from removing the file
+        # before the message that now references it is stored
+        os.utime(path)
+    except FileNotFoundError:
+        os.makedirs(UPLOAD_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=UPLOAD_DIR, prefix=".inline-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.chmod(tmp_path, _FILE_MODE)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+    return f"/uploads/{name}"
+
+
+def has_data_uri(*media: Optional[Iterable]) -> bool:
+    """True if any media list holds an inline `data:` URI."""
+    return any(
+        isinstance(item, str) and item.startswith("data:")
+        for items in media
+        for item in (items or [])
+    )
+
+
+def offload_data_uris(items: Optional[List]) -> Tuple[Optional[List], int]:
+    """
+    Replace the `data:` URIs of a media list with uploads/ references.
+
+    Returns the new list and the number of URI characters moved out; URIs
+    that cannot be decoded are left as they are.
+    """
+    if not items:
+        return items, 0
+    result = []
+    moved = 0
+    for item in items:
+        if isinstance(item, str) and item.startswith("data:"):
+            try:
+                url = store_data_uri(item)
+            except OSError as e:
+                print(f"[upload_store] could not store inline media: {e}")
+                url = None
+            if url is not None:
+                moved += len(item)
+                item = url
+        result.append(item)
+    return result, moved
+
+
+def thumbnail_name(name: str, size: int) -> str:
+    """Name of the downscaled JPEG copy of an uploaded image."""
+    return f"{name}.thumb{size}.jpg"
+
+
+def make_thumbnail(name: str, size: int) -> Optional[str]:
+    """
+    Downscaled copy (at most `size` pixels per side) of an uploaded image.
+
+    Returns its `/uploads/...` URL, or None when Pillow is missing or the
+    file is not a readable image. Thumbnails are written once and reused.
+    """
+    if Image is None or not is_upload_name(name):
+        return None
+    thumb = thumbnail_name(name, size)
+    path = os.path.join(UPLOAD_DIR, thumb)
+    if not os.path.exists(path):
+        try:
+            with Image.open(os.path.join(UPLOAD_DIR, name)) as image:
+                image.thumbnail((size, size))
+                fd, tmp_path = tempfile.mkstemp(dir=UPLOAD_DIR, prefix=".thumb-")
+                try:
+                    with os.fdopen(fd, "wb") as f:
+                        image.convert("RGB").save(f, "JPEG", quality=80)
+                    os.chmod(tmp_path, _FILE_MODE)
+                    os.replace(tmp_path, path)
+                except BaseException:
+                    try:
+                        os.remove(tmp_path)
+                    except OSError:
+                        pass
+                    raise
+        except (OSError, ValueError) as e:
+            print(f"[upload_store] could not create a thumbnail of {name}: {e}")
+            return None
+    return f"/uploads/{thumb}"
+
+
+def _referencing(query: Query) -> Query:
+    pattern = "%/uploads/%"
+    content = ChatMessage.content
+    if query.session.get_bind().dialect.name == "sqlite":
+        # Long content is stored compressed
+        content = func.decompress_text(content)
+    return query.filter(
+        or_(
+            content.like(pattern),
+            ChatMessage.images.like(pattern),
+            ChatMessage.videos.like(pattern),
+            ChatMessage.audios.like(pattern),
+        )
+    )
+
+
+def collect_upload_refs(db: Session, *criteria) -> Set[str]:
+    """Uploads referenced by the messages matching `criteria`, read column-wise in batches."""
+    query = _referencing(
+        db.query(ChatMessage.content, ChatMessage.images, ChatMessage.videos, ChatMessage.audios)
+    ).filter(*criteria)
+    refs: Set[str] = set()
+    for content, images, videos, audios in query.yield_per(500):
+        refs |= upload_refs(content, images, videos, audios)
+    return refs
+
+
+def _is_referenced(db: Session, name: str) -> bool:
+    """
+    True if any message may reference the upload `name`.
+
+    A LIKE match is enough: a longer name sharing the prefix only keeps the
+    file a little longer. The uncompressed media columns are tested first.
+    """
+    escaped = name.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    pattern = f"%/uploads/{escaped}%"
+    content = ChatMessage.content
+    if db.get_bind().dialect.name == "sqlite":
+        content = func.decompress_text(content)
+    condition = or_(
+        ChatMessage.images.like(pattern, escape="\\"),
+        ChatMessage.videos.like(pattern, escape="\\"),
+        ChatMessage.audios.like(pattern, escape="\\"),
+        content.like(pattern, escape="\\"),
+    )
+    return db.query(exists().where(condition)).scalar()
+
+
+def remove_unreferenced_uploads(
+    db: Session, candidates: Set[str], started: Optional[float] = None
+) -> int:
+    """
+    Delete the candidate files (and their thumbnails) that no remaining message references.
+
+    Files modified since `started` (the time the delete began, by default
+    now) are kept: the same media may have just been stored again for a
+    message that is not committed yet.
+    """
+    if not candidates:
+        return 0
+    if started is None:
+        started = time.time()
+    # File system clocks can lag time.time() by a tick
+    started -= 1
+    removed = 0
+    for name in candidates:
+        if _is_referenced(db, name):
+            continue
+        try:
+            if os.path.getmtime(os.path.join(UPLOAD_DIR, name)) >= started:
+                continue
+        except OSError:
+            pass
+        paths = [os.path.join(UPLOAD_DIR, name)]
+        paths += glob.glob(os.path.join(UPLOAD_DIR, glob.escape(name) + ".thumb*.jpg"))
+        for path in paths:
+            try:
+                os.remove(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"[upload_store] could not remove {path}: {e}")
+    return removed
@@ -187,6 +187,28 @@ class APIClient {
       return false;
     }
   }
+  async cancelGeneration(generationId: string): Promise<boolean> {
+    try {
+      const response = await fetch(this.url(`/chat/${generationId}`), {
+        method: 'DELETE',
+      });
+      return response.status === 204;
+    } catch {
+      return false;
+    }
+  }
+
+  async cancelSessionGeneration(sessionId: number): Promise<boolean> {
+    try {
+      const response = await fetch(this.url(`/sessions/${sessionId}/generation`), {
+        method: 'DELETE',
+      });
+      return response.status === 204;
+    } catch {
+      return false;
+    }
+  }
+
   async *chatStream(
     request: ChatRequest,
     signal?: AbortSignal
@@ -221,8 +243,13 @@ class APIClient {
           const rawEvent = buffer.slice(0, boundaryIndex).trim();
           buffer = buffer.slice(boundaryIndex + sepLength);
 
-          if (rawEvent.startsWith('data:')) {
-            const dataStr = rawEvent.slice(5).trim();
+          // Events may carry an `id:` field (for resuming) alongside `data:`
+          const dataLines = rawEvent
+            .split(/\r?\n/)
+            .filter((line) => line.startsWith('data:'))
+            .map((line) => line.slice(5).trim());
+          if (dataLines.length > 0) {
+            const dataStr = dataLines.join('\n');
             if (dataStr && dataStr !== '[DONE]') {
               try {
                 const data = JSON.parse(dataStr) as StreamChunk;
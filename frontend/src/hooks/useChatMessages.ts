@@ -1,4 +1,4 @@
-import { useState, useCallback } from 'react';
+import { useState, useCallback, useRef } from 'react';
 import { apiClient } from '../api/apiClient';
 import type { Message, ChatRequest, SearchResult } from '../types';
 import type { ChatRequestSettings } from './useChatSettings';
@@ -16,7 +16,7 @@ type UseChatMessagesReturn = {
   messages: Message[];
   isLoading: boolean;
   handleSendMessage: (content: string, imageUrls?: string[], videoUrls?: string[], audioUrls?: string[]) => Promise<void>;
-  handleStopGeneration: () => void;
+  handleStopGeneration: () => Promise<void>;
   handleEditMessage: (index: number, content: string) => Promise<void>;
   handleRefreshMessage: (index: number) => Promise<void>;
   resetMessages: () => void;
@@ -34,6 +34,8 @@ const useChatMessages = ({
   const [messages, setMessages] = useState<Message[]>([]);
   const [isLoading, setIsLoading] = useState(false);
   const [abortController, setAbortController] = useState<AbortController | null>(null);
+  // Generation of the running stream, announced by its first event
+  const generationIdRef = useRef<string | null>(null);
 
   const isGeminiImagen = selectedProvider === 'gemini' && selectedModel.toLowerCase().startsWith('imagen-');
   const isGeminiImageGeneration =
@@ -41,13 +43,22 @@ const useChatMessages = ({
     selectedModel.toLowerCase().includes('image') &&
     !selectedModel.toLowerCase().startsWith('imagen-');
 
-  const handleStopGeneration = useCallback(() => {
+  // Closing the stream leaves the generation running on the server, so it is
+  // cancelled there too; resolves once the partial reply is saved
+  const handleStopGeneration = useCallback(async () => {
     if (abortController) {
       abortController.abort();
       setAbortController(null);
       setIsLoading(false);
+      const generationId = generationIdRef.current;
+      generationIdRef.current = null;
+      if (generationId) {
+        await apiClient.cancelGeneration(generationId);
+      } else if (currentSessionId) {
+        await apiClient.cancelSessionGeneration(currentSessionId);
+      }
     }
-  }, [abortController]);
+  }, [abortController, currentSessionId]);
 
   const refreshMessages = useCallback(async (sessionId: number) => {
     const session = await apiClient.getSession(sessionId);
@@ -77,6 +88,7 @@ const useChatMessages = ({
       setIsLoading(true);
       const controller = new AbortController();
       setAbortController(controller);
+      generationIdRef.current = null;
 
       let newSessionId = currentSessionId;
       const currentSettings = getCurrentSettings();
@@ -210,6 +222,9 @@ const useChatMessages = ({
           }
         } else {
           for await (const chunk of apiClient.chatStream(request, controller.signal)) {
+            if (chunk.generation_id) {
+              generationIdRef.current = chunk.generation_id;
+            }
             if (chunk.session_id && !newSessionId) {
               newSessionId = chunk.session_id;
               setCurrentSessionId(newSessionId);
@@ -290,6 +305,9 @@ const useChatMessages = ({
       } finally {
         setIsLoading(false);
         setAbortController(null);
+        if (!controller.signal.aborted) {
+          generationIdRef.current = null;
+        }
         const sessionIdToRefresh = newSessionId || currentSessionId;
         if (sessionIdToRefresh) {
           loadSessions();
@@ -316,7 +334,7 @@ const useChatMessages = ({
       if (!messageToEdit || messageToEdit.role !== 'user') return;
 
       if (currentSessionId) {
-        handleStopGeneration();
+        await handleStopGeneration();
 
         if (messageToEdit.id) {
           await apiClient.truncateSession(currentSessionId, messageToEdit.id);
@@ -325,7 +343,7 @@ const useChatMessages = ({
         setMessages((prev) => prev.slice(0, index));
         handleSendMessage(content, messageToEdit.images);
       } else {
-        handleStopGeneration();
+        await handleStopGeneration();
         setMessages((prev) => prev.slice(0, index));
         handleSendMessage(content, messageToEdit.images);
       }
@@ -344,7 +362,7 @@ const useChatMessages = ({
       if (!userMessage || userMessage.role !== 'user') return;
 
       if (currentSessionId) {
-        handleStopGeneration();
+        await handleStopGeneration();
 
         if (userMessage.id) {
           await apiClient.truncateSession(currentSessionId, userMessage.id);
@@ -353,7 +371,7 @@ const useChatMessages = ({
         setMessages((prev) => prev.slice(0, userMessageIndex));
         handleSendMessage(userMessage.content, userMessage.images);
       } else {
-        handleStopGeneration();
+        await handleStopGeneration();
         setMessages((prev) => prev.slice(0, userMessageIndex));
         handleSendMessage(userMessage.content, userMessage.images);
       }
@@ -26,6 +26,7 @@ export interface Message {
   model?: string;
   thought_process?: string;
   thought_signatures?: string[];
+  status?: 'complete' | 'partial' | 'aborted';
 }
 
 export interface SearchResult {
@@ -267,11 +268,23 @@ export interface ChatRequest {
   camera_fixed?: boolean;
 }
 
+export interface ContextReport {
+  kept: number;
+  dropped: number;
+  history_tokens: number;
+  dropped_tokens: number;
+  context_length: number | null;
+  budget: number | null;
+  fixed_tokens: number;
+}
+
 export interface StreamChunk {
   content?: string;
   reasoning?: string;
   search_results?: SearchResult[];
   session_id?: number;
+  generation_id?: string;
+  context?: ContextReport;
   error?: string;
   done?: boolean;
 }